@@ -3,24 +3,34 @@ import hmac
 from hashlib import sha256
 import uuid  # For generating unique tokens
 
-from flask import Flask, render_template, request, redirect, url_for, make_response, jsonify, send_from_directory, session
+from flask import Flask, Response, render_template, request, redirect, url_for, make_response, jsonify, send_file, send_from_directory, session
 from flask_migrate import Migrate
 import requests  # Import the requests library
 # import jwt
 from joserfc.errors import JoseError
 import logging
 from flask_sqlalchemy import SQLAlchemy  # Database integration
-from models import db, AuthToken, Card, Season, Comment, AllowedUser, CardUploadMetadata  
+from models import db, AuthToken, Card, Season, Comment, AllowedUser, CardUploadMetadata, SyncJob, LeaderLease
 from config import Config
 from sqlalchemy import create_engine, select, and_, text
 from sqlalchemy.orm import Session, sessionmaker
 from sqlite3 import connect
 # from telegram_client_service import sync_telegram_messages
 from datetime import datetime
-import subprocess
-import sys
 
-import pymysql
+from db_pool import mysql_pool
+from upload_metadata import load_upload_metadata, probe_upload_metadata
+from catalog import CatalogStore, CARD_FIELDS, present_card, normalize_sort, encode_cursor, decode_cursor
+from user_collections import UserCollectionCache, category_counts, popcount
+from media_cache import MediaCache
+from telegram_bot_api import bot_api
+from media_prefetch import MediaPrefetcher
+from media_derivatives import DerivativeGenerator, variant_kind, MIMETYPES as DERIVATIVE_MIMETYPES
+from sync_jobs import SyncJobRunner
+from sync_matching import MatchingPool
+from sync_writer import PostgresSession, postgres_engine
+from leader_election import LeaderElection
+from telegram_user_sync import TelegramUserSync
 
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -34,17 +44,127 @@ migrate = Migrate(app, db)
 
 
 HIDDEN_CARD_NAMES = ['срать в помогатор апельсины', 'test', 'фаланга пальца']
+HIDDEN_CATEGORIES = ['Scarface - Tony Montana']
 
 def get_db_conn():
-    """Get MySQL database connection"""
+    """Get a pooled MySQL database connection (close() returns it to the pool)"""
     try:
-        connection = pymysql.connect(**Config.MYSQL_CONFIG)
+        connection = mysql_pool.connection()
         return connection
     except Exception as e:
         logging.error(f"Error creating MySQL connection: {e}")
         return None
 
 
+# In-memory snapshot of the visible `files` catalog, see catalog.py
+catalog = CatalogStore(
+    get_db_conn,
+    load_upload_metadata,
+    hidden_names=HIDDEN_CARD_NAMES,
+    hidden_rarities=HIDDEN_CATEGORIES,
+    probe_interval=Config.CATALOG_PROBE_INTERVAL,
+    max_age=Config.CATALOG_MAX_AGE,
+    metadata_probe=probe_upload_metadata
+)
+
+
+# Parsed users.cards columns, re-parsed only when the raw value changes
+user_collections = UserCollectionCache(max_entries=Config.USER_COLLECTION_CACHE_SIZE)
+
+
+# Card images and videos cached from the Telegram Bot API, see media_cache.py
+media_cache = MediaCache(
+    'backend/card_images',
+    'backend/card_videos',
+    index_path=Config.MEDIA_CACHE_INDEX,
+    max_bytes=Config.MEDIA_CACHE_MAX_BYTES,
+    policy=Config.MEDIA_CACHE_POLICY,
+    negative_ttl=Config.MEDIA_NEGATIVE_TTL
+)
+
+# Thumbnails and WebP/AVIF variants of cached card images, see media_derivatives.py
+derivatives = DerivativeGenerator(
+    media_cache,
+    widths=Config.MEDIA_THUMBNAIL_WIDTHS,
+    pregenerate_concurrency=Config.MEDIA_PREGENERATE_CONCURRENCY,
+    pregenerate_pause=Config.MEDIA_PREGENERATE_PAUSE
+)
+
+# Grid thumbnail widths requested by Card.vue
+GRID_THUMBNAIL_WIDTHS = (240, 480)
+
+
+def catalog_file_ids():
+    """file_ids of every visible card, newest first"""
+    # Called from the prefetch thread: a catalog refresh loads upload metadata through db.session
+    with app.app_context():
+        snapshot = catalog.get()
+    return [card.photo for card in sorted(snapshot.by_id.values(), key=lambda card: card.id, reverse=True)
+            if card.photo]
+
+
+def pregenerate_thumbnails(file_id, media):
+    if media.kind == 'image':
+        derivatives.pregenerate(media, widths=GRID_THUMBNAIL_WIDTHS)
+
+
+# Downloads media of new cards in the background so visitors hit the cache
+media_prefetcher = MediaPrefetcher(
+    media_cache,
+    catalog_file_ids,
+    lock_path=Config.MEDIA_CACHE_INDEX + '.prefetch.lock',
+    max_workers=Config.MEDIA_PREFETCH_WORKERS,
+    on_downloaded=pregenerate_thumbnails
+)
+catalog.on_change = lambda snapshot: media_prefetcher.trigger(f"catalog version {snapshot.version}")
+
+
+def telegram_sync_finished(job):
+    # Upload dates and seasons may have changed; other workers see it through probe_upload_metadata()
+    catalog.invalidate()
+    media_prefetcher.trigger("telegram sync")
+
+
+def sync_leader_deposed():
+    stop_telegram_scheduler()
+    # The new leader fails the job this worker was running; don't keep writing on its behalf
+    sync_jobs.cancel(f"worker {sync_jobs.worker} is no longer the leader")
+    sync_matching_pool.shutdown()
+
+
+# A single worker across all workers and hosts schedules and runs the Telegram syncs, see leader_election.py
+sync_leader = LeaderElection(
+    postgres_engine,
+    'telegram-sync',
+    lease_seconds=Config.SYNC_LEADER_LEASE,
+    renew_interval=Config.SYNC_LEADER_RENEW_INTERVAL,
+    on_elected=lambda: start_telegram_scheduler(),
+    on_deposed=sync_leader_deposed
+)
+
+# Processes for the leader's matching, started by its first sync, see sync_matching.py
+sync_matching_pool = MatchingPool(Config.SYNC_FUZZY_WORKERS)
+
+# Telegram syncs run as background jobs in the leader, with a warm Telegram client, see sync_jobs.py
+sync_jobs = SyncJobRunner(
+    PostgresSession,
+    lambda on_progress: TelegramUserSync(keep_client=True, on_progress=on_progress, media_index=media_cache.index,
+                                         fence=sync_leader.fence, matching_pool=sync_matching_pool),
+    is_leader=lambda: sync_leader.is_leader,
+    poll_interval=Config.SYNC_JOB_POLL_INTERVAL,
+    on_finished=telegram_sync_finished
+)
+
+
+def get_catalog():
+    """Current catalog snapshot, or None if it could not be loaded"""
+    try:
+        return catalog.get()
+    except Exception as e:
+        logging.error(f"Error loading card catalog: {e}")
+        return None
+
+
 def populate_all_cards_metadata():
     """Populate upload metadata using actual Telegram channel data with fallback"""
     try:
@@ -133,46 +253,44 @@ from apscheduler.schedulers.background import BackgroundScheduler
 
 # Add this after your existing imports and before route definitions
 
-def schedule_telegram_sync():
-    """Schedule automatic Telegram sync every 24 hours"""
+# Scheduler of the elected sync leader, None in every other worker
+telegram_scheduler = None
+
+def start_telegram_scheduler():
+    """Queue a Telegram sync whenever the last successful one is SYNC_INTERVAL_HOURS old (leader only)"""
+    global telegram_scheduler
     scheduler = BackgroundScheduler()
     
     def run_scheduled_sync():
-        logging.info("Running scheduled Telegram sync...")
         try:
-            success = run_telegram_user_sync()
-            if success:
-                logging.info("Scheduled Telegram sync completed successfully")
-            else:
-                logging.error("Scheduled Telegram sync failed")
+            job = sync_jobs.submit_if_due(Config.SYNC_INTERVAL_HOURS * 3600)
+            if job:
+                logging.info(f"Queued scheduled Telegram sync {job['id']}")
         except Exception as e:
             logging.error(f"Error in scheduled sync: {e}")
     
-    # Schedule to run every 24 hours
-    scheduler.add_job(run_scheduled_sync, 'interval', hours=24)
+    # Due-ness is checked against the sync_job table, so leader changes and restarts don't reset the schedule
+    scheduler.add_job(run_scheduled_sync, 'interval', minutes=Config.SYNC_SCHEDULE_CHECK_MINUTES,
+                      next_run_time=datetime.now())
     scheduler.start()
-    logging.info("Telegram sync scheduler started - will run every 24 hours")
-    
-    return scheduler
+    telegram_scheduler = scheduler
+    sync_jobs.wake()
+    logging.info(f"Telegram sync scheduler started - will sync every {Config.SYNC_INTERVAL_HOURS:g} hours")
+
+def stop_telegram_scheduler():
+    global telegram_scheduler
+    scheduler, telegram_scheduler = telegram_scheduler, None
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+        logging.info("Telegram sync scheduler stopped")
 
 # Add this to your existing manual sync endpoint for immediate triggers
 @app.route("/api/trigger-sync-now")
 def trigger_sync_now():
-    """Immediately trigger Telegram sync"""
+    """Immediately trigger Telegram sync (in the background, see /api/sync-jobs/<job_id>)"""
     try:
         logging.info("Immediate Telegram sync triggered via API")
-        success = run_telegram_user_sync()
-        
-        if success:
-            return jsonify({
-                'status': 'success',
-                'message': 'Telegram sync completed successfully'
-            }), 200
-        else:
-            return jsonify({
-                'status': 'error', 
-                'message': 'Telegram sync failed - check logs'
-            }), 500
+        return sync_job_accepted(*sync_jobs.submit(reason="trigger-sync-now"))
             
     except Exception as e:
         logging.error(f"Immediate sync error: {e}")
@@ -196,33 +314,64 @@ with app.app_context():
         else:
             logging.info(f"Found {existing_count} existing metadata entries")
             
-        # Start the scheduled sync
-        schedule_telegram_sync()
-        logging.info("Automatic Telegram sync scheduler started")
-            
     except Exception as e:
         logging.error(f"Error during database initialization: {e}")
 
+    try:
+        # Index files downloaded before the index existed and apply the disk budget
+        media_cache.reconcile()
+    except Exception as e:
+        logging.error(f"Error reconciling the media cache: {e}")
 
-
-def run_telegram_user_sync():
-    """Run Telegram user sync as a separate process"""
     try:
-        result = subprocess.run([
-            sys.executable, 'telegram_user_sync.py'
-        ], capture_output=True, text=True, timeout=300)  # 5 minute timeout
-        
-        logging.info(f"user sync process stdout: {result.stdout}")
-        if result.stderr:
-            logging.error(f"user sync process stderr: {result.stderr}")
-        
-        return result.returncode == 0
-    except subprocess.TimeoutExpired:
-        logging.error("Telegram user sync process timed out")
-        return False
+        # Every worker campaigns; the elected one schedules syncs and runs the jobs queued by any worker
+        sync_jobs.start()
+        sync_leader.start()
+        logging.info("Telegram sync leader election started")
     except Exception as e:
-        logging.error(f"Error running user sync process: {e}")
-        return False
+        logging.error(f"Error starting the Telegram sync: {e}")
+
+
+
+def sync_job_accepted(job, created):
+    """202 response for a submitted sync job, pointing at its status"""
+    status_url = url_for('sync_job_status', job_id=job['id'])
+    response = jsonify({
+        'status': 'accepted',
+        'message': 'Telegram sync queued' if created else 'Telegram sync already queued',
+        'job': job,
+        'status_url': status_url
+    })
+    response.headers['Location'] = status_url
+    return response, 202
+
+
+@app.route("/api/sync-jobs/<job_id>")
+def sync_job_status(job_id):
+    """State and progress of a Telegram sync job"""
+    job = db.session.get(SyncJob, job_id)
+    if job is None:
+        return jsonify({'error': 'Sync job not found'}), 404
+    return jsonify(job.present()), 200
+
+
+@app.route("/api/sync-leader")
+def sync_leader_status():
+    """Which worker currently schedules and runs the Telegram syncs"""
+    lease = db.session.get(LeaderLease, sync_leader.name)
+    return jsonify({
+        'lease': lease.present() if lease else None,
+        'worker': sync_leader.identity,
+        'is_leader': sync_leader.is_leader
+    }), 200
+
+
+@app.route("/api/sync-jobs")
+def list_sync_jobs():
+    """Most recent Telegram sync jobs, newest first"""
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    jobs = SyncJob.query.order_by(SyncJob.created_at.desc()).limit(limit).all()
+    return jsonify([job.present() for job in jobs]), 200
     
 
 @app.route('/placeholder.jpg')
@@ -267,7 +416,7 @@ def download_avatar(url, user_id):
     os.makedirs(avatar_dir, exist_ok=True)
     filename = os.path.join(avatar_dir, f"{user_id}.jpg")  # Assuming avatars are JPEGs, adjust if needed
     try:
-        response = requests.get(url, stream=True)
+        response = bot_api.get(url, stream=True)
         response.raise_for_status()  # Raise an exception for bad status codes
         with open(filename, 'wb') as f:
             for chunk in response.iter_content(chunk_size=8192):
@@ -400,37 +549,12 @@ def home():
 # In app.py, add this endpoint
 @app.route("/api/manual-sync-telegram")
 def manual_sync_telegram():
-    """Manually trigger Telegram sync with options"""
+    """Manually trigger Telegram sync with options (in the background, see /api/sync-jobs/<job_id>)"""
     sync_type = request.args.get('type', 'full')  # 'full' or 'incremental'
     
     try:
         logging.info(f"Manual Telegram sync triggered: {sync_type}")
-        
-        if sync_type == 'incremental':
-            # Use the new incremental sync for better performance
-            from telegram_user_sync import TelegramUserSync
-            import asyncio
-            
-            sync = TelegramUserSync()
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            success = loop.run_until_complete(sync.sync_new_cards_only())
-        else:
-            # Full sync
-            success = run_telegram_user_sync()
-        
-        if success:
-            return jsonify({
-                'status': 'success',
-                'message': f'{sync_type.capitalize()} Telegram sync completed successfully',
-                'type': sync_type
-            }), 200
-        else:
-            return jsonify({
-                'status': 'error', 
-                'message': f'{sync_type.capitalize()} Telegram sync failed - check logs',
-                'type': sync_type
-            }), 500
+        return sync_job_accepted(*sync_jobs.submit(full=sync_type != 'incremental', reason=f"manual {sync_type}"))
             
     except Exception as e:
         logging.error(f"Manual sync error: {e}")
@@ -467,7 +591,8 @@ def db_status():
         return jsonify({
             "postgres_version": pg_version,
             "mysql_version": mysql_version,
-            "cards_count": cards_count
+            "cards_count": cards_count,
+            "mysql_pool": mysql_pool.stats()
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -475,48 +600,72 @@ def db_status():
         connection.close()
 
 
+@app.route("/api/db-pool-stats")
+def db_pool_stats():
+    """MySQL connection pool metrics for this worker"""
+    return jsonify({'pid': os.getpid(), 'mysql_pool': mysql_pool.stats()}), 200
+
+
+@app.route("/api/media-prefetch-status")
+def media_prefetch_status():
+    """Progress of this worker's last media prefetch run"""
+    return jsonify({'pid': os.getpid(), 'prefetch': media_prefetcher.status()}), 200
+
+
+@app.route("/api/media-cache-stats")
+def media_cache_stats():
+    """Card media cache usage, aggregated over all workers"""
+    try:
+        return jsonify(media_cache.stats()), 200
+    except Exception as e:
+        logging.error(f"Error reading media cache stats: {str(e)}")
+        return jsonify({'error': 'Failed to read media cache stats'}), 500
+
+
 @app.route("/api/debug-telegram-sync")
 def debug_telegram_sync():
-    """Debug endpoint to test Telegram sync functionality"""
+    """Debug endpoint to test card matching against the local message archive (no Telegram traffic)"""
     try:
-        from telegram_client_service import telegram_client_service
-        import asyncio
+        from telegram_user_sync import TelegramUserSync
+        from message_archive import MessageArchive
+        from card_matcher import CardMatcher, normalize_for_fuzzy_match
         
-        # Test async message fetching
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        messages = loop.run_until_complete(
-            telegram_client_service.get_channel_messages(limit=50)
-        )
+        archive = MessageArchive(db.session, TelegramUserSync().channel_username)
+        messages = archive.messages(limit=request.args.get('limit', 2000, type=int))
+        matcher = CardMatcher(messages)
         
         # Test card matching
-        from app import get_db_conn
         connection = get_db_conn()
-        test_results = []
+        if not connection:
+            return jsonify({'error': 'Database connection failed'}), 500
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT id, name FROM files WHERE id IN (336, 1, 100, 200, 300) ORDER BY id")
+                test_cards = cursor.fetchall()
+        finally:
+            connection.close()
         
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT id, name FROM files WHERE id IN (336, 1, 100, 200, 300) ORDER BY id")
-            test_cards = cursor.fetchall()
-            
-            for card in test_cards:
-                match = telegram_client_service.find_card_in_messages(card['name'], messages)
-                test_results.append({
-                    'card_id': card['id'],
-                    'card_name': card['name'],
-                    'normalized_name': telegram_client_service.normalize_card_name(card['name']),
-                    'found_in_messages': match is not None,
-                    'match_date': match.date.isoformat() if match else None,
-                    'match_message_id': match.id if match else None,
-                    'match_text_preview': (match.text or match.message or "")[:100] + '...' if match else None
-                })
+        test_results = []
+        for card in test_cards:
+            match = matcher.exact_match(card['name']) or matcher.fuzzy_match(card['name'])[0]
+            test_results.append({
+                'card_id': card['id'],
+                'card_name': card['name'],
+                'normalized_name': normalize_for_fuzzy_match(card['name']),
+                'found_in_messages': match is not None,
+                'match_date': match.date.isoformat() if match else None,
+                'match_message_id': match.id if match else None,
+                'match_text_preview': (match.text or "")[:100] + '...' if match else None
+            })
         
         return jsonify({
             'total_messages_found': len(messages),
+            'archived_messages': archive.count(),
             'test_cards': test_results,
             'message_sample': [{
                 'id': msg.id,
                 'date': msg.date.isoformat(),
-                'text': (msg.text or msg.message or "")[:200]
+                'text': (msg.text or "")[:200]
             } for msg in messages[:5]] if messages else []
         })
         
@@ -567,127 +716,112 @@ def get_all_metadata():
         return jsonify({'error': str(e)}), 500
 
 
+MEDIA_MIMETYPES = {'image': 'image/jpeg', 'video': 'video/mp4'}
+
+
+def send_cached_media(media, mimetype):
+    """Send a cached media file with Range, ETag and Last-Modified support.
+
+    The ETag is the SHA-256 of the file, so it is strong and identical across
+    workers and file_ids. With MEDIA_ACCEL_REDIRECT_PREFIX set, nginx serves
+    the bytes itself (internal location mapped to the backend directory) and
+    Flask only sends the headers.
+    """
+    if Config.MEDIA_ACCEL_REDIRECT_PREFIX:
+        relative_path = os.path.relpath(media.path, 'backend').replace(os.sep, '/')
+        response = make_response('')
+        response.headers.set('X-Accel-Redirect', f"{Config.MEDIA_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{relative_path}")
+        response.headers.set('Content-Type', mimetype)
+        response.headers.set('ETag', f'"{media.etag}"')
+        response.headers.set('Cache-Control', 'public, max-age=3600')
+        return response
+
+    # conditional=True answers If-None-Match/If-Modified-Since with 304 and
+    # Range with 206; the file goes out through wsgi.file_wrapper (sendfile)
+    response = send_file(
+        os.path.abspath(media.path),
+        mimetype=mimetype,
+        conditional=True,
+        etag=media.etag,
+        max_age=3600
+    )
+    response.headers.set('Accept-Ranges', 'bytes')
+    response.headers.set('Cache-Control', 'public, max-age=3600')
+    return response
+
+
+def send_card_variant(file_id, requested_width):
+    """Resized image in the best format the client accepts, or None to serve the original"""
+    original = media_cache.fetch(file_id)
+    if original is None:
+        return send_from_directory('public', 'placeholder.jpg')
+    if original.kind != 'image' or not os.path.exists(original.path):
+        return None
+
+    width = derivatives.snap_width(requested_width)
+    suffix = derivatives.negotiate(request.headers.get('Accept'))
+    variant = derivatives.get(original, width, suffix)
+    if variant is not None and not os.path.exists(variant.path):
+        media_cache.forget_variant(original.content_hash, variant_kind(width, suffix))
+        variant = derivatives.get(original, width, suffix)
+    if variant is None:
+        return None
+
+    response = send_cached_media(variant, DERIVATIVE_MIMETYPES[suffix])
+    response.headers.set('Vary', 'Accept')
+    return response
+
+
 @app.route('/api/card_image/<path:file_id>')
 def serve_card_image(file_id):
-    """Serve card images/videos from local cache, downloading from Telegram if not cached"""
-    TOKEN = os.getenv("CARDS_BOT_TOKEN")
-    
-    if not TOKEN:
-        logging.error("CARDS_BOT_TOKEN environment variable is not set!")
-        return send_from_directory('public', 'placeholder.jpg')
-    
+    """Serve card images/videos from local cache, downloading from Telegram if not cached.
+
+    With ?w=<pixels> images are served as a thumbnail of (about) that width,
+    in AVIF/WebP when the Accept header allows it.
+    """
     logging.debug(f"Attempting to serve media for file_id: {file_id}")
-    
-    # Create cache directories if they don't exist
-    image_cache_dir = 'backend/card_images'
-    video_cache_dir = 'backend/card_videos'
-    os.makedirs(image_cache_dir, exist_ok=True)
-    os.makedirs(video_cache_dir, exist_ok=True)
-    
-    # Check if file is already cached as image
-    image_cache_file = os.path.join(image_cache_dir, f"{file_id}.jpg")
-    video_cache_file = os.path.join(video_cache_dir, f"{file_id}.mp4")
-    
-    # Check image cache first
-    if os.path.exists(image_cache_file):
+
+    width = request.args.get('w', type=int)
+    if width and width > 0:
         try:
-            logging.debug(f"Serving from image cache: {image_cache_file}")
-            return send_from_directory(image_cache_dir, f"{file_id}.jpg")
+            response = send_card_variant(file_id, width)
+            if response is not None:
+                return response
         except Exception as e:
-            logging.warning(f"Error serving cached image for {file_id}: {str(e)}")
+            logging.error(f"Error serving card thumbnail for {file_id}: {str(e)}", exc_info=True)
     
-    # Check video cache
-    if os.path.exists(video_cache_file):
-        try:
-            logging.debug(f"Serving from video cache: {video_cache_file}")
-            response = make_response(send_from_directory(video_cache_dir, f"{file_id}.mp4"))
-            response.headers.set('Content-Type', 'video/mp4')
-            response.headers.set('Cache-Control', 'public, max-age=3600')
-            return response
-        except Exception as e:
-            logging.warning(f"Error serving cached video for {file_id}: {str(e)}")
+    media = media_cache.fetch_streaming(file_id)
+    if media is not None and media[0] == 'file' and not os.path.exists(media[1].path):
+        # Evicted by another worker since this one last saw it
+        media_cache.forget(file_id)
+        media = media_cache.fetch_streaming(file_id)
+    if media is None:
+        return send_from_directory('public', 'placeholder.jpg')
     
     try:
-        # First, get file path from Telegram API
-        api_url = f"https://api.telegram.org/bot{TOKEN}/getFile?file_id={file_id}"
-        response = requests.get(api_url)
-        
-        if response.status_code != 200:
-            logging.warning(f"Failed to get file info for file_id {file_id}: {response.text}")
-            return send_from_directory('public', 'placeholder.jpg')
-        
-        file_info = response.json()
-        if not file_info.get("ok"):
-            error_description = file_info.get('description', 'Unknown error')
-            logging.warning(f"Telegram API error for file_id {file_id}: {error_description}")
-            
-            if file_id.startswith('CgAC'):
-                logging.info(f"File {file_id} appears to be a special type (sticker/animation), using placeholder")
-            return send_from_directory('public', 'placeholder.jpg')
-        
-        file_path = file_info.get("result", {}).get("file_path")
-        if not file_path:
-            logging.warning(f"file_path not found for file_id {file_id}")
-            return send_from_directory('public', 'placeholder.jpg')
-        
-        logging.debug(f"File path obtained: {file_path}")
-        
-        # Download the file from Telegram
-        file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_path}"
-        file_response = requests.get(file_url)
-        
-        if file_response.status_code != 200:
-            logging.warning(f"Failed to download file for file_id {file_id}: {file_response.status_code}")
-            return send_from_directory('public', 'placeholder.jpg')
-        
-        # Determine if this is a video file based on file path extension
-        is_video = file_path.lower().endswith(('.mp4', '.mov', '.avi', '.webm'))
-        
-        if is_video:
-            # Cache as video
-            try:
-                with open(video_cache_file, 'wb') as f:
-                    f.write(file_response.content)
-                logging.debug(f"Cached video for file_id {file_id} at {video_cache_file}")
-            except Exception as e:
-                logging.warning(f"Failed to cache video for {file_id}: {str(e)}")
-            
-            # Return the video
-            response = make_response(file_response.content)
-            response.headers.set('Content-Type', 'video/mp4')
+        if media[0] == 'stream':
+            # First request for this file: relay it while it is written to the cache
+            _, chunks, kind, size = media
+            response = Response(chunks, mimetype=MEDIA_MIMETYPES[kind], direct_passthrough=True)
+            if size is not None:
+                response.headers.set('Content-Length', str(size))
             response.headers.set('Cache-Control', 'public, max-age=3600')
-            logging.debug(f"Successfully served video for {file_id}")
             return response
-        else:
-            # Cache as image
-            try:
-                with open(image_cache_file, 'wb') as f:
-                    f.write(file_response.content)
-                logging.debug(f"Cached image for file_id {file_id} at {image_cache_file}")
-            except Exception as e:
-                logging.warning(f"Failed to cache image for {file_id}: {str(e)}")
-            
-            # Return the image
-            response = make_response(file_response.content)
-            response.headers.set('Content-Type', 'image/jpeg')
-            response.headers.set('Cache-Control', 'public, max-age=3600')
-            logging.debug(f"Successfully served image for {file_id}")
-            return response
-            
+
+        _, cached = media
+        return send_cached_media(cached, MEDIA_MIMETYPES[cached.kind])
     except Exception as e:
         logging.error(f"Error serving card media for {file_id}: {str(e)}", exc_info=True)
+        if media[0] == 'stream':
+            media[1].close()
         return send_from_directory('public', 'placeholder.jpg')
 
 
 @app.route("/api/sync-telegram-messages")
 def sync_telegram_messages_route():
-    """Endpoint to manually trigger Telegram message synchronization"""
+    """Endpoint to manually trigger Telegram message synchronization (in the background)"""
     try:
-        success = run_telegram_user_sync()  # Changed to bot sync
-        if success:
-            return jsonify({"status": "sync completed successfully"}), 200
-        else:
-            return jsonify({"error": "Sync failed - check logs"}), 500
+        return sync_job_accepted(*sync_jobs.submit(reason="sync-telegram-messages"))
     except Exception as e:
         logging.error(f"Sync error: {e}")
         return jsonify({"error": "Sync failed"}), 500
@@ -696,309 +830,162 @@ def sync_telegram_messages_route():
 @app.route("/api/categories")
 def get_categories():
     """Get all categories: all cards, available at shop, and rarities"""
-    connection = get_db_conn()
-    if not connection:
+    snapshot = get_catalog()
+    if snapshot is None:
         return jsonify({'error': 'Database connection failed'}), 500
     
     try:
-        with connection.cursor() as cursor:
-            # Define hidden categories to exclude - only Scarface remains hidden
-            hidden_categories = ['Scarface - Tony Montana']
-            
-            # Get total card count (excluding hidden categories AND hidden card names)
-            cursor.execute("""
-                SELECT COUNT(*) as total 
-                FROM files 
-                WHERE rare NOT IN (%s)
-                AND name NOT IN (%s, %s, %s)
-            """, hidden_categories + HIDDEN_CARD_NAMES)
-            total_cards = cursor.fetchone()['total']
-            
-            # Get shop available count (excluding hidden categories AND hidden card names)
-            cursor.execute("""
-                SELECT COUNT(*) as shop_count 
-                FROM files 
-                WHERE shop != '-' AND shop IS NOT NULL 
-                AND rare NOT IN (%s)
-                AND name NOT IN (%s, %s, %s)
-            """, hidden_categories + HIDDEN_CARD_NAMES)
-            shop_count = cursor.fetchone()['shop_count']
-            
-            # Get all rarities with counts (excluding hidden categories AND hidden card names)
-            cursor.execute("""
-                SELECT rare, COUNT(*) as count 
-                FROM files 
-                WHERE rare NOT IN (%s)
-                AND name NOT IN (%s, %s, %s)
-                GROUP BY rare 
-                ORDER BY count DESC
-            """, hidden_categories + HIDDEN_CARD_NAMES)
-            rarities_data = cursor.fetchall()
-            
-            # Build categories list (same as before)
-            categories = [
-                {
-                    'id': 'all',
-                    'name': 'All Cards',
-                    'type': 'general',
-                    'count': total_cards
-                },
-                {
-                    'id': 'shop',
-                    'name': 'Available at Shop', 
-                    'type': 'shop',
-                    'count': shop_count
-                }
-            ]
-            
-            # Add rarities as categories
-            for rarity_data in rarities_data:
-                categories.append({
-                    'id': f"rarity_{rarity_data['rare']}",
-                    'name': rarity_data['rare'],
-                    'type': 'rarity',
-                    'count': rarity_data['count']
-                })
-            
-            return jsonify(categories), 200
+        # Counts come straight from the category index of this catalog version
+        categories = [
+            {
+                'id': category_id,
+                'name': name,
+                'type': category_type,
+                'count': count
+            }
+            for category_id, name, category_type, count in snapshot.index.summary()
+        ]
+        
+        return jsonify(categories), 200
             
     except Exception as e:
         logging.error(f"Error fetching categories: {str(e)}")
         return jsonify({'error': 'Failed to fetch categories'}), 500
-    finally:
-        connection.close()
+
+
+def list_category_cards(snapshot, category_id, owned=None, total_count=None):
+    """Sorted, optionally paginated and projected card listing for a category.
+
+    Query parameters: sort/direction as before, limit (page size, capped at
+    Config.MAX_PAGE_SIZE), cursor (next_cursor of the previous page) and
+    fields (comma-separated card keys; id is always included). Without
+    limit the whole category is returned. Returns (payload, status).
+    """
+    sort_field, sort_direction = normalize_sort(request.args.get('sort', 'id'), request.args.get('direction', 'desc'))
+    
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, Config.MAX_PAGE_SIZE))
+    
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            after = decode_cursor(cursor, sort_field, sort_direction)
+        except ValueError as e:
+            return {'error': f'Invalid cursor: {e}'}, 400
+    
+    fields = None
+    requested = request.args.get('fields')
+    if requested:
+        fields = [field.strip() for field in requested.split(',') if field.strip()]
+        unknown = [field for field in fields if field not in CARD_FIELDS]
+        if unknown:
+            return {'error': f"Unknown fields: {', '.join(unknown)}"}, 400
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+    
+    try:
+        page = snapshot.page(category_id, sort_field, sort_direction, after=after, limit=limit, owned=owned)
+    except TypeError:
+        # A hand-edited cursor whose key doesn't compare with this ordering
+        return {'error': 'Invalid cursor'}, 400
+    if page is None:
+        return {'error': 'Invalid category ID'}, 400
+    cards, next_key = page
+    
+    transformed_cards = [present_card(card) for card in cards]
+    if fields:
+        transformed_cards = [{field: card[field] for field in fields} for card in transformed_cards]
+    
+    resolved_id = snapshot.index.resolve(category_id)
+    return {
+        'cards': transformed_cards,
+        'total_count': total_count(resolved_id) if total_count else snapshot.index.count(resolved_id),
+        'category_id': category_id,
+        'next_cursor': encode_cursor(sort_field, sort_direction, next_key) if next_key is not None else None
+    }, 200
 
 
 @app.route("/api/cards/by-category/<category_id>")
 def get_cards_by_category(category_id):
     """Get cards filtered by category (all cards, shop, or specific rarity)"""
-    connection = get_db_conn()
-    if not connection:
+    snapshot = get_catalog()
+    if snapshot is None:
         return jsonify({'error': 'Database connection failed'}), 500
     
     try:
-        sort_field = request.args.get('sort', 'id')  # Default to 'id'
-        sort_direction = request.args.get('direction', 'desc')
-        
-        # Define valid MySQL columns to prevent SQL injection
-        valid_mysql_columns = ['id', 'name', 'rare', 'fame']
-        
-        # If sort_field is 'season', we'll handle it in Python later
-        if sort_field not in valid_mysql_columns:
-            sort_field = 'id'  # Fallback to ID
-        
-        # Define hidden categories to exclude - only Scarface remains hidden
-        hidden_categories = ['Scarface - Tony Montana']
-        
-        with connection.cursor() as cursor:
-            # Handle different category types
-            if category_id == 'all':
-                query = """
-                    SELECT id, tg_id as photo, name, rare as rarity, fame as points 
-                    FROM files 
-                    WHERE rare NOT IN (%s)
-                    AND name NOT IN (%s, %s, %s)
-                    ORDER BY {field} {direction}
-                """.format(field=sort_field, direction=sort_direction)
-                cursor.execute(query, hidden_categories + HIDDEN_CARD_NAMES)
-                
-            elif category_id == 'shop':
-                query = """
-                    SELECT id, tg_id as photo, name, rare as rarity, fame as points 
-                    FROM files 
-                    WHERE shop != '-' AND shop IS NOT NULL
-                    AND rare NOT IN (%s)
-                    AND name NOT IN (%s, %s, %s)
-                    ORDER BY {field} {direction}
-                """.format(field=sort_field, direction=sort_direction)
-                cursor.execute(query, hidden_categories + HIDDEN_CARD_NAMES)
-                
-            elif category_id.startswith('rarity_'):
-                rarity_name = category_id.replace('rarity_', '')
-                import urllib.parse
-                rarity_name = urllib.parse.unquote(rarity_name)
-                
-                query = """
-                    SELECT id, tg_id as photo, name, rare as rarity, fame as points 
-                    FROM files 
-                    WHERE rare = %s
-                    AND name NOT IN (%s, %s, %s)
-                    ORDER BY {field} {direction}
-                """.format(field=sort_field, direction=sort_direction)
-                cursor.execute(query, (rarity_name,) + tuple(HIDDEN_CARD_NAMES))
-                
-            else:
-                return jsonify({'error': 'Invalid category ID'}), 400
-            
-            cards = [dict(row) for row in cursor.fetchall()]
-            
-            # Transform to match frontend expectations and add upload metadata from SQLite
-            transformed_cards = []
-            for card in cards:
-                # Get upload metadata from SQLite (separate database)
-                metadata = CardUploadMetadata.query.filter_by(card_id=card['id']).first()
-                
-                # Default values if no metadata
-                upload_date = None
-                season = 1
-                
-                if metadata:
-                    upload_date = metadata.upload_date.isoformat() if metadata.upload_date else None
-                    season = metadata.season if metadata.season else 1
-                
-                transformed_card = {
-                    'id': card['id'],
-                    'uuid': card['id'],
-                    'img': card['photo'],
-                    'name': card['name'],
-                    'rarity': card['rarity'],
-                    'category': card['rarity'],
-                    'points': card['points'],
-                    'upload_date': upload_date,
-                    'season': season
-                }
-                transformed_cards.append(transformed_card)
-            
-            # Apply season sorting in Python if requested
-            if request.args.get('sort') == 'season':
-                transformed_cards.sort(key=lambda x: x.get('season', 1), 
-                                     reverse=(sort_direction == 'desc'))
-            
-            return jsonify({
-                'cards': transformed_cards,
-                'total_count': len(transformed_cards),
-                'category_id': category_id
-            }), 200
+        payload, status = list_category_cards(snapshot, category_id)
+        return jsonify(payload), status
             
     except Exception as e:
         logging.error(f"Error fetching cards by category: {str(e)}")
         return jsonify({'error': 'Failed to fetch cards'}), 500
-    finally:
-        connection.close()
 
 
 @app.route("/api/rarity_newest_cards")
 def get_rarity_newest_cards():
     """Get the newest card image for each rarity category"""
-    connection = get_db_conn()
-    if not connection:
+    snapshot = get_catalog()
+    if snapshot is None:
         return jsonify({'error': 'Database connection failed'}), 500
     
     try:
-        # Define hidden categories to exclude - only Scarface remains hidden
-        hidden_categories = ['Scarface - Tony Montana']
+        # Convert to dictionary with rarity as key
+        result = {}
+        for category_id, rarity in sorted(snapshot.index.rarities.items(), key=lambda item: item[1]):
+            card = snapshot.newest_card(category_id)
+            result[rarity] = {
+                'photo': card.photo,
+                'name': card.name
+            }
         
-        with connection.cursor() as cursor:
-            # Get the newest card (highest ID) for each rarity, excluding hidden card names
-            cursor.execute("""
-                SELECT f1.rare, f1.tg_id as photo, f1.name
-                FROM files f1
-                INNER JOIN (
-                    SELECT rare, MAX(id) as max_id
-                    FROM files 
-                    WHERE rare NOT IN (%s)
-                    AND name NOT IN (%s, %s, %s)
-                    GROUP BY rare
-                ) f2 ON f1.rare = f2.rare AND f1.id = f2.max_id
-                ORDER BY f1.rare
-            """, hidden_categories + HIDDEN_CARD_NAMES)
-            
-            newest_cards = cursor.fetchall()
-            
-            # Convert to dictionary with rarity as key
-            result = {}
-            for card in newest_cards:
-                result[card['rare']] = {
-                    'photo': card['photo'],
-                    'name': card['name']
-                }
-            
-            return jsonify(result), 200
+        return jsonify(result), 200
             
     except Exception as e:
         logging.error(f"Error fetching newest rarity cards: {str(e)}")
         return jsonify({'error': 'Failed to fetch newest cards'}), 500
-    finally:
-        connection.close()
 
 
 @app.route("/api/all_categories_newest_cards")
 def get_all_categories_newest_cards():
     """Get the newest card image for all categories including All Cards and Shop"""
-    connection = get_db_conn()
-    if not connection:
+    snapshot = get_catalog()
+    if snapshot is None:
         return jsonify({'error': 'Database connection failed'}), 500
     
     try:
-        # Define hidden categories to exclude - only Scarface remains hidden
-        hidden_categories = ['Scarface - Tony Montana']
+        result = {}
         
-        with connection.cursor() as cursor:
-            result = {}
-            
-            # Get newest card for "All Cards" category (overall newest card), excluding hidden card names
-            cursor.execute("""
-                SELECT tg_id as photo, name, rare as rarity
-                FROM files 
-                WHERE rare NOT IN (%s)
-                AND name NOT IN (%s, %s, %s)
-                ORDER BY id DESC 
-                LIMIT 1
-            """, hidden_categories + HIDDEN_CARD_NAMES)
-            
-            all_cards_newest = cursor.fetchone()
-            if all_cards_newest:
-                result['All Cards'] = {
-                    'photo': all_cards_newest['photo'],
-                    'name': all_cards_newest['name']
-                }
-            
-            # Get newest card for "Shop" category (newest card available in shop), excluding hidden card names
-            cursor.execute("""
-                SELECT tg_id as photo, name, rare as rarity
-                FROM files 
-                WHERE shop != '-' AND shop IS NOT NULL
-                AND rare NOT IN (%s)
-                AND name NOT IN (%s, %s, %s)
-                ORDER BY id DESC 
-                LIMIT 1
-            """, hidden_categories + HIDDEN_CARD_NAMES)
-            
-            shop_newest = cursor.fetchone()
-            if shop_newest:
-                result['Available at Shop'] = {
-                    'photo': shop_newest['photo'],
-                    'name': shop_newest['name']
-                }
-            
-            # Also include all rarity categories for consistency, excluding hidden card names
-            cursor.execute("""
-                SELECT f1.rare, f1.tg_id as photo, f1.name
-                FROM files f1
-                INNER JOIN (
-                    SELECT rare, MAX(id) as max_id
-                    FROM files 
-                    WHERE rare NOT IN (%s)
-                    AND name NOT IN (%s, %s, %s)
-                    GROUP BY rare
-                ) f2 ON f1.rare = f2.rare AND f1.id = f2.max_id
-                ORDER BY f1.rare
-            """, hidden_categories + HIDDEN_CARD_NAMES)
-            
-            rarity_newest_cards = cursor.fetchall()
-            for card in rarity_newest_cards:
-                result[card['rare']] = {
-                    'photo': card['photo'],
-                    'name': card['name']
-                }
-            
-            return jsonify(result), 200
+        # Newest card for "All Cards" category (overall newest card)
+        all_cards_newest = snapshot.newest_card('all')
+        if all_cards_newest:
+            result['All Cards'] = {
+                'photo': all_cards_newest.photo,
+                'name': all_cards_newest.name
+            }
+        
+        # Newest card for "Shop" category (newest card available in shop)
+        shop_newest = snapshot.newest_card('shop')
+        if shop_newest:
+            result['Available at Shop'] = {
+                'photo': shop_newest.photo,
+                'name': shop_newest.name
+            }
+        
+        # Also include all rarity categories for consistency
+        for category_id, rarity in sorted(snapshot.index.rarities.items(), key=lambda item: item[1]):
+            card = snapshot.newest_card(category_id)
+            result[rarity] = {
+                'photo': card.photo,
+                'name': card.name
+            }
+        
+        return jsonify(result), 200
             
     except Exception as e:
         logging.error(f"Error fetching newest cards for all categories: {str(e)}")
         return jsonify({'error': 'Failed to fetch newest cards'}), 500
-    finally:
-        connection.close()
 
 
 @app.route('/api/check_permission', methods=['GET'])
@@ -1015,56 +1002,37 @@ def check_permission():
 
 @app.route("/api/card_info/<card_id>")
 def get_card_info(card_id):  
-    connection = get_db_conn()
-    if not connection:
+    try:
+        card_number = int(card_id)
+    except ValueError:
+        return jsonify({'error': 'Invalid card ID'}), 400
+    
+    snapshot = get_catalog()
+    if snapshot is None:
         return jsonify({'error': 'Database connection failed'}), 500
     
     try:
-        with connection.cursor() as cursor:
-            cursor.execute(
-                "SELECT tg_id as photo, name, rare as rarity, fame as points, shop FROM files WHERE id = %s", 
-                (int(card_id),)
-            )
-            row = cursor.fetchone()
-            
-            if not row:
-                return jsonify({'error': 'Card not found'}), 404
-            
-            hidden_categories = ['Scarface - Tony Montana']
-            if row['rarity'] in hidden_categories or row['name'] in HIDDEN_CARD_NAMES:
-                return jsonify({'error': 'Card not found'}), 404
-
-            # Get upload metadata
-            metadata = CardUploadMetadata.query.filter_by(card_id=int(card_id)).first()
-            
-            # Default values if no metadata
-            upload_date = None
-            season = 1
-            
-            if metadata:
-                upload_date = metadata.upload_date.isoformat() if metadata.upload_date else None
-                season = metadata.season if metadata.season else 1
+        # Hidden cards never make it into the snapshot
+        card = snapshot.get(card_number)
+        if not card:
+            return jsonify({'error': 'Card not found'}), 404
 
-            return jsonify({
-                'id': card_id,
-                'uuid': card_id,
-                'season_id': season,
-                'img': row['photo'],
-                'category': row['rarity'],
-                'name': row['name'],
-                'description': f"Points: {row['points']}",
-                'shop': row['shop'],
-                'upload_date': upload_date,
-                'season': season  # Make sure this is included
-            }), 200
+        return jsonify({
+            'id': card_id,
+            'uuid': card_id,
+            'season_id': card.season,
+            'img': card.photo,
+            'category': card.rarity,
+            'name': card.name,
+            'description': f"Points: {card.points}",
+            'shop': card.shop,
+            'upload_date': card.upload_date,
+            'season': card.season  # Make sure this is included
+        }), 200
             
-    except ValueError:
-        return jsonify({'error': 'Invalid card ID'}), 400
     except Exception as e:
-        logging.error(f"MySQL error: {str(e)}")
+        logging.error(f"Error fetching card info: {str(e)}")
         return jsonify({'error': 'Failed to fetch card info'}), 500
-    finally:
-        connection.close()
 
 
 @app.route("/api/season_info/<int:season_id>")  #yep
@@ -1137,6 +1105,93 @@ def debug_user_session():
     }), 200
 
 
+def fetch_user_row(cursor, user_id):
+    """users joined with botnet and states in a single round trip"""
+    cursor.execute("""
+        SELECT 
+            u.nickname,
+            u.fame_season,
+            u.fame_all,
+            u.cards,
+            u.pic,
+            u.user_id,
+            u.icons,
+            b.balance,
+            b.botnet_amount,
+            b.comp_points,
+            s.state_start
+        FROM users u
+        LEFT JOIN botnet b ON u.user_id = b.user_id
+        LEFT JOIN states s ON u.user_id = s.user_id
+        WHERE u.user_id = %s
+    """, (user_id,))
+    return cursor.fetchone()
+
+
+def days_since(state_start):
+    """Days since registration, 0 if the start date is missing or unparseable"""
+    if not state_start:
+        return 0
+    for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            start_date = datetime.strptime(str(state_start), date_format)
+            return (datetime.now() - start_date).days
+        except ValueError:
+            continue
+    return 0
+
+
+def build_user_stats(user_data, collection):
+    """Stats block shown on the profile page"""
+    stats = {
+        'season_points': user_data['fame_season'] or 0,
+        'all_time_points': user_data['fame_all'] or 0,
+        'balance': user_data['balance'] or 0,
+        'points_balance': user_data['fame_all'] or 0,  # Using fame_all as points balance
+        'attempts_remaining': user_data['botnet_amount'] or 0,
+        'cards_in_collection': collection.total_tokens,
+        'days_with_us': days_since(user_data['state_start']),
+        'nickname': user_data['nickname'],
+        'profile_pic': user_data['pic']
+    }
+    
+    # Format the response in the requested structure
+    return {
+        'stats': [
+            f"💠Points this season: {stats['season_points']}",
+            f"💠Points all time: {stats['all_time_points']}",
+            f"💸Balance: {stats['balance']}",
+            f"💠Points balance: {stats['points_balance']}",
+            f"📂Remaining attempts: {stats['attempts_remaining']}",
+            f"📂Cards in collection: {stats['cards_in_collection']}",
+            f"👀You are with us for {stats['days_with_us']} day(s)"
+        ],
+        'raw_data': stats
+    }
+
+
+def build_user_profile(user_data, collection):
+    """Detailed profile with collection statistics"""
+    return {
+        'user_id': user_data['user_id'],
+        'nickname': user_data['nickname'],
+        'profile_picture': user_data['pic'],
+        'icons': user_data['icons'],
+        'statistics': {
+            'season_points': user_data['fame_season'] or 0,
+            'all_time_points': user_data['fame_all'] or 0,
+            'balance': user_data['balance'] or 0,
+            'points_balance': user_data['fame_all'] or 0,
+            'attempts_remaining': user_data['botnet_amount'] or 0,
+            'competition_points': user_data['comp_points'] or 0,
+            'total_cards': collection.total_tokens,
+            'unique_cards': collection.unique_tokens,
+            'days_registered': days_since(user_data['state_start'])
+        },
+        'registration_date': user_data['state_start']
+    }
+
+
 @app.route("/api/user/stats")
 def get_user_stats():
     """Get comprehensive user statistics"""
@@ -1150,92 +1205,13 @@ def get_user_stats():
     
     try:
         with connection.cursor() as cursor:
-            # Get user basic info
-            cursor.execute("""
-                SELECT 
-                    nickname,
-                    fame_season,
-                    fame_all,
-                    cards,
-                    pic,
-                    user_id
-                FROM users 
-                WHERE user_id = %s
-            """, (user_id,))
-            
-            user_data = cursor.fetchone()
+            user_data = fetch_user_row(cursor, user_id)
             
             if not user_data:
                 return jsonify({'error': 'User not found'}), 404
             
-            # Get user balance from botnet table
-            cursor.execute("""
-                SELECT balance, botnet_amount
-                FROM botnet 
-                WHERE user_id = %s
-            """, (user_id,))
-            
-            botnet_data = cursor.fetchone()
-            
-            # Calculate days since registration
-            cursor.execute("""
-                SELECT state_start 
-                FROM states 
-                WHERE user_id = %s
-            """, (user_id,))
-            
-            state_data = cursor.fetchone()
-            
-            # Parse cards to count collection
-            cards_text = user_data['cards'] or ""
-            card_count = 0
-            if cards_text and cards_text != "?":
-                # Assuming cards are stored as comma-separated values
-                card_list = [card.strip() for card in cards_text.split(',') if card.strip()]
-                card_count = len(card_list)
-            
-            # Calculate days since registration
-            days_with_us = 0
-            if state_data and state_data['state_start']:
-                try:
-                    start_date = datetime.strptime(str(state_data['state_start']), '%Y-%m-%d %H:%M:%S')
-                    days_with_us = (datetime.now() - start_date).days
-                except ValueError:
-                    # Try alternative date format if needed
-                    try:
-                        start_date = datetime.strptime(str(state_data['state_start']), '%Y-%m-%d')
-                        days_with_us = (datetime.now() - start_date).days
-                    except ValueError:
-                        days_with_us = 0
-            
-            # Prepare response data
-            stats = {
-                'season_points': user_data['fame_season'] or 0,
-                'all_time_points': user_data['fame_all'] or 0,
-                'balance': botnet_data['balance'] if botnet_data else 0,
-                'points_balance': user_data['fame_all'] or 0,  # Using fame_all as points balance
-                'attempts_remaining': botnet_data['botnet_amount'] if botnet_data else 0,
-                'cards_in_collection': card_count,
-                'days_with_us': days_with_us,
-                'nickname': user_data['nickname'],
-                'profile_pic': user_data['pic']
-            }
-            
-            # Format the response in the requested structure
-            formatted_stats = {
-                'stats': [
-                    f"💠Points this season: {stats['season_points']}",
-                    f"💠Points all time: {stats['all_time_points']}",
-                    f"💸Balance: {stats['balance']}",
-                    f"💠Points balance: {stats['points_balance']}",
-                    f"📂Remaining attempts: {stats['attempts_remaining']}",
-                    f"📂Cards in collection: {stats['cards_in_collection']}",
-                    f"👀You are with us for {stats['days_with_us']} day(s)"
-                ],
-                'raw_data': stats
-            }
-            
-            return jsonify(formatted_stats), 200
+            collection = user_collections.get(user_id, user_data['cards'])
+            return jsonify(build_user_stats(user_data, collection)), 200
             
     except Exception as e:
         logging.error(f"Error fetching user stats: {str(e)}")
@@ -1257,75 +1233,13 @@ def get_user_profile():
     
     try:
         with connection.cursor() as cursor:
-            # Get comprehensive user data
-            cursor.execute("""
-                SELECT 
-                    u.nickname,
-                    u.fame_season,
-                    u.fame_all,
-                    u.cards,
-                    u.pic,
-                    u.user_id,
-                    u.icons,
-                    b.balance,
-                    b.botnet_amount,
-                    b.comp_points,
-                    s.state_start
-                FROM users u
-                LEFT JOIN botnet b ON u.user_id = b.user_id
-                LEFT JOIN states s ON u.user_id = s.user_id
-                WHERE u.user_id = %s
-            """, (user_id,))
-            
-            user_data = cursor.fetchone()
+            user_data = fetch_user_row(cursor, user_id)
             
             if not user_data:
                 return jsonify({'error': 'User not found'}), 404
             
-            # Calculate additional statistics
-            cards_text = user_data['cards'] or ""
-            card_count = 0
-            unique_cards = set()
-            
-            if cards_text and cards_text != "?":
-                card_list = [card.strip() for card in cards_text.split(',') if card.strip()]
-                card_count = len(card_list)
-                unique_cards = set(card_list)
-            
-            # Calculate days since registration
-            days_with_us = 0
-            if user_data['state_start']:
-                try:
-                    start_date = datetime.strptime(str(user_data['state_start']), '%Y-%m-%d %H:%M:%S')
-                    days_with_us = (datetime.now() - start_date).days
-                except ValueError:
-                    try:
-                        start_date = datetime.strptime(str(user_data['state_start']), '%Y-%m-%d')
-                        days_with_us = (datetime.now() - start_date).days
-                    except ValueError:
-                        days_with_us = 0
-            
-            # Prepare detailed profile
-            profile = {
-                'user_id': user_data['user_id'],
-                'nickname': user_data['nickname'],
-                'profile_picture': user_data['pic'],
-                'icons': user_data['icons'],
-                'statistics': {
-                    'season_points': user_data['fame_season'] or 0,
-                    'all_time_points': user_data['fame_all'] or 0,
-                    'balance': user_data['balance'] or 0,
-                    'points_balance': user_data['fame_all'] or 0,
-                    'attempts_remaining': user_data['botnet_amount'] or 0,
-                    'competition_points': user_data['comp_points'] or 0,
-                    'total_cards': card_count,
-                    'unique_cards': len(unique_cards),
-                    'days_registered': days_with_us
-                },
-                'registration_date': user_data['state_start']
-            }
-            
-            return jsonify(profile), 200
+            collection = user_collections.get(user_id, user_data['cards'])
+            return jsonify(build_user_profile(user_data, collection)), 200
             
     except Exception as e:
         logging.error(f"Error fetching user profile: {str(e)}")
@@ -1354,21 +1268,9 @@ def get_user_cards():
             if not user_data or not user_data['cards']:
                 return jsonify({'cardIds': []}), 200
             
-            # Parse comma-separated card IDs
-            cards_text = user_data['cards']
-            if cards_text and cards_text != "?":
-                card_ids = [card_id.strip() for card_id in cards_text.split(',') if card_id.strip()]
-                # Convert to integers and filter valid IDs
-                valid_card_ids = []
-                for card_id in card_ids:
-                    try:
-                        valid_card_ids.append(int(card_id))
-                    except ValueError:
-                        continue
-                
-                return jsonify({'cardIds': valid_card_ids}), 200
-            else:
-                return jsonify({'cardIds': []}), 200
+            # Valid card IDs in stored order, duplicates included
+            collection = user_collections.get(user_id, user_data['cards'])
+            return jsonify({'cardIds': collection.all_ids.tolist()}), 200
                 
     except Exception as e:
         logging.error(f"Error fetching user cards: {str(e)}")
@@ -1377,6 +1279,21 @@ def get_user_cards():
         connection.close()
 
 
+def build_user_categories(snapshot, collection):
+    """Categories with total and user card counts from one bitset intersection pass"""
+    user_counts = category_counts(collection.bits, snapshot.index)
+    return [
+        {
+            'id': category_id,
+            'name': name,
+            'type': category_type,
+            'totalCount': count,
+            'userCardCount': user_counts[category_id]
+        }
+        for category_id, name, category_type, count in snapshot.index.summary()
+    ]
+
+
 @app.route("/api/user/categories")
 def get_user_categories():
     """Get categories with user's card counts"""
@@ -1394,120 +1311,13 @@ def get_user_categories():
         cursor.execute("SELECT cards FROM users WHERE user_id = %s", (user_id,))
         user_data = cursor.fetchone()
         
-        user_card_ids = []
-        if user_data and user_data['cards'] and user_data['cards'] != "?":
-            cards_text = user_data['cards']
-            card_ids = [card_id.strip() for card_id in cards_text.split(',') if card_id.strip()]
-            for card_id in card_ids:
-                try:
-                    user_card_ids.append(int(card_id))
-                except ValueError:
-                    continue
-        
-        # Define hidden categories
-        hidden_categories = ['Scarface - Tony Montana']
-        
-        # Get all categories with counts
-        categories = []
-        
-        # All Cards category
-        cursor.execute("""
-            SELECT COUNT(*) as total 
-            FROM files 
-            WHERE rare NOT IN (%s)
-            AND name NOT IN (%s, %s, %s)
-        """, hidden_categories + HIDDEN_CARD_NAMES)
-        total_cards = cursor.fetchone()['total']
+        collection = user_collections.get(user_id, user_data['cards'] if user_data else None)
         
-        # Count user's cards in all categories
-        user_all_count = 0
-        if user_card_ids:
-            placeholders = ', '.join(['%s'] * len(user_card_ids))
-            cursor.execute(f"""
-                SELECT COUNT(*) as count 
-                FROM files 
-                WHERE id IN ({placeholders})
-                AND rare NOT IN (%s)
-                AND name NOT IN (%s, %s, %s)
-            """, user_card_ids + hidden_categories + HIDDEN_CARD_NAMES)
-            user_all_count = cursor.fetchone()['count']
-        
-        categories.append({
-            'id': 'all',
-            'name': 'All Cards',
-            'type': 'general',
-            'totalCount': total_cards,
-            'userCardCount': user_all_count
-        })
-        
-        # Shop category
-        cursor.execute("""
-            SELECT COUNT(*) as shop_count 
-            FROM files 
-            WHERE shop != '-' AND shop IS NOT NULL 
-            AND rare NOT IN (%s)
-            AND name NOT IN (%s, %s, %s)
-        """, hidden_categories + HIDDEN_CARD_NAMES)
-        shop_count = cursor.fetchone()['shop_count']
-        
-        # Count user's cards in shop
-        user_shop_count = 0
-        if user_card_ids:
-            placeholders = ', '.join(['%s'] * len(user_card_ids))
-            cursor.execute(f"""
-                SELECT COUNT(*) as count 
-                FROM files 
-                WHERE id IN ({placeholders})
-                AND shop != '-' AND shop IS NOT NULL
-                AND rare NOT IN (%s)
-                AND name NOT IN (%s, %s, %s)
-            """, user_card_ids + hidden_categories + HIDDEN_CARD_NAMES)
-            user_shop_count = cursor.fetchone()['count']
-        
-        categories.append({
-            'id': 'shop',
-            'name': 'Available at Shop',
-            'type': 'shop',
-            'totalCount': shop_count,
-            'userCardCount': user_shop_count
-        })
+        snapshot = get_catalog()
+        if snapshot is None:
+            return jsonify({'error': 'Database connection failed'}), 500
         
-        # Rarity categories
-        cursor.execute("""
-            SELECT rare, COUNT(*) as count 
-            FROM files 
-            WHERE rare NOT IN (%s)
-            AND name NOT IN (%s, %s, %s)
-            GROUP BY rare 
-            ORDER BY count DESC
-        """, hidden_categories + HIDDEN_CARD_NAMES)
-        rarities_data = cursor.fetchall()
-        
-        for rarity_data in rarities_data:
-            rarity_name = rarity_data['rare']
-            
-            # Count user's cards in this rarity
-            user_rarity_count = 0
-            if user_card_ids:
-                placeholders = ', '.join(['%s'] * len(user_card_ids))
-                cursor.execute(f"""
-                    SELECT COUNT(*) as count 
-                    FROM files 
-                    WHERE id IN ({placeholders})
-                    AND rare = %s
-                    AND name NOT IN (%s, %s, %s)
-                """, user_card_ids + [rarity_name] + HIDDEN_CARD_NAMES)
-                user_rarity_count = cursor.fetchone()['count']
-            
-            categories.append({
-                'id': f"rarity_{rarity_name}",
-                'name': rarity_name,
-                'type': 'rarity',
-                'totalCount': rarity_data['count'],
-                'userCardCount': user_rarity_count
-            })
-        
-        return jsonify({'categories': categories}), 200
+        return jsonify({'categories': build_user_categories(snapshot, collection)}), 200
         
     except Exception as e:
         logging.error(f"Error fetching user categories: {str(e)}")
@@ -1516,6 +1326,66 @@ def get_user_categories():
         connection.close()
 
 
+DASHBOARD_FIELDS = ('stats', 'profile', 'cards', 'categories')
+
+
+@app.route("/api/user/dashboard")
+def get_user_dashboard():
+    """Stats, profile, card ids and categories for the profile page in one request.
+
+    Pass ?fields=stats,cards to get only the listed sections.
+    """
+    is_auth, user_id = is_authenticated(request, session)
+    if not is_auth:
+        return jsonify({'error': 'Authentication required'}), 401
+    
+    requested = request.args.get('fields')
+    if requested:
+        fields = [field.strip() for field in requested.split(',') if field.strip()]
+        unknown = [field for field in fields if field not in DASHBOARD_FIELDS]
+        if unknown:
+            return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+    else:
+        fields = list(DASHBOARD_FIELDS)
+    
+    connection = get_db_conn()
+    if not connection:
+        return jsonify({'error': 'Database connection failed'}), 500
+    
+    try:
+        with connection.cursor() as cursor:
+            user_data = fetch_user_row(cursor, user_id)
+    except Exception as e:
+        logging.error(f"Error fetching user dashboard: {str(e)}")
+        return jsonify({'error': 'Failed to fetch user dashboard'}), 500
+    finally:
+        connection.close()
+    
+    if not user_data:
+        return jsonify({'error': 'User not found'}), 404
+    
+    try:
+        collection = user_collections.get(user_id, user_data['cards'])
+        dashboard = {}
+        if 'stats' in fields:
+            dashboard['stats'] = build_user_stats(user_data, collection)
+        if 'profile' in fields:
+            dashboard['profile'] = build_user_profile(user_data, collection)
+        if 'cards' in fields:
+            dashboard['cards'] = {'cardIds': collection.all_ids.tolist()}
+        if 'categories' in fields:
+            snapshot = get_catalog()
+            if snapshot is None:
+                return jsonify({'error': 'Database connection failed'}), 500
+            dashboard['categories'] = build_user_categories(snapshot, collection)
+        
+        return jsonify(dashboard), 200
+        
+    except Exception as e:
+        logging.error(f"Error building user dashboard: {str(e)}")
+        return jsonify({'error': 'Failed to fetch user dashboard'}), 500
+
+
 @app.route("/api/user/cards/by-category/<category_id>")
 def get_user_cards_by_category(category_id):
     """Get user's cards filtered by category"""
@@ -1533,115 +1403,25 @@ def get_user_cards_by_category(category_id):
         cursor.execute("SELECT cards FROM users WHERE user_id = %s", (user_id,))
         user_data = cursor.fetchone()
         
-        user_card_ids = []
-        if user_data and user_data['cards'] and user_data['cards'] != "?":
-            cards_text = user_data['cards']
-            card_ids = [card_id.strip() for card_id in cards_text.split(',') if card_id.strip()]
-            for card_id in card_ids:
-                try:
-                    user_card_ids.append(int(card_id))
-                except ValueError:
-                    continue
+        collection = user_collections.get(user_id, user_data['cards'] if user_data else None)
         
         # If user has no cards, return empty
-        if not user_card_ids:
-            return jsonify({'cards': [], 'total_count': 0, 'category_id': category_id, 'user_cards': True})
-        
-        sort_field = request.args.get('sort', 'id')
-        sort_direction = request.args.get('direction', 'desc')
-        
-        # Define valid MySQL columns to prevent SQL injection
-        valid_mysql_columns = ['id', 'name', 'rare', 'fame']
+        if not collection.card_ids:
+            return jsonify({'cards': [], 'total_count': 0, 'category_id': category_id, 'next_cursor': None, 'user_cards': True})
         
-        if sort_field not in valid_mysql_columns:
-            sort_field = 'id'
+        snapshot = get_catalog()
+        if snapshot is None:
+            return jsonify({'error': 'Database connection failed'}), 500
         
-        # Define hidden categories to exclude
-        hidden_categories = ['Scarface - Tony Montana']
-        
-        placeholders = ', '.join(['%s'] * len(user_card_ids))
-        
-        with connection.cursor() as cursor:
-            # Handle different category types, but only return user's cards
-            if category_id == 'all':
-                query = f"""
-                    SELECT id, tg_id as photo, name, rare as rarity, fame as points 
-                    FROM files 
-                    WHERE id IN ({placeholders})
-                    AND rare NOT IN (%s)
-                    AND name NOT IN (%s, %s, %s)
-                    ORDER BY {sort_field} {sort_direction}
-                """
-                cursor.execute(query, user_card_ids + hidden_categories + HIDDEN_CARD_NAMES)
-                
-            elif category_id == 'shop':
-                query = f"""
-                    SELECT id, tg_id as photo, name, rare as rarity, fame as points 
-                    FROM files 
-                    WHERE id IN ({placeholders})
-                    AND shop != '-' AND shop IS NOT NULL
-                    AND rare NOT IN (%s)
-                    AND name NOT IN (%s, %s, %s)
-                    ORDER BY {sort_field} {sort_direction}
-                """
-                cursor.execute(query, user_card_ids + hidden_categories + HIDDEN_CARD_NAMES)
-                
-            elif category_id.startswith('rarity_'):
-                rarity_name = category_id.replace('rarity_', '')
-                import urllib.parse
-                rarity_name = urllib.parse.unquote(rarity_name)
-                
-                query = f"""
-                    SELECT id, tg_id as photo, name, rare as rarity, fame as points 
-                    FROM files 
-                    WHERE id IN ({placeholders})
-                    AND rare = %s
-                    AND name NOT IN (%s, %s, %s)
-                    ORDER BY {sort_field} {sort_direction}
-                """
-                cursor.execute(query, user_card_ids + [rarity_name] + HIDDEN_CARD_NAMES)
-                
-            else:
-                return jsonify({'error': 'Invalid category ID'}), 400
-            
-            cards = [dict(row) for row in cursor.fetchall()]
-            
-            # Transform to match frontend expectations and add upload metadata
-            transformed_cards = []
-            for card in cards:
-                metadata = CardUploadMetadata.query.filter_by(card_id=card['id']).first()
-                
-                upload_date = None
-                season = 1
-                
-                if metadata:
-                    upload_date = metadata.upload_date.isoformat() if metadata.upload_date else None
-                    season = metadata.season if metadata.season else 1
-                
-                transformed_card = {
-                    'id': card['id'],
-                    'uuid': card['id'],
-                    'img': card['photo'],
-                    'name': card['name'],
-                    'rarity': card['rarity'],
-                    'category': card['rarity'],
-                    'points': card['points'],
-                    'upload_date': upload_date,
-                    'season': season
-                }
-                transformed_cards.append(transformed_card)
-            
-            # Apply season sorting in Python if requested
-            if request.args.get('sort') == 'season':
-                transformed_cards.sort(key=lambda x: x.get('season', 1), 
-                                     reverse=(sort_direction == 'desc'))
-            
-            return jsonify({
-                'cards': transformed_cards,
-                'total_count': len(transformed_cards),
-                'category_id': category_id,
-                'user_cards': True  # Flag to indicate these are user's cards
-            }), 200
+        # Walk the category in display order, keeping only the user's cards
+        payload, status = list_category_cards(
+            snapshot, category_id,
+            owned=collection.id_set,
+            total_count=lambda resolved_id: popcount(collection.bits & snapshot.index.bitset(resolved_id))
+        )
+        if status == 200:
+            payload['user_cards'] = True  # Flag to indicate these are user's cards
+        return jsonify(payload), status
             
     except Exception as e:
         logging.error(f"Error fetching user cards by category: {str(e)}")
@@ -1665,7 +1445,7 @@ def proxy_avatar():
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
         
-        response = requests.get(url, stream=True, headers=headers, timeout=10)
+        response = bot_api.get(url, stream=True, headers=headers, timeout=10)
         response.raise_for_status()
         
         # Create response with proper headers
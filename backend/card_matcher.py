@@ -0,0 +1,438 @@
+import logging
+import multiprocessing
+import random
+import re
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from fuzzywuzzy import fuzz
+except ImportError:
+    fuzz = None
+
+try:
+    import Levenshtein
+except ImportError:  # python-Levenshtein is optional for fuzzywuzzy
+    Levenshtein = None
+
+try:
+    # Installed along with python-Levenshtein, whose C code it provides since 0.21
+    from rapidfuzz import fuzz as rapidfuzz_fuzz
+except ImportError:
+    rapidfuzz_fuzz = None
+
+
+FUZZY_THRESHOLD = 70  # A fuzzy match needs a score above this
+WORD_OVERLAP_SCORE = 80  # Score given when most of the card's words appear in the message
+
+COMMON_PREFIXES = ['card:', 'card -', 'new card:', 'card name:', 'name:']
+
+# Bump whenever the normalization or pattern rules below change, so that
+# persisted CardPatterns and MessageForms get recomputed
+NORMALIZATION_VERSION = 1
+
+# Lowercased exact search patterns and the fuzzy-normalized name of a card
+CardPatterns = namedtuple('CardPatterns', ['exact', 'fuzzy'])
+# Lowercased text, its whitespace-separated words and the fuzzy-normalized text of a message
+MessageForms = namedtuple('MessageForms', ['lower', 'words', 'fuzzy'])
+
+
+def normalize_for_exact_match(text):
+    """Lowercase and collapse whitespace, keeping punctuation (card names may contain it)"""
+    if not text:
+        return ""
+    return re.sub(r'\s+', ' ', text.lower()).strip()
+
+
+def normalize_for_fuzzy_match(text):
+    """Lowercase, drop punctuation and collapse whitespace"""
+    if not text:
+        return ""
+    normalized = re.sub(r'[^\w\s]', '', text.lower())
+    return re.sub(r'\s+', ' ', normalized).strip()
+
+
+def create_exact_search_patterns(card_name):
+    """The card name as stored, normalized, and both again without parenthesized parts"""
+    patterns = [card_name, normalize_for_exact_match(card_name)]
+
+    without_parentheses = re.sub(r'\([^)]*\)', '', card_name).strip()
+    if without_parentheses and without_parentheses != card_name:
+        patterns.append(without_parentheses)
+        patterns.append(normalize_for_exact_match(without_parentheses))
+
+    # Remove duplicates and patterns too short to be meaningful
+    patterns = [p for p in patterns if p and len(p) > 2]
+    return list(dict.fromkeys(patterns))
+
+
+def card_patterns(card_name):
+    """Everything matching needs to know about a card name"""
+    if not card_name:
+        return CardPatterns([], "")
+    exact = [pattern.lower() for pattern in create_exact_search_patterns(card_name)]
+    return CardPatterns(list(dict.fromkeys(exact)), normalize_for_fuzzy_match(card_name))
+
+
+def message_forms(text):
+    """Everything matching needs to know about a message text"""
+    lower = text.lower()
+    return MessageForms(lower, frozenset(lower.split()), normalize_for_fuzzy_match(text))
+
+
+def is_exact_match(pattern_lower, message_lower, message_words):
+    """Whether a lowercased pattern occurs in a lowercased message as a card name would"""
+    if pattern_lower in message_lower:
+        words_in_pattern = set(pattern_lower.split())
+        if len(words_in_pattern) > 1:
+            # Require most of the pattern's words to appear as whole words
+            common_words = words_in_pattern.intersection(message_words)
+            if len(common_words) >= max(2, len(words_in_pattern) * 0.6):
+                return True
+        elif re.search(r'\b' + re.escape(pattern_lower) + r'\b', message_lower):
+            return True
+
+    # Card name after a common prefix, at the start of the message or quoted
+    for prefix in COMMON_PREFIXES:
+        if f"{prefix} {pattern_lower}" in message_lower or f"{prefix}{pattern_lower}" in message_lower:
+            return True
+    if message_lower.startswith(pattern_lower):
+        return True
+    return f"\"{pattern_lower}\"" in message_lower or f"'{pattern_lower}'" in message_lower
+
+
+def name_score(normalized_card_name, message):
+    """partial_ratio of a fuzzy-normalized card name against a message's text, 0 without fuzzy matching"""
+    if not message.text:
+        return 0
+    forms = getattr(message, 'forms', None)
+    text = forms.fuzzy if forms else normalize_for_fuzzy_match(message.text)
+    if rapidfuzz_fuzz is not None:
+        return rapidfuzz_fuzz.partial_ratio(normalized_card_name, text)
+    if fuzz is not None:
+        return fuzz.partial_ratio(normalized_card_name, text)
+    return 0
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _round(value):
+    # fuzzywuzzy's utils.intr
+    return int(round(value))
+
+
+def _partial_ratio(s1, s2):
+    """fuzz.partial_ratio() as computed with python-Levenshtein, without its per-window objects
+
+    Same blocks, windows and rounding; windows starting at the same offset
+    are only scored once.
+    """
+    if s1 == s2:
+        return 100
+    if not s1 or not s2:
+        return 0
+    shorter, longer = (s1, s2) if len(s1) <= len(s2) else (s2, s1)
+    best = 0.0
+    scored = set()
+    for block in Levenshtein.matching_blocks(Levenshtein.opcodes(shorter, longer), shorter, longer):
+        start = max(0, block[1] - block[0])
+        if start in scored:
+            continue
+        scored.add(start)
+        ratio = Levenshtein.ratio(shorter, longer[start:start + len(shorter)])
+        if ratio > .995:
+            return 100
+        best = max(best, ratio)
+    return _round(100 * best)
+
+
+IndexedMessage = namedtuple('IndexedMessage', ['message', 'lower', 'words', 'fuzzy'])
+
+
+class FuzzyCorpus:
+    """Fuzzy-normalized message texts and their word index, scored against card names.
+
+    Holds only strings, so it can be rebuilt in worker processes from `texts`.
+    """
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.word_index = {}  # word -> list of text positions
+        for position, text in enumerate(texts):
+            for word in set(text.split()):
+                self.word_index.setdefault(word, []).append(position)
+        self.stats = {'fuzzy_scored': 0, 'fuzzy_skipped': 0}
+
+    def best_match(self, normalized_card_name):
+        """(position, score) of the first text with the highest score above FUZZY_THRESHOLD, (None, 0) if none"""
+        # fuzzywuzzy scores with python-Levenshtein when it is installed, and so does _partial_ratio()
+        partial_ratio = fuzz.partial_ratio if Levenshtein is None else _partial_ratio
+
+        words_in_card = set(normalized_card_name.split())
+        required_words = max(2, len(words_in_card) * 0.5)
+        common_words = Counter()
+        for word in words_in_card:
+            for position in self.word_index.get(word, ()):
+                common_words[position] += 1
+
+        best_position = None
+        best_score = 0
+        for position, text in enumerate(self.texts):
+            threshold = max(best_score, FUZZY_THRESHOLD)
+            boosted = common_words[position] >= required_words
+            if not (boosted and WORD_OVERLAP_SCORE > threshold):
+                # rapidfuzz aligns the card against every window of the message, a
+                # superset of the windows fuzzywuzzy tries, so its score is an upper bound
+                if rapidfuzz_fuzz is not None:
+                    bound = rapidfuzz_fuzz.partial_ratio(normalized_card_name, text, score_cutoff=threshold)
+                    if bound < threshold:
+                        self.stats['fuzzy_skipped'] += 1
+                        continue
+
+            self.stats['fuzzy_scored'] += 1
+            score = partial_ratio(normalized_card_name, text)
+            if boosted:
+                score = max(score, WORD_OVERLAP_SCORE)
+            if score > best_score and score > FUZZY_THRESHOLD:
+                best_score = score
+                best_position = position
+        return best_position, best_score
+
+
+# Corpus of a fuzzy-matching worker process, set up once by _init_fuzzy_worker()
+_worker_corpus = None
+
+
+def _init_fuzzy_worker(texts):
+    global _worker_corpus
+    _worker_corpus = FuzzyCorpus(texts)
+
+
+def _fuzzy_chunk(normalized_card_names):
+    return [_worker_corpus.best_match(name) for name in normalized_card_names]
+
+
+class CardMatcher:
+    """Finds the channel message announcing a card, for many cards against one batch of messages.
+
+    Every message is normalized once up front (or not at all when it carries
+    precomputed MessageForms as `forms`, like archived messages do); cards
+    can likewise be passed as precomputed CardPatterns. The exact stage looks up
+    candidate messages in a trigram index (any exact match contains the
+    pattern as a substring) and only verifies those. The fuzzy stage counts
+    shared words through an inverted word index and only scores messages for
+    which rapidfuzz's (faster, never lower) partial_ratio can beat the best
+    score so far. Results are identical to checking every message:
+    the newest matching message for the exact stage, the first message with
+    the highest score above FUZZY_THRESHOLD for the fuzzy stage.
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.entries = []
+        self.trigram_index = {}  # trigram of the lowercased text -> set of entry positions
+
+        for message in messages:
+            if not message.text:
+                continue
+            position = len(self.entries)
+            forms = getattr(message, 'forms', None) or message_forms(message.text)
+            self.entries.append(IndexedMessage(message, *forms))
+            for trigram in trigrams(forms.lower):
+                self.trigram_index.setdefault(trigram, set()).add(position)
+
+        self.fuzzy_corpus = FuzzyCorpus([entry.fuzzy for entry in self.entries])
+        self.stats = {'exact_candidates': 0}
+
+    def _substring_candidates(self, pattern_lower):
+        """Positions of messages that may contain pattern_lower, in message order"""
+        if len(pattern_lower) < 3:
+            return range(len(self.entries))
+        postings = []
+        for trigram in trigrams(pattern_lower):
+            posting = self.trigram_index.get(trigram)
+            if not posting:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates &= posting
+            if not candidates:
+                return []
+        return sorted(candidates)
+
+    def exact_match(self, card_name, patterns=None):
+        """Newest message that names the card exactly (ties go to the earlier message in the batch)"""
+        if not card_name:
+            return None
+
+        matched = set()
+        for pattern_lower in (patterns or card_patterns(card_name)).exact:
+            for position in self._substring_candidates(pattern_lower):
+                if position in matched:
+                    continue
+                self.stats['exact_candidates'] += 1
+                entry = self.entries[position]
+                if is_exact_match(pattern_lower, entry.lower, entry.words):
+                    matched.add(position)
+
+        best = None
+        for position in sorted(matched):
+            message = self.entries[position].message
+            if best is None or message.date > best.date:
+                best = message
+        return best
+
+    def fuzzy_match(self, card_name, patterns=None):
+        """(message, score) of the best fuzzy match, (None, 0) if nothing scores above FUZZY_THRESHOLD"""
+        return self.fuzzy_match_many([card_name], patterns=None if patterns is None else [patterns])[0]
+
+    def fuzzy_match_many(self, card_names, max_workers=1, chunk_size=50, patterns=None):
+        """fuzzy_match() for each card name (with its CardPatterns, if given), in order.
+
+        With max_workers > 1 the cards are scored in chunks on a process pool,
+        each worker holding its own copy of the normalized messages; every
+        card is scored independently, so the results equal the serial ones.
+        """
+        if fuzz is None:
+            logging.warning("fuzzywuzzy not installed, skipping fuzzy matching")
+            return [(None, 0)] * len(card_names)
+
+        if patterns is None:
+            normalized_names = [normalize_for_fuzzy_match(card_name) for card_name in card_names]
+        else:
+            normalized_names = [card.fuzzy for card in patterns]
+
+        if max_workers <= 1 or len(card_names) <= chunk_size:
+            results = [self.fuzzy_corpus.best_match(name) for name in normalized_names]
+        else:
+            chunks = [normalized_names[i:i + chunk_size] for i in range(0, len(normalized_names), chunk_size)]
+            # spawn rather than fork: the sync also runs inside threaded/gevent web workers
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(chunks)),
+                                     mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_fuzzy_worker,
+                                     initargs=(self.fuzzy_corpus.texts,)) as pool:
+                results = [result for chunk in pool.map(_fuzzy_chunk, chunks) for result in chunk]
+
+        matches = []
+        for card_name, (position, score) in zip(card_names, results):
+            if position is None:
+                matches.append((None, 0))
+                continue
+            logging.info(f"Fuzzy match: '{card_name}' with score {score}")
+            matches.append((self.entries[position].message, score))
+        return matches
+
+
+def _scan_exact_match(card_name, messages):
+    """Reference implementation: check every pattern against every message"""
+    matching = []
+    for message in messages:
+        if not message.text:
+            continue
+        lower = message.text.lower()
+        for pattern in create_exact_search_patterns(card_name):
+            if is_exact_match(pattern.lower(), lower, set(lower.split())):
+                matching.append(message)
+                break
+    matching.sort(key=lambda message: message.date, reverse=True)
+    return matching[0] if matching else None
+
+
+def _scan_fuzzy_match(card_name, messages):
+    """Reference implementation: score every message"""
+    best_match, best_score = None, 0
+    normalized_card_name = normalize_for_fuzzy_match(card_name)
+    for message in messages:
+        if not message.text:
+            continue
+        normalized_message = normalize_for_fuzzy_match(message.text)
+        score = fuzz.partial_ratio(normalized_card_name, normalized_message)
+        words_in_card = set(normalized_card_name.split())
+        if len(words_in_card & set(normalized_message.split())) >= max(2, len(words_in_card) * 0.5):
+            score = max(score, WORD_OVERLAP_SCORE)
+        if score > best_score and score > FUZZY_THRESHOLD:
+            best_score, best_match = score, message
+    return best_match
+
+
+def _benchmark(card_count=3000, message_count=2000, checked_cards=150, workers=None):
+    """Index vs. full scan on a synthetic channel; the scan is timed on a sample and extrapolated.
+
+    The fuzzy stage is also run on a process pool of `workers` (default: CPU count) and compared.
+    """
+    from datetime import datetime, timedelta
+
+    rng = random.Random(7)
+    Message = namedtuple('Message', ['id', 'text', 'date'])
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+                  for _ in range(5000)]
+
+    def word():
+        return rng.choice(vocabulary)
+
+    card_names = list(dict.fromkeys(
+        ' '.join(word() for _ in range(rng.randint(1, 3))) + (f" ({word()})" if rng.random() < 0.2 else '')
+        for _ in range(card_count)
+    ))
+    start = datetime(2025, 1, 1)
+    messages = []
+    for message_id in range(message_count):
+        text = ' '.join(word() for _ in range(rng.randint(8, 40)))
+        if rng.random() < 0.7:
+            name = rng.choice(card_names)
+            if rng.random() < 0.2:
+                name = name.replace(name[len(name) // 2], '', 1)  # Typo for the fuzzy stage
+            text = rng.choice(["New card: ", "", "Карточка "]) + name + "\n" + text
+        messages.append(Message(message_id, text if rng.random() > 0.05 else None,
+                                start + timedelta(hours=rng.randint(0, 5000))))
+
+    started = time.perf_counter()
+    matcher = CardMatcher(messages)
+    build_time = time.perf_counter() - started
+
+    def match_all(names, exact, fuzzy):
+        results = []
+        for name in names:
+            match = exact(name)
+            if match is None and fuzz is not None:
+                match = fuzzy(name)
+            results.append(match)
+        return results
+
+    started = time.perf_counter()
+    indexed = match_all(card_names, matcher.exact_match, lambda name: matcher.fuzzy_match(name)[0])
+    indexed_time = time.perf_counter() - started
+
+    sample = card_names[:checked_cards]
+    started = time.perf_counter()
+    scanned = match_all(sample, lambda name: _scan_exact_match(name, messages),
+                        lambda name: _scan_fuzzy_match(name, messages))
+    scan_time = (time.perf_counter() - started) * len(card_names) / len(sample)
+    assert scanned == indexed[:checked_cards], "indexed matcher disagrees with the full scan"
+
+    workers = workers or multiprocessing.cpu_count()
+    fuzzy_names = [name for name in card_names if matcher.exact_match(name) is None]
+    started = time.perf_counter()
+    serial = matcher.fuzzy_match_many(fuzzy_names)
+    serial_time = time.perf_counter() - started
+    started = time.perf_counter()
+    parallel = matcher.fuzzy_match_many(fuzzy_names, max_workers=max(workers, 2))
+    parallel_time = time.perf_counter() - started
+    assert parallel == serial, "parallel fuzzy matching disagrees with the serial path"
+
+    print(f"{len(card_names)} cards x {len(messages)} messages")
+    print(f"index build          {build_time:8.3f} s")
+    print(f"indexed matching     {indexed_time:8.3f} s")
+    print(f"full scan (est.)     {scan_time:8.3f} s")
+    print(f"fuzzy stage, serial  {serial_time:8.3f} s ({len(fuzzy_names)} cards)")
+    print(f"fuzzy stage, {max(workers, 2)} proc {parallel_time:8.3f} s")
+    print(f"stats                {dict(matcher.stats, **matcher.fuzzy_corpus.stats)}")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,466 @@
+import base64
+import json
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from urllib.parse import unquote
+
+from user_collections import ids_to_bitset
+
+
+# One row of the `files` table merged with its CardUploadMetadata
+CatalogCard = namedtuple('CatalogCard', [
+    'id', 'photo', 'name', 'rarity', 'points', 'shop', 'in_shop', 'upload_date', 'season'
+])
+
+SORTABLE_FIELDS = ('id', 'name', 'rare', 'fame', 'season')
+
+# Keys of present_card(), selectable with ?fields=
+CARD_FIELDS = ('id', 'uuid', 'img', 'name', 'rarity', 'category', 'points', 'upload_date', 'season')
+
+
+def card_sort_key(sort_field):
+    """Key function emulating the old MySQL ORDER BY for an in-memory sort"""
+    if sort_field == 'name':
+        # utf8mb4_general_ci compares case-insensitively
+        return lambda card: ((card.name or '').casefold(), card.id)
+    if sort_field == 'rare':
+        return lambda card: ((card.rarity or '').casefold(), card.id)
+    if sort_field == 'fame':
+        # NULLs sort first in ascending order, like MySQL
+        return lambda card: (card.points is not None, card.points or 0, card.id)
+    if sort_field == 'season':
+        return lambda card: (card.season, card.id)
+    return lambda card: (card.id, card.id)
+
+
+def normalize_sort(sort_field, direction):
+    """Fall back to id / descending for unknown sort parameters"""
+    if sort_field not in SORTABLE_FIELDS:
+        sort_field = 'id'
+    return sort_field, ('asc' if direction == 'asc' else 'desc')
+
+
+def encode_cursor(sort_field, direction, key):
+    """Opaque keyset cursor: the sort key of the last card on a page"""
+    raw = json.dumps([sort_field, direction, list(key)], ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort_field, direction):
+    """Sort key stored in a cursor; ValueError if it is malformed or for another ordering"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_field, cursor_direction, key = json.loads(raw.decode())
+    except Exception:
+        raise ValueError("Malformed cursor")
+    if (cursor_field, cursor_direction) != (sort_field, direction) or not isinstance(key, list):
+        raise ValueError("Cursor belongs to a different sort order")
+    return tuple(key)
+
+
+def _position_after(keys, after, descending):
+    """Index of the first key that comes after `after` in display order"""
+    lo, hi = 0, len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if (keys[mid] >= after) if descending else (keys[mid] <= after):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def present_card(card):
+    """Card dict in the shape the frontend listings expect"""
+    return {
+        'id': card.id,
+        'uuid': card.id,
+        'img': card.photo,
+        'name': card.name,
+        'rarity': card.rarity,
+        'category': card.rarity,
+        'points': card.points,
+        'upload_date': card.upload_date,
+        'season': card.season
+    }
+
+
+class CategoryIndex:
+    """Sorted card id arrays for the 'all', 'shop' and 'rarity_<name>' categories.
+
+    Built once per catalog version. When a refresh only adds cards, the
+    previous index is extended with the new ids instead of being rebuilt.
+    """
+
+    def __init__(self, ids_by_category, rarities):
+        self.ids_by_category = ids_by_category  # {category_id: array of ascending card ids}
+        self.rarities = rarities  # {category_id: rarity name}
+        self._summary = None
+        self._bitsets = {}
+
+    @classmethod
+    def build(cls, cards):
+        index = cls({'all': array('l'), 'shop': array('l')}, {})
+        index._add(sorted(cards, key=lambda card: card.id))
+        return index
+
+    def extended(self, new_cards):
+        """New index with `new_cards` added; this one stays untouched for current readers"""
+        index = CategoryIndex(
+            {category_id: array('l', ids) for category_id, ids in self.ids_by_category.items()},
+            dict(self.rarities)
+        )
+        index._add(sorted(new_cards, key=lambda card: card.id))
+        return index
+
+    def _add(self, cards):
+        for card in cards:
+            targets = [self.ids_by_category['all']]
+            if card.in_shop:
+                targets.append(self.ids_by_category['shop'])
+            rarity_id = f"rarity_{card.rarity}"
+            if rarity_id not in self.ids_by_category:
+                self.ids_by_category[rarity_id] = array('l')
+                self.rarities[rarity_id] = card.rarity
+            targets.append(self.ids_by_category[rarity_id])
+            for ids in targets:
+                if not ids or ids[-1] < card.id:
+                    ids.append(card.id)
+                else:
+                    ids.insert(bisect_left(ids, card.id), card.id)
+
+    def resolve(self, category_id):
+        """Normalise a category id from a URL, None if it is not a known category"""
+        if category_id in self.ids_by_category:
+            return category_id
+        if category_id.startswith('rarity_'):
+            unquoted = f"rarity_{unquote(category_id[len('rarity_'):])}"
+            if unquoted in self.ids_by_category:
+                return unquoted
+        return None
+
+    def ids(self, category_id):
+        return self.ids_by_category.get(category_id)
+
+    def bitset(self, category_id):
+        """Category membership as an int bitset (bit N set for card N), built on first use"""
+        bits = self._bitsets.get(category_id)
+        if bits is None:
+            bits = ids_to_bitset(self.ids_by_category.get(category_id, ()))
+            self._bitsets[category_id] = bits
+        return bits
+
+    def count(self, category_id):
+        ids = self.ids_by_category.get(category_id)
+        return len(ids) if ids is not None else 0
+
+    def newest_id(self, category_id):
+        ids = self.ids_by_category.get(category_id)
+        return ids[-1] if ids else None
+
+    def rarity_ids(self):
+        """Rarity category ids ordered by card count, largest first"""
+        return sorted(self.rarities, key=lambda category_id: -len(self.ids_by_category[category_id]))
+
+    def summary(self):
+        """[(category_id, name, type, count)] in display order, computed once per index"""
+        if self._summary is None:
+            summary = [
+                ('all', 'All Cards', 'general', self.count('all')),
+                ('shop', 'Available at Shop', 'shop', self.count('shop')),
+            ]
+            for category_id in self.rarity_ids():
+                summary.append((category_id, self.rarities[category_id], 'rarity', self.count(category_id)))
+            self._summary = summary
+        return self._summary
+
+
+class CatalogSnapshot:
+    """Immutable in-memory copy of the visible card catalog"""
+
+    def __init__(self, by_id, index, version, max_id, row_count, metadata_state=None):
+        self.by_id = by_id
+        self.index = index
+        self.version = version
+        # Raw `files` table probe values this snapshot was built from
+        self.max_id = max_id
+        self.row_count = row_count
+        self.metadata_state = metadata_state  # metadata_probe() result this snapshot was built from
+        self.loaded_at = time.time()
+        self._sorted = {}
+
+    @classmethod
+    def build(cls, cards, version, max_id, row_count, metadata_state=None):
+        return cls({card.id: card for card in cards}, CategoryIndex.build(cards), version, max_id, row_count,
+                   metadata_state)
+
+    def extended(self, new_cards, version, max_id, row_count):
+        """Snapshot with `new_cards` added, reusing this snapshot's index"""
+        by_id = dict(self.by_id)
+        by_id.update((card.id, card) for card in new_cards)
+        snapshot = CatalogSnapshot(by_id, self.index.extended(new_cards), version, max_id, row_count,
+                                   self.metadata_state)
+        snapshot.loaded_at = self.loaded_at  # Still due for a full reload on schedule
+        return snapshot
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def get(self, card_id):
+        return self.by_id.get(card_id)
+
+    def newest_card(self, category_id):
+        newest_id = self.index.newest_id(category_id)
+        return self.by_id[newest_id] if newest_id is not None else None
+
+    def ordering(self, category_id, sort_field='id', direction='desc'):
+        """(ids, sort keys) of a category in display order, None if the category is unknown.
+
+        Orders are memoised per snapshot, so repeated listings are pure lookups.
+        """
+        category_id = self.index.resolve(category_id)
+        if category_id is None:
+            return None
+        sort_field, direction = normalize_sort(sort_field, direction)
+        memo_key = (category_id, sort_field, direction)
+        ordering = self._sorted.get(memo_key)
+        if ordering is None:
+            key_of = card_sort_key(sort_field)
+            cards = sorted(
+                (self.by_id[card_id] for card_id in self.index.ids(category_id)),
+                key=key_of, reverse=(direction == 'desc')
+            )
+            ordering = (array('l', (card.id for card in cards)), [key_of(card) for card in cards])
+            self._sorted[memo_key] = ordering
+        return ordering
+
+    def sorted_ids(self, category_id, sort_field='id', direction='desc'):
+        ordering = self.ordering(category_id, sort_field, direction)
+        return ordering[0] if ordering is not None else None
+
+    def page(self, category_id, sort_field='id', direction='desc', after=None, limit=None, owned=None):
+        """One keyset page of a category: (cards, key of the last card or None on the last page).
+
+        `after` is the sort key from the previous page's cursor and `owned`
+        optionally restricts the listing to a set of card ids. Returns None
+        for an unknown category.
+        """
+        ordering = self.ordering(category_id, sort_field, direction)
+        if ordering is None:
+            return None
+        ids, keys = ordering
+        _, direction = normalize_sort(sort_field, direction)
+        position = _position_after(keys, after, direction == 'desc') if after is not None else 0
+
+        cards = []
+        next_key = None
+        last_key = after  # Key of the last card taken (limit=0 pages resume where they started)
+        for index in range(position, len(ids)):
+            card_id = ids[index]
+            if owned is not None and card_id not in owned:
+                continue
+            if limit is not None and len(cards) == limit:
+                next_key = last_key
+                break
+            cards.append(self.by_id[card_id])
+            last_key = keys[index]
+        return cards, next_key
+
+    def cards_in_category(self, category_id, sort_field='id', direction='desc'):
+        """Sorted cards of a category id ('all', 'shop' or 'rarity_<name>'), None if the id is invalid"""
+        ids = self.sorted_ids(category_id, sort_field, direction)
+        if ids is None:
+            return None
+        return [self.by_id[card_id] for card_id in ids]
+
+
+class CatalogStore:
+    """Holds the current CatalogSnapshot and refreshes it lazily as requests come in.
+
+    A cheap MAX(id)/COUNT(*) probe of `files` runs at most every
+    `probe_interval` seconds. When it shows only appended rows, just the new
+    cards are fetched and the category index is extended; any other change,
+    or a snapshot older than `max_age`, triggers a full reload. So does a
+    change in what `metadata_probe()` returns, if given: upload metadata
+    is rewritten by the sync in whichever worker leads it, and the probe
+    lets every worker notice. Reloads swap the snapshot reference
+    atomically, so readers always see a consistent catalog, and only one
+    caller reloads at a time while the others keep serving the old snapshot.
+    `on_change`, if given, is called with every new snapshot.
+    """
+
+    def __init__(self, connection_factory, metadata_loader, hidden_names, hidden_rarities,
+                 probe_interval=15.0, max_age=600.0, on_change=None, metadata_probe=None):
+        self.connection_factory = connection_factory
+        self.metadata_loader = metadata_loader
+        self.metadata_probe = metadata_probe
+        self.hidden_names = list(hidden_names)
+        self.hidden_rarities = list(hidden_rarities)
+        self.probe_interval = probe_interval
+        self.max_age = max_age
+        self.on_change = on_change
+
+        self._snapshot = None
+        self._version = 0
+        self._next_probe = 0.0
+        self._force_reload = False
+        self._refresh_lock = threading.Lock()
+
+    def get(self):
+        """Return the current snapshot, loading or refreshing it when due"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._refresh_lock:
+                if self._snapshot is None:
+                    self._reload()
+            return self._snapshot
+
+        if time.monotonic() >= self._next_probe and self._refresh_lock.acquire(blocking=False):
+            try:
+                self._refresh_if_changed()
+            except Exception as e:
+                # Keep serving the previous snapshot if MySQL is briefly unavailable
+                logging.error(f"Catalog refresh failed, serving version {snapshot.version}: {e}")
+            finally:
+                self._refresh_lock.release()
+        return self._snapshot
+
+    def invalidate(self):
+        """Force a reload on the next get(), e.g. after a sync rewrote upload metadata"""
+        self._force_reload = True
+        self._next_probe = 0.0
+
+    def _refresh_if_changed(self):
+        self._next_probe = time.monotonic() + self.probe_interval
+        snapshot = self._snapshot
+        if self._force_reload or time.time() - snapshot.loaded_at >= self.max_age:
+            self._reload()
+            return
+
+        metadata_state = self._probe_metadata()
+        if metadata_state != snapshot.metadata_state:
+            logging.info(f"Upload metadata changed ({snapshot.metadata_state} -> {metadata_state})")
+            self._reload(metadata_state)
+            return
+
+        connection = self.connection_factory()
+        if not connection:
+            raise RuntimeError("MySQL connection failed")
+        try:
+            max_id, row_count = self._probe(connection)
+        finally:
+            connection.close()
+
+        if (max_id, row_count) == (snapshot.max_id, snapshot.row_count):
+            return
+        logging.info(f"Catalog changed (max id {snapshot.max_id} -> {max_id}, "
+                     f"rows {snapshot.row_count} -> {row_count})")
+        if not (snapshot.max_id is not None and max_id is not None and max_id > snapshot.max_id
+                and row_count > snapshot.row_count and self._extend(snapshot)):
+            self._reload()
+
+    def _extend(self, snapshot):
+        """Add cards newer than the snapshot's max id; False if that can't explain the change"""
+        connection = self.connection_factory()
+        if not connection:
+            raise RuntimeError("MySQL connection failed")
+        try:
+            max_id, row_count = self._probe(connection)
+            visible, params = self._visible_filter()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) AS row_count FROM files WHERE id > %s", (snapshot.max_id,))
+                appended = cursor.fetchone()['row_count']
+                if snapshot.row_count + appended != row_count:
+                    # Rows were also deleted or rewritten, only a full reload is safe
+                    return False
+                cursor.execute(f"""
+                    SELECT id, tg_id, name, rare, fame, shop
+                    FROM files
+                    WHERE id > %s AND {visible}
+                """, [snapshot.max_id] + params)
+                rows = cursor.fetchall()
+        finally:
+            connection.close()
+
+        cards = self._cards_from_rows(rows, self.metadata_loader([row['id'] for row in rows]))
+        self._version += 1
+        self._snapshot = snapshot.extended(cards, self._version, max_id, row_count)
+        logging.info(f"Extended catalog to version {self._version} with {len(cards)} new cards")
+        self._notify()
+        return True
+
+    def _notify(self):
+        if self.on_change is None:
+            return
+        try:
+            self.on_change(self._snapshot)
+        except Exception as e:
+            logging.error(f"Catalog change listener failed: {e}")
+
+    def _visible_filter(self):
+        """WHERE clause and parameters selecting the visible cards (NOT IN also drops NULL names and rarities)"""
+        rarity_placeholders = ', '.join(['%s'] * len(self.hidden_rarities))
+        name_placeholders = ', '.join(['%s'] * len(self.hidden_names))
+        return (f"rare NOT IN ({rarity_placeholders}) AND name NOT IN ({name_placeholders})",
+                self.hidden_rarities + self.hidden_names)
+
+    def _cards_from_rows(self, rows, metadata_by_card):
+        cards = []
+        for row in rows:
+            upload_date, season = metadata_by_card.get(row['id'], (None, 1))
+            cards.append(CatalogCard(
+                id=row['id'],
+                photo=row['tg_id'],
+                name=row['name'],
+                rarity=row['rare'],
+                points=row['fame'],
+                shop=row['shop'],
+                in_shop=row['shop'] is not None and row['shop'] != '-',
+                upload_date=upload_date,
+                season=season
+            ))
+        return cards
+
+    def _probe(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MAX(id) AS max_id, COUNT(*) AS row_count FROM files")
+            row = cursor.fetchone()
+        return row['max_id'], row['row_count']
+
+    def _probe_metadata(self):
+        return self.metadata_probe() if self.metadata_probe is not None else None
+
+    def _reload(self, metadata_state=None):
+        started = time.monotonic()
+        if metadata_state is None:
+            metadata_state = self._probe_metadata()  # Before loading, so later writes show up as a change
+        connection = self.connection_factory()
+        if not connection:
+            raise RuntimeError("MySQL connection failed")
+        try:
+            max_id, row_count = self._probe(connection)
+            visible, params = self._visible_filter()
+            with connection.cursor() as cursor:
+                # Hidden cards are filtered once here instead of in every endpoint
+                cursor.execute(f"""
+                    SELECT id, tg_id, name, rare, fame, shop
+                    FROM files
+                    WHERE {visible}
+                """, params)
+                rows = cursor.fetchall()
+        finally:
+            connection.close()
+
+        cards = self._cards_from_rows(rows, self.metadata_loader())
+
+        self._version += 1
+        self._force_reload = False
+        self._snapshot = CatalogSnapshot.build(cards, self._version, max_id, row_count, metadata_state)
+        self._next_probe = time.monotonic() + self.probe_interval
+        logging.info(f"Loaded catalog version {self._version}: {len(cards)} cards "
+                     f"in {time.monotonic() - started:.3f}s")
+        self._notify()
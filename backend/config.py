@@ -22,7 +22,47 @@ class Config:
         'cursorclass': pymysql.cursors.DictCursor,
         'port': 3306
     }
+
+    # MySQL connection pool (see db_pool.py)
+    MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", 10))
+    MYSQL_POOL_TIMEOUT = float(os.environ.get("MYSQL_POOL_TIMEOUT", 5))  # Seconds to wait for a free connection
+    MYSQL_POOL_MAX_IDLE = float(os.environ.get("MYSQL_POOL_MAX_IDLE", 300))  # Recycle connections idle longer than this
+    MYSQL_POOL_PING_INTERVAL = float(os.environ.get("MYSQL_POOL_PING_INTERVAL", 30))  # Ping before reuse after this idle time
     
+    # In-memory card catalog (see catalog.py)
+    CATALOG_PROBE_INTERVAL = float(os.environ.get("CATALOG_PROBE_INTERVAL", 15))  # Seconds between MAX(id)/COUNT probes
+    CATALOG_MAX_AGE = float(os.environ.get("CATALOG_MAX_AGE", 600))  # Full reload at least this often
+
+    MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 200))  # Upper bound for ?limit= on card listings
+    USER_COLLECTION_CACHE_SIZE = int(os.environ.get("USER_COLLECTION_CACHE_SIZE", 2048))  # Parsed users.cards entries kept per worker
+
+    # Telegram Bot API client (see telegram_bot_api.py)
+    TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get("TELEGRAM_CONNECT_TIMEOUT", 5))
+    TELEGRAM_READ_TIMEOUT = float(os.environ.get("TELEGRAM_READ_TIMEOUT", 30))
+    TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", 3))  # For connection errors, 5xx and short 429s
+    TELEGRAM_FILE_PATH_TTL = float(os.environ.get("TELEGRAM_FILE_PATH_TTL", 3000))  # getFile results stay valid for an hour
+
+    # Telegram channel sync (see telegram_user_sync.py)
+    SYNC_FUZZY_WORKERS = int(os.environ.get("SYNC_FUZZY_WORKERS", os.cpu_count() or 1))  # Processes for the sync's card matching and image hashing, see sync_matching.py
+    SYNC_IMAGE_MAX_DISTANCE = int(os.environ.get("SYNC_IMAGE_MAX_DISTANCE", 8))  # Differing bits (of 64) for an image match
+    SYNC_THUMBNAIL_CONCURRENCY = int(os.environ.get("SYNC_THUMBNAIL_CONCURRENCY", 4))  # Channel photo thumbnails downloaded at once
+    SYNC_JOB_POLL_INTERVAL = float(os.environ.get("SYNC_JOB_POLL_INTERVAL", 2))  # Seconds between checks for queued jobs and leadership
+    SYNC_INTERVAL_HOURS = float(os.environ.get("SYNC_INTERVAL_HOURS", 24))  # Scheduled sync after the last successful one
+    SYNC_SCHEDULE_CHECK_MINUTES = float(os.environ.get("SYNC_SCHEDULE_CHECK_MINUTES", 10))  # How often the leader checks whether a sync is due
+    SYNC_LEADER_LEASE = int(os.environ.get("SYNC_LEADER_LEASE", 60))  # Seconds before a leader that stopped renewing may be deposed
+    SYNC_LEADER_RENEW_INTERVAL = float(os.environ.get("SYNC_LEADER_RENEW_INTERVAL", 15))  # Seconds between lease renewals / campaigns
+
+    # Card media cache (see media_cache.py)
+    MEDIA_NEGATIVE_TTL = float(os.environ.get("MEDIA_NEGATIVE_TTL", 3600))  # Seconds to remember file_ids Telegram rejected
+    MEDIA_CACHE_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES", 2 * 1024 ** 3))  # Disk budget for card_images + card_videos
+    MEDIA_CACHE_POLICY = os.environ.get("MEDIA_CACHE_POLICY", "lru")  # Eviction order: "lru" or "lfu"
+    MEDIA_CACHE_INDEX = os.environ.get("MEDIA_CACHE_INDEX", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media_index.sqlite3"))  # Index shared by all workers
+    MEDIA_THUMBNAIL_WIDTHS = tuple(int(w) for w in os.environ.get("MEDIA_THUMBNAIL_WIDTHS", "160,240,320,480,640").split(","))  # Allowed ?w= values
+    MEDIA_PREFETCH_WORKERS = int(os.environ.get("MEDIA_PREFETCH_WORKERS", 4))  # Concurrent downloads when warming the cache
+    MEDIA_PREGENERATE_CONCURRENCY = int(os.environ.get("MEDIA_PREGENERATE_CONCURRENCY", 1))  # Images whose thumbnails are encoded at once after a prefetch
+    MEDIA_PREGENERATE_PAUSE = float(os.environ.get("MEDIA_PREGENERATE_PAUSE", 0.05))  # Seconds between pregenerated variants
+    MEDIA_ACCEL_REDIRECT_PREFIX = os.environ.get("MEDIA_ACCEL_REDIRECT_PREFIX", "")  # e.g. "/internal-media" to let nginx send cached files
+
     # For SQLite over TCP proxy
     SQLITE_DB_PATH = "/app/db/offcardswood.db"  # Mounted path in container
     # SQLALCHEMY_BINDS = f"sqlite:///{SQLITE_DB_PATH}?mode=ro"  # Read-only mode
@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+import weakref
+from collections import deque
+
+import pymysql
+
+from config import Config
+
+
+class PoolTimeout(Exception):
+    """Raised when no MySQL connection could be checked out in time"""
+
+
+def _reclaim_leaked(pool, slot):
+    """weakref.finalize callback: a checkout was garbage-collected without close()"""
+    if slot:
+        raw = slot.pop()
+        logging.warning("MySQL connection was never closed; discarding it")
+        pool._count('leaked')
+        # Its transaction state is unknown, so it is not reused
+        pool._discard(raw)
+
+
+class PooledConnection:
+    """Thin proxy around a pymysql connection that returns it to the pool on close().
+
+    A proxy that is garbage-collected without close() gives its slot back
+    too (the connection itself is discarded), so a forgotten close() can't
+    permanently shrink the pool.
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._slot = [raw]  # Shared with the finalizer; empty once the connection was handed back
+        self._finalizer = weakref.finalize(self, _reclaim_leaked, pool, self._slot)
+
+    @property
+    def _raw(self):
+        if not self._slot:
+            raise pymysql.err.InterfaceError("Connection already returned to the pool")
+        return self._slot[0]
+
+    def cursor(self, *args, **kwargs):
+        return self._raw.cursor(*args, **kwargs)
+
+    def close(self):
+        # Existing code closes connections in `finally`; for a pooled
+        # connection that means "give it back", not "hang up".
+        if self._slot:
+            self._finalizer.detach()
+            self._pool._release(self._slot.pop())
+
+    def invalidate(self):
+        """Drop the underlying connection instead of returning it to the pool"""
+        if self._slot:
+            self._finalizer.detach()
+            self._pool._discard(self._slot.pop())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and isinstance(exc, pymysql.err.OperationalError):
+            self.invalidate()
+        else:
+            self.close()
+
+
+class MySQLConnectionPool:
+    """Bounded pool of pymysql connections.
+
+    Uses only threading primitives, so under gunicorn's gevent worker (which
+    monkey-patches threading) waiting for a connection yields to other greenlets
+    instead of blocking the worker.
+    """
+
+    def __init__(self, connect_kwargs, max_size=10, checkout_timeout=5.0,
+                 max_idle=300.0, ping_interval=30.0):
+        self.connect_kwargs = dict(connect_kwargs)
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.max_idle = max_idle
+        self.ping_interval = ping_interval
+
+        # Reentrant: the garbage collector may run _reclaim_leaked() while this thread holds it
+        self._lock = threading.Condition(threading.RLock())
+        self._idle = deque()  # (raw connection, returned_at)
+        self._size = 0  # open connections, idle + checked out
+
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'recycled': 0,
+            'failed_health_checks': 0,
+            'discarded': 0,
+            'leaked': 0,
+            'timeouts': 0,
+            'connect_errors': 0,
+            'checkouts': 0,
+            'wait_time_total': 0.0,
+        }
+
+    def connection(self, timeout=None):
+        """Check out a connection, waiting up to `timeout` seconds for a free slot"""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        while True:
+            raw, returned_at = self._acquire_slot(deadline)
+            if raw is None:
+                # We reserved a slot for a brand new connection
+                try:
+                    raw = pymysql.connect(**self.connect_kwargs)
+                except Exception:
+                    with self._lock:
+                        self._size -= 1
+                        self._stats['connect_errors'] += 1
+                        self._lock.notify()
+                    raise
+                self._count('created')
+                break
+
+            idle_for = time.monotonic() - returned_at
+            if idle_for > self.max_idle:
+                self._count('recycled')
+                self._discard(raw)
+                continue
+            if idle_for > self.ping_interval and not self._is_healthy(raw):
+                self._count('failed_health_checks')
+                self._discard(raw)
+                continue
+            self._count('reused')
+            break
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['wait_time_total'] += time.monotonic() - started
+        return PooledConnection(self, raw)
+
+    def _acquire_slot(self, deadline):
+        """Return an idle (connection, returned_at) or (None, None) when a new one may be opened"""
+        with self._lock:
+            while True:
+                if self._idle:
+                    # LIFO keeps the hot connections hot and lets the rest age out
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(
+                        f"Timed out waiting for a MySQL connection (pool size {self.max_size})"
+                    )
+                self._lock.wait(remaining)
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _is_healthy(self, raw):
+        try:
+            raw.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def _release(self, raw):
+        try:
+            # End the implicit transaction so the next borrower doesn't read
+            # from a stale REPEATABLE READ snapshot.
+            raw.rollback()
+        except Exception as e:
+            logging.debug(f"Discarding MySQL connection that failed rollback: {e}")
+            self._discard(raw)
+            return
+        with self._lock:
+            self._idle.append((raw, time.monotonic()))
+            self._lock.notify()
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._size -= 1
+            self._stats['discarded'] += 1
+            self._lock.notify()
+
+    def close_idle(self):
+        """Close every idle connection (e.g. after fork or on shutdown)"""
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for raw, _ in idle:
+            self._discard(raw)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['max_size'] = self.max_size
+        checkouts = stats['checkouts']
+        stats['avg_wait_ms'] = round(stats.pop('wait_time_total') / checkouts * 1000, 3) if checkouts else 0.0
+        return stats
+
+
+mysql_pool = MySQLConnectionPool(
+    Config.MYSQL_CONFIG,
+    max_size=Config.MYSQL_POOL_SIZE,
+    checkout_timeout=Config.MYSQL_POOL_TIMEOUT,
+    max_idle=Config.MYSQL_POOL_MAX_IDLE,
+    ping_interval=Config.MYSQL_POOL_PING_INTERVAL,
+)
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import socket
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+from models import LeaderLease
+
+
+class LeadershipLost(Exception):
+    """Raised by LeaderElection.fence() in a worker that no longer holds the lease it was elected with"""
+
+
+def advisory_lock_key(name):
+    """Positive 63-bit advisory lock key for a role name, stable across processes"""
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:8], 'big') >> 1
+
+
+class LeaderElection:
+    """Elects one leader for a role among every worker and host sharing the Postgres database.
+
+    Leadership is a session-level advisory lock held on a connection of its
+    own, so Postgres hands it over as soon as the leader's process dies or
+    its connection drops. The leader also renews a lease in leader_lease
+    every `renew_interval` seconds through that connection and steps down
+    when it cannot; a candidate finding the lease expired (a leader that
+    hangs without dying) terminates the leader's backend to free the lock.
+    on_elected() and on_deposed() are called from the election thread.
+
+    Every election bumps the lease's term. Work done on the leader's behalf
+    in other sessions checks it through fence() before committing, so a
+    leader that was deposed (or whose lease ran out) while it was busy
+    can't overwrite what its successor writes.
+    """
+
+    def __init__(self, engine, name, lease_seconds=60, renew_interval=15, on_elected=None, on_deposed=None):
+        self.engine = engine
+        self.name = name
+        self.key = advisory_lock_key(name)
+        self.lease_seconds = lease_seconds
+        self.renew_interval = renew_interval
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.identity = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._connection = None  # Holds the advisory lock while leading
+        self.is_leader = False
+        self.term = None  # Lease term this worker was elected with
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name=f"leader-{self.name}", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop campaigning and give up leadership"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                if self.is_leader:
+                    self._renew()
+                else:
+                    self._campaign()
+            except Exception as e:
+                logging.error(f"Leader election for {self.name} failed: {e}")
+                if self.is_leader:
+                    self._step_down()
+            self._stop.wait(self.renew_interval)
+        if self.is_leader:
+            self._step_down()
+
+    def _campaign(self):
+        connection = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            acquired = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key}).scalar()
+            if not acquired:
+                self._depose_expired(connection)
+                connection.close()
+                return
+
+            table = LeaderLease.__table__
+            statement = insert(table).values(
+                name=self.name,
+                holder=self.identity,
+                backend_pid=text("pg_backend_pid()"),
+                term=1,
+                acquired_at=text("now()"),
+                renewed_at=text("now()"),
+                expires_at=text(f"now() + interval '{int(self.lease_seconds)} seconds'"),
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=['name'],
+                set_=dict({column: statement.excluded[column] for column in
+                           ('holder', 'backend_pid', 'acquired_at', 'renewed_at', 'expires_at')},
+                          term=table.c.term + 1),
+            ).returning(table.c.term)
+            term = connection.execute(statement).scalar()
+        except Exception:
+            connection.invalidate()  # Closes the session and so releases the lock, if it was taken
+            raise
+
+        self._connection = connection
+        self.term = term
+        self.is_leader = True
+        logging.info(f"{self.identity} is now the leader for {self.name} (term {term})")
+        if self.on_elected is not None:
+            self.on_elected()
+
+    def _depose_expired(self, connection):
+        """Terminate the backend of a leader whose lease ran out, freeing the lock for the next campaign"""
+        deposed = connection.execute(text("""
+            SELECT l.holder, pg_terminate_backend(l.backend_pid)
+            FROM leader_lease l
+            JOIN pg_locks k ON k.pid = l.backend_pid
+            WHERE l.name = :name AND l.expires_at < now()
+              AND k.locktype = 'advisory' AND k.granted
+              AND ((k.classid::bigint << 32) | k.objid::bigint) = :key
+        """), {"name": self.name, "key": self.key}).fetchone()
+        if deposed is not None:
+            logging.warning(f"Deposed {deposed[0]} as leader for {self.name}: its lease expired")
+
+    def _renew(self):
+        renewed = self._connection.execute(text(f"""
+            UPDATE leader_lease
+            SET renewed_at = now(), expires_at = now() + interval '{int(self.lease_seconds)} seconds'
+            WHERE name = :name AND holder = :holder AND backend_pid = pg_backend_pid() AND expires_at > now()
+        """), {"name": self.name, "holder": self.identity}).rowcount
+        if not renewed:
+            logging.warning(f"Lost the lease for {self.name}")
+            self._step_down()
+
+    def fence(self, session):
+        """Check that this worker still leads under its term, within the session's transaction.
+
+        Locks the lease row until that transaction ends, so nobody can take
+        over between the check and the commit; raises LeadershipLost
+        otherwise. Fits as a SQLAlchemy before_commit listener.
+        """
+        term = self.term
+        if not self.is_leader or term is None:
+            raise LeadershipLost(f"{self.identity} is not the leader for {self.name}")
+        held = session.execute(text("""
+            SELECT 1 FROM leader_lease
+            WHERE name = :name AND holder = :holder AND term = :term AND expires_at > now()
+            FOR SHARE
+        """), {"name": self.name, "holder": self.identity, "term": term}).first()
+        if held is None:
+            raise LeadershipLost(f"{self.identity} lost the lease for {self.name} (term {term})")
+
+    def _step_down(self):
+        self.is_leader = False
+        self.term = None
+        connection, self._connection = self._connection, None
+        try:
+            if self.on_deposed is not None:
+                self.on_deposed()
+        finally:
+            if connection is not None:
+                try:
+                    # Discard rather than return it to the pool: ending the session releases the lock
+                    connection.invalidate()
+                    connection.close()
+                except Exception as e:
+                    logging.debug(f"Closing the leader connection for {self.name} failed: {e}")
+        logging.info(f"{self.identity} is no longer the leader for {self.name}")
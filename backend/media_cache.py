@@ -0,0 +1,807 @@
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from telegram_bot_api import bot_api as default_bot_api, TelegramFileRejected
+
+
+# Telegram file_ids are URL-safe base64; anything else never reaches the disk
+FILE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{10,255}$')
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.webm')
+
+TEMP_PREFIX = '.tmp-'
+
+# Kinds of files downloaded from Telegram; any other kind in the index is a
+# derivative (see media_derivatives.py) named "<source hash>.<kind>" in derived_dir
+ORIGINAL_KINDS = ('image', 'video')
+EXTENSIONS = {'image': '.jpg', 'video': '.mp4'}
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# A cached file: originals are keyed by the SHA-256 of their bytes, which is
+# also their ETag; derivatives by their source's hash plus their kind
+CachedMedia = namedtuple('CachedMedia', ['path', 'kind', 'content_hash', 'etag'])
+
+
+class SingleFlight:
+    """Run a function at most once per key at a time; concurrent callers share the result"""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        call, leader = self._join(key)
+        if not leader:
+            return self._wait(call)
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, call)
+
+    def lead(self, key):
+        """Claim `key` without running anything yet.
+
+        Returns a finish(result=None, error=None) callable when the caller
+        became the leader, None when another call is already in flight.
+        """
+        call, leader = self._join(key)
+        if not leader:
+            return None
+
+        def finish(result=None, error=None):
+            call.result = result
+            call.error = error
+            self._finish(key, call)
+        return finish
+
+    def _join(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = self._Call()
+            return call, True
+
+    def _wait(self, call):
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _finish(self, key, call):
+        with self._lock:
+            del self._calls[key]
+        call.done.set()
+
+
+class NegativeCache:
+    """Remembers failing keys for `ttl` seconds"""
+
+    def __init__(self, ttl=3600.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            if len(self._expires) >= self.max_entries:
+                now = time.monotonic()
+                self._expires = {k: v for k, v in self._expires.items() if v > now}
+                if len(self._expires) >= self.max_entries:
+                    self._expires.pop(next(iter(self._expires)))
+            self._expires[key] = time.monotonic() + self.ttl
+
+    def __contains__(self, key):
+        expires = self._expires.get(key)
+        if expires is None:
+            return False
+        if expires <= time.monotonic():
+            with self._lock:
+                self._expires.pop(key, None)
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._expires)
+
+
+class AtomicFile:
+    """A file written under a temp name and renamed into place on commit().
+
+    Readers either see no file or the complete file, never a partial one,
+    even with several writers racing on the same path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fd, self.tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or '.', prefix=TEMP_PREFIX, suffix=os.path.basename(path)
+        )
+        self._file = os.fdopen(fd, 'wb')
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._digest.update(chunk)
+        self.size += len(chunk)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def commit(self, path=None):
+        """Rename into place (at `path` if given); returns (size, SHA-256 hex digest)"""
+        self._file.close()
+        os.replace(self.tmp_path, path or self.path)
+        return self.size, self._digest.hexdigest()
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+
+def atomic_write(path, chunks):
+    """Write an iterable of byte chunks to `path` atomically, see AtomicFile"""
+    target = AtomicFile(path)
+    try:
+        for chunk in chunks:
+            target.write(chunk)
+        return target.commit()
+    except BaseException:
+        target.discard()
+        raise
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaIndex:
+    """SQLite index of cached media files, shared by every worker process on the host.
+
+    `blobs` holds one row per stored file, keyed by content hash and kind;
+    `file_ids` maps Telegram file_ids onto the blob holding their bytes, so
+    file_ids with identical payloads share a single file.
+    """
+
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] < self.SCHEMA_VERSION:
+                # Version 1 indexed files by file_id; reconcile() re-adopts them from disk
+                self._conn.execute("DROP TABLE IF EXISTS media")
+                self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    content_hash TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    access_count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (content_hash, kind)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS file_ids (
+                    file_id TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS file_ids_blob ON file_ids (content_hash, kind)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            """)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def resolve(self, file_id):
+        """The blob row a file_id maps to, or None"""
+        rows = self._execute("""
+            SELECT b.* FROM file_ids f
+            JOIN blobs b ON b.content_hash = f.content_hash AND b.kind = f.kind
+            WHERE f.file_id = ?
+        """, (file_id,))
+        return rows[0] if rows else None
+
+    def get_blob(self, content_hash, kind):
+        rows = self._execute("SELECT * FROM blobs WHERE content_hash = ? AND kind = ?", (content_hash, kind))
+        return rows[0] if rows else None
+
+    def put_blob(self, content_hash, kind, path, size, etag, last_access=None):
+        now = time.time()
+        self._execute("""
+            INSERT INTO blobs (content_hash, kind, path, size, etag, created_at, last_access, access_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+            ON CONFLICT (content_hash, kind) DO UPDATE SET
+                path = excluded.path, size = excluded.size, etag = excluded.etag
+        """, (content_hash, kind, path, size, etag, now, last_access or now))
+
+    def map_file_id(self, file_id, content_hash, kind):
+        self._execute("""
+            INSERT INTO file_ids (file_id, content_hash, kind, created_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (file_id) DO UPDATE SET content_hash = excluded.content_hash, kind = excluded.kind
+        """, (file_id, content_hash, kind, time.time()))
+
+    def remove_blob(self, content_hash, kind):
+        """Delete a blob row and the file_id mappings onto it; returns those file_ids"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                file_ids = [row['file_id'] for row in self._conn.execute(
+                    "SELECT file_id FROM file_ids WHERE content_hash = ? AND kind = ?", (content_hash, kind)
+                )]
+                self._conn.execute("DELETE FROM file_ids WHERE content_hash = ? AND kind = ?", (content_hash, kind))
+                self._conn.execute("DELETE FROM blobs WHERE content_hash = ? AND kind = ?", (content_hash, kind))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return file_ids
+
+    def remove_orphan_mappings(self):
+        self._execute("""
+            DELETE FROM file_ids WHERE NOT EXISTS (
+                SELECT 1 FROM blobs b WHERE b.content_hash = file_ids.content_hash AND b.kind = file_ids.kind
+            )
+        """)
+
+    def touch_many(self, accesses):
+        """accesses: [(last_access, hits, content_hash, kind)]"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("""
+                    UPDATE blobs SET last_access = MAX(last_access, ?), access_count = access_count + ?
+                    WHERE content_hash = ? AND kind = ?
+                """, accesses)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def add_counters(self, deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                if delta:
+                    self._conn.execute("""
+                        INSERT INTO counters (name, value) VALUES (?, ?)
+                        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+                    """, (name, delta))
+
+    def counters(self):
+        return {row['name']: row['value'] for row in self._execute("SELECT name, value FROM counters")}
+
+    def totals(self):
+        row = self._execute("SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes FROM blobs")[0]
+        return row['entries'], row['bytes']
+
+    def mapping_count(self):
+        return self._execute("SELECT COUNT(*) AS count FROM file_ids")[0]['count']
+
+    def eviction_candidates(self, policy, limit=100):
+        order = "access_count ASC, last_access ASC" if policy == 'lfu' else "last_access ASC"
+        return self._execute(f"SELECT * FROM blobs ORDER BY {order} LIMIT ?", (limit,))
+
+    def all_blobs(self):
+        return self._execute("SELECT * FROM blobs")
+
+    def mapped_file_ids(self):
+        return {row['file_id'] for row in self._execute("SELECT file_id FROM file_ids")}
+
+
+class DownloadAborted(Exception):
+    """A streamed download was closed before it completed"""
+
+
+class StreamingDownload:
+    """A download relayed to the client that started it while it is written to the cache.
+
+    The WSGI server calls close() when the response is over, including when
+    it never iterated it (HEAD requests, clients gone before the first byte).
+    A download that did not complete by then is abandoned: the temp file is
+    removed, the Telegram response closed, and requests waiting on the
+    file_id get DownloadAborted instead of waiting forever.
+    """
+
+    def __init__(self, cache, file_id, kind, response, finish):
+        self.cache = cache
+        self.file_id = file_id
+        self.kind = kind
+        self.response = response
+        self._finish = finish  # None once the SingleFlight call has finished
+        self._out = cache._temp_file(file_id, kind)
+
+    def __iter__(self):
+        try:
+            for chunk in self.response.iter_content(chunk_size=64 * 1024):
+                self._out.write(chunk)
+                yield chunk
+            media = self.cache._store(self.file_id, self.kind, self._out)
+        except Exception as e:
+            self._complete(error=e)
+            self.cache._log_failure(self.file_id, e)
+            raise
+        self._complete(result=media)
+
+    def close(self):
+        if self._finish is not None:
+            logging.debug(f"Download of {self.file_id} closed before it completed")
+            self._complete(error=DownloadAborted(f"Download of {self.file_id} was abandoned"))
+
+    def _complete(self, result=None, error=None):
+        finish, self._finish = self._finish, None
+        if finish is None:
+            return
+        try:
+            self.response.close()
+            if error is not None:
+                self._out.discard()
+        finally:
+            finish(result=result, error=error)
+
+
+def _media_from_row(row):
+    return CachedMedia(row['path'], row['kind'], row['content_hash'], row['etag'])
+
+
+class MediaCache:
+    """Size-bounded, content-addressed on-disk cache of card images and videos from the Bot API.
+
+    Files are stored once per content hash (<sha256>.jpg / .mp4) and file_ids
+    are mapped onto them in a MediaIndex, so identical artwork sent under
+    several file_ids takes space once and shares a strong ETag. Once the cache
+    grows past `max_bytes` the least recently (or, with policy='lfu', least
+    frequently) used files are evicted down to `low_watermark` of the budget.
+    Lookups are answered from an in-process map backed by the index instead
+    of stat() calls; access times are buffered and flushed periodically.
+    Derivatives (thumbnails, other formats) live in `derived_dir` and share
+    the same index and budget.
+    """
+
+    def __init__(self, image_dir, video_dir, index_path, max_bytes=2 * 1024 ** 3, policy='lru',
+                 low_watermark=0.9, negative_ttl=3600.0, flush_interval=30.0, bot_api=None):
+        self.image_dir = image_dir
+        self.video_dir = video_dir
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.low_watermark = low_watermark
+        self.bot_api = bot_api or default_bot_api
+        self.flush_interval = flush_interval
+        self.rejected = NegativeCache(ttl=negative_ttl)
+        self._flights = SingleFlight()
+        os.makedirs(image_dir, exist_ok=True)
+        os.makedirs(video_dir, exist_ok=True)
+        self.derived_dir = os.path.join(image_dir, 'derived')
+        os.makedirs(self.derived_dir, exist_ok=True)
+        self.index = MediaIndex(index_path)
+
+        self._lock = threading.Lock()
+        self._entries = {}  # file_id -> CachedMedia
+        self._variants = {}  # (source hash, kind) -> CachedMedia
+        self._pending_access = {}  # (content_hash, kind) -> [last_access, hits]
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'evicted_bytes': 0, 'deduplicated': 0}
+        self._next_flush = time.monotonic() + flush_interval
+
+    def directory(self, kind):
+        if kind in ORIGINAL_KINDS:
+            return self.video_dir if kind == 'video' else self.image_dir
+        return self.derived_dir
+
+    def blob_path(self, content_hash, kind):
+        if kind in ORIGINAL_KINDS:
+            return os.path.join(self.directory(kind), f"{content_hash}{EXTENSIONS[kind]}")
+        return os.path.join(self.derived_dir, f"{content_hash}.{kind}")
+
+    def lookup(self, file_id):
+        """CachedMedia for a file_id, None on a miss"""
+        media = self._entries.get(file_id)
+        if media is None:
+            row = self.index.resolve(file_id)
+            if row is None:
+                return None
+            media = _media_from_row(row)
+            with self._lock:
+                self._entries[file_id] = media
+        self._record_access(media.content_hash, media.kind)
+        return media
+
+    def forget(self, file_id):
+        """Drop a stale entry whose file disappeared (e.g. evicted by another worker)"""
+        with self._lock:
+            media = self._entries.pop(file_id, None)
+        if media is not None and not os.path.exists(media.path):
+            self._drop_blob(media.content_hash, media.kind)
+
+    def lookup_variant(self, content_hash, kind):
+        """CachedMedia of a derivative of the original with `content_hash`, None on a miss"""
+        media = self._variants.get((content_hash, kind))
+        if media is None:
+            row = self.index.get_blob(content_hash, kind)
+            if row is None:
+                return None
+            media = _media_from_row(row)
+            with self._lock:
+                self._variants[(content_hash, kind)] = media
+        self._record_access(content_hash, kind)
+        return media
+
+    def store_variant(self, content_hash, kind, data):
+        """Atomically write a derivative and index it; returns its CachedMedia"""
+        path = self.blob_path(content_hash, kind)
+        size, etag = atomic_write(path, [data])
+        media = CachedMedia(path, kind, content_hash, etag)
+        self.index.put_blob(content_hash, kind, path, size, etag)
+        with self._lock:
+            self._variants[(content_hash, kind)] = media
+        self.enforce_budget()
+        return media
+
+    def forget_variant(self, content_hash, kind):
+        with self._lock:
+            self._variants.pop((content_hash, kind), None)
+        self.index.remove_blob(content_hash, kind)
+
+    def fetch(self, file_id):
+        """CachedMedia for a file_id, downloading it once on a miss.
+
+        Returns None for invalid or rejected file_ids and on download errors.
+        Concurrent misses for the same file_id share a single download.
+        """
+        if not FILE_ID_PATTERN.match(file_id):
+            logging.warning(f"Refusing malformed file_id {file_id!r}")
+            return None
+
+        cached = self.lookup(file_id)
+        if cached:
+            self._count('hits')
+            return cached
+
+        if file_id in self.rejected:
+            logging.debug(f"file_id {file_id} was rejected by Telegram recently, skipping")
+            return None
+
+        self._count('misses')
+        return self._shared_download(file_id)
+
+    def missing(self, file_ids):
+        """The file_ids that have no original in the cache, in the given order"""
+        cached = self.index.mapped_file_ids()
+        return [file_id for file_id in file_ids if file_id not in cached]
+
+    def download(self, file_id):
+        """Download a file_id into the cache, raising on failure (for background callers that retry)"""
+        try:
+            return self._flights.do(file_id, lambda: self._download(file_id))
+        except TelegramFileRejected:
+            self.rejected.add(file_id)
+            raise
+
+    def _shared_download(self, file_id):
+        try:
+            return self._flights.do(file_id, lambda: self._download(file_id))
+        except Exception as e:
+            self._log_failure(file_id, e)
+            return None
+
+    def fetch_streaming(self, file_id):
+        """Like fetch(), but a download started by this call is relayed while it is written.
+
+        Returns None, ('file', CachedMedia) for a file already on disk, or
+        ('stream', chunks, kind, size) where `chunks` is a StreamingDownload
+        yielding the file as it arrives from Telegram (size may be None), to
+        be closed once the response is done. Only the request that starts a
+        download relays it; concurrent requests for the same file_id wait for
+        the finished file as with fetch().
+        """
+        if not FILE_ID_PATTERN.match(file_id):
+            logging.warning(f"Refusing malformed file_id {file_id!r}")
+            return None
+
+        cached = self.lookup(file_id)
+        if cached:
+            self._count('hits')
+            return 'file', cached
+        if file_id in self.rejected:
+            return None
+
+        finish = self._flights.lead(file_id)
+        if finish is None:
+            media = self._shared_download(file_id)
+            return ('file', media) if media else None
+
+        self._count('misses')
+        try:
+            on_disk = self._find_in_index(file_id)
+            if on_disk:
+                finish(result=on_disk)
+                return 'file', on_disk
+            kind, response = self._open_download(file_id)
+        except Exception as e:
+            finish(error=e)
+            self._log_failure(file_id, e)
+            return None
+
+        size = response.headers.get('Content-Length')
+        return 'stream', StreamingDownload(self, file_id, kind, response, finish), kind, int(size) if size else None
+
+    def _log_failure(self, file_id, error):
+        if isinstance(error, TelegramFileRejected):
+            self.rejected.add(file_id)
+            logging.warning(f"Telegram API error for file_id {file_id}: {error}")
+            if file_id.startswith('CgAC'):
+                logging.info(f"File {file_id} appears to be a special type (sticker/animation), using placeholder")
+        else:
+            logging.error(f"Error downloading card media for {file_id}: {str(error)}")
+
+    def _find_in_index(self, file_id):
+        # Another worker process may have finished the download meanwhile
+        row = self.index.resolve(file_id)
+        if row is None or not os.path.exists(row['path']):
+            return None
+        media = _media_from_row(row)
+        with self._lock:
+            self._entries[file_id] = media
+        return media
+
+    def _open_download(self, file_id):
+        """Resolve a file_id through getFile and open the download: (kind, response)"""
+        file_path, response = self.bot_api.open_file(file_id)
+        logging.debug(f"File path obtained: {file_path}")
+
+        # Determine if this is a video file based on file path extension
+        kind = 'video' if file_path.lower().endswith(VIDEO_EXTENSIONS) else 'image'
+        return kind, response
+
+    def _download(self, file_id):
+        on_disk = self._find_in_index(file_id)
+        if on_disk:
+            return on_disk
+
+        kind, file_response = self._open_download(file_id)
+        out = self._temp_file(file_id, kind)
+        try:
+            with file_response:
+                for chunk in file_response.iter_content(chunk_size=64 * 1024):
+                    out.write(chunk)
+            return self._store(file_id, kind, out)
+        except BaseException:
+            out.discard()
+            raise
+
+    def _temp_file(self, file_id, kind):
+        # The final name depends on the content hash, known only once the download is complete
+        return AtomicFile(os.path.join(self.directory(kind), f"{file_id}{EXTENSIONS[kind]}"))
+
+    def _store(self, file_id, kind, out):
+        """Move a completed download to its content-addressed path and map the file_id onto it"""
+        content_hash = out.hexdigest()
+        path = self.blob_path(content_hash, kind)
+        existing = self.index.get_blob(content_hash, kind)
+        if existing is not None and os.path.exists(existing['path']):
+            # Same bytes already stored under another file_id
+            out.discard()
+            self._count('deduplicated')
+            logging.debug(f"file_id {file_id} has the same content as a cached {kind} ({content_hash})")
+        else:
+            out.commit(path)
+            self.index.put_blob(content_hash, kind, path, out.size, content_hash)
+            logging.debug(f"Cached {kind} for file_id {file_id} at {path}")
+        self.index.map_file_id(file_id, content_hash, kind)
+
+        media = CachedMedia(path, kind, content_hash, content_hash)
+        with self._lock:
+            self._entries[file_id] = media
+        self.enforce_budget()
+        return media
+
+    def _record_access(self, content_hash, kind):
+        now = time.time()
+        with self._lock:
+            pending = self._pending_access.setdefault((content_hash, kind), [now, 0])
+            pending[0] = now
+            pending[1] += 1
+        if time.monotonic() >= self._next_flush:
+            self.flush()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def flush(self):
+        """Write buffered access times and counters to the shared index"""
+        with self._lock:
+            pending, self._pending_access = self._pending_access, {}
+            counters = dict(self._counters)
+            self._counters = dict.fromkeys(self._counters, 0)
+            self._next_flush = time.monotonic() + self.flush_interval
+        try:
+            if pending:
+                self.index.touch_many([
+                    (last_access, hits, content_hash, kind)
+                    for (content_hash, kind), (last_access, hits) in pending.items()
+                ])
+            self.index.add_counters(counters)
+        except Exception as e:
+            logging.warning(f"Failed to flush media cache index: {e}")
+
+    def enforce_budget(self):
+        """Evict files until the cache is back under its low watermark"""
+        _, used = self.index.totals()
+        if used <= self.max_bytes:
+            return
+        self.flush()  # Eviction order must see this worker's recent accesses
+        target = int(self.max_bytes * self.low_watermark)
+        while used > target:
+            candidates = self.index.eviction_candidates(self.policy)
+            if not candidates:
+                break
+            for row in candidates:
+                self._evict(row)
+                used -= row['size']
+                if used <= target:
+                    break
+        logging.info(f"Media cache trimmed to {used} bytes (budget {self.max_bytes})")
+
+    def _evict(self, row):
+        try:
+            os.unlink(row['path'])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Could not evict {row['path']}: {e}")
+        self._drop_blob(row['content_hash'], row['kind'])
+        with self._lock:
+            self._counters['evictions'] += 1
+            self._counters['evicted_bytes'] += row['size']
+
+    def _drop_blob(self, content_hash, kind):
+        file_ids = self.index.remove_blob(content_hash, kind)
+        with self._lock:
+            for file_id in file_ids:
+                self._entries.pop(file_id, None)
+            self._variants.pop((content_hash, kind), None)
+
+    def reconcile(self):
+        """Bring the index in line with the directories: adopt unknown files, drop missing ones.
+
+        Files from before content addressing (<file_id>.jpg/.mp4) are hashed,
+        renamed to their content hash and mapped; old-style derivatives are
+        deleted and regenerated on demand. Workers starting together take
+        turns through a lock file; a file that vanishes mid-way was handled
+        by another process and is skipped.
+        """
+        with open(self.index.path + '.reconcile.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # Released when the file is closed
+            self._reconcile()
+
+    def _reconcile(self):
+        known = set()
+        for row in self.index.all_blobs():
+            if os.path.exists(row['path']):
+                known.add(row['path'])
+            else:
+                self.index.remove_blob(row['content_hash'], row['kind'])
+
+        counts = {'adopted': 0, 'migrated': 0}
+        for kind, directory in (('image', self.image_dir), ('video', self.video_dir), (None, self.derived_dir)):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if path in known:
+                    continue
+                try:
+                    outcome = self._reconcile_file(kind, name, path, known)
+                except FileNotFoundError:
+                    logging.debug(f"{path} disappeared while reconciling the media cache")
+                    continue
+                if outcome:
+                    counts[outcome] += 1
+
+        self.index.remove_orphan_mappings()
+        entries, used = self.index.totals()
+        logging.info(f"Media cache reconciled: {entries} files, {used} bytes, "
+                     f"{counts['adopted']} adopted from disk, {counts['migrated']} migrated to content addressing")
+        self.enforce_budget()
+
+    def _reconcile_file(self, kind, name, path, known):
+        """Adopt or migrate one file found on disk; returns 'adopted', 'migrated' or None"""
+        if name.startswith(TEMP_PREFIX):
+            # Leftover of a download interrupted by a crash
+            if time.time() - os.path.getmtime(path) > 3600:
+                os.unlink(path)
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        stem, _, suffix = name.partition('.')
+        stat = os.stat(path)
+        if kind is None:
+            if HASH_PATTERN.match(stem) and suffix:
+                self.index.put_blob(stem, suffix, path, stat.st_size, file_sha256(path), last_access=stat.st_mtime)
+                return 'adopted'
+            os.unlink(path)
+            return None
+
+        if f".{suffix}" != EXTENSIONS[kind]:
+            return None
+        if HASH_PATTERN.match(stem):
+            self.index.put_blob(stem, kind, path, stat.st_size, stem, last_access=stat.st_mtime)
+            return 'adopted'
+        if not FILE_ID_PATTERN.match(stem):
+            return None
+
+        content_hash = file_sha256(path)
+        target = self.blob_path(content_hash, kind)
+        if target in known or os.path.exists(target):
+            os.unlink(path)
+        else:
+            os.replace(path, target)
+        known.add(target)
+        self.index.put_blob(content_hash, kind, target, stat.st_size, content_hash, last_access=stat.st_mtime)
+        self.index.map_file_id(stem, content_hash, kind)
+        return 'migrated'
+
+    def stats(self):
+        self.flush()
+        counters = self.index.counters()
+        entries, used = self.index.totals()
+        hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+        return {
+            'entries': entries,
+            'file_ids': self.index.mapping_count(),
+            'bytes_used': used,
+            'max_bytes': self.max_bytes,
+            'policy': self.policy,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+            'evictions': counters.get('evictions', 0),
+            'evicted_bytes': counters.get('evicted_bytes', 0),
+            'deduplicated_downloads': counters.get('deduplicated', 0),
+            'negative_cache_entries': len(self.rejected),
+        }
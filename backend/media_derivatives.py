@@ -0,0 +1,131 @@
+import io
+import logging
+import threading
+import time
+
+from PIL import Image
+
+from media_cache import SingleFlight
+
+
+# Output formats in order of preference: (kind suffix, Pillow format, MIME type, save options)
+FORMATS = (
+    ('avif', 'AVIF', 'image/avif', {'quality': 55}),
+    ('webp', 'WEBP', 'image/webp', {'quality': 78, 'method': 4}),
+    ('jpg', 'JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+MIMETYPES = {suffix: mimetype for suffix, _, mimetype, _ in FORMATS}
+
+
+def available_formats():
+    """Format suffixes this Pillow build can encode (AVIF needs Pillow >= 11.2 or pillow-avif-plugin)"""
+    Image.init()
+    extensions = Image.registered_extensions()
+    return tuple(suffix for suffix, pil_format, _, _ in FORMATS if extensions.get(f'.{suffix}') == pil_format)
+
+
+def parse_accept(accept_header):
+    """{mime type: q} from an Accept header"""
+    accepted = {}
+    for part in (accept_header or '').split(','):
+        fields = part.strip().split(';')
+        mimetype = fields[0].strip().lower()
+        if not mimetype:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[mimetype] = q
+    return accepted
+
+
+def variant_kind(width, suffix):
+    """Index kind of a derivative, e.g. "w320.webp" (the file is "<source hash>.w320.webp")"""
+    return f"w{width}.{suffix}"
+
+
+class DerivativeGenerator:
+    """Resized, re-encoded variants of cached card images.
+
+    Variants are produced on first request (or ahead of time through
+    pregenerate()) and stored in the media cache under the original's content
+    hash and their own kind, so they are reused across workers and file_ids
+    with the same artwork, and evicted with the originals' budget.
+    Widths are snapped to a fixed set to keep the number of variants bounded.
+    Ahead-of-time generation runs in the background of a serving worker, so
+    at most `pregenerate_concurrency` images are encoded at once, with a
+    `pregenerate_pause` between variants to let requests through.
+    """
+
+    def __init__(self, media_cache, widths=(160, 240, 320, 480, 640), pregenerate_concurrency=1,
+                 pregenerate_pause=0.05):
+        self.media_cache = media_cache
+        self.widths = tuple(sorted(widths))
+        self.formats = available_formats()
+        self.pregenerate_pause = pregenerate_pause
+        self._flights = SingleFlight()
+        self._pregenerate_slots = threading.BoundedSemaphore(pregenerate_concurrency)
+        logging.info(f"Image derivatives: widths {self.widths}, formats {self.formats}")
+
+    def snap_width(self, requested):
+        """Smallest allowed width >= requested (the largest one for anything bigger)"""
+        for width in self.widths:
+            if width >= requested:
+                return width
+        return self.widths[-1]
+
+    def negotiate(self, accept_header):
+        """Best format suffix the client accepts; JPEG is always acceptable"""
+        accepted = parse_accept(accept_header)
+        for suffix in self.formats:
+            if accepted.get(MIMETYPES[suffix], 0) > 0:
+                return suffix
+        return 'jpg'
+
+    def get(self, original, width, suffix):
+        """CachedMedia of the variant of an original image, generated on a miss; None if that failed"""
+        kind = variant_kind(width, suffix)
+        media = self.media_cache.lookup_variant(original.content_hash, kind)
+        if media is not None:
+            return media
+        try:
+            return self._flights.do((original.content_hash, kind), lambda: self._generate(original, width, suffix))
+        except Exception as e:
+            logging.error(f"Failed to generate {kind} for {original.content_hash}: {str(e)}")
+            return None
+
+    def pregenerate(self, original, widths=None, suffixes=None):
+        """Build variants ahead of time, e.g. right after the original was downloaded"""
+        with self._pregenerate_slots:
+            for width in widths or self.widths:
+                for suffix in suffixes or self.formats:
+                    if self.media_cache.lookup_variant(original.content_hash, variant_kind(width, suffix)):
+                        continue
+                    self.get(original, width, suffix)
+                    time.sleep(self.pregenerate_pause)
+
+    def _generate(self, original, width, suffix):
+        kind = variant_kind(width, suffix)
+        # Another request may have finished it while this one waited its turn
+        media = self.media_cache.lookup_variant(original.content_hash, kind)
+        if media is not None:
+            return media
+
+        _, pil_format, _, options = next(f for f in FORMATS if f[0] == suffix)
+        with Image.open(original.path) as image:
+            image.draft('RGB', (width, width * 4))  # Let the JPEG decoder downscale while decoding
+            image = image.convert('RGBA' if suffix != 'jpg' and image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+            if image.width > width:
+                height = max(1, round(image.height * width / image.width))
+                image = image.resize((width, height), Image.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, pil_format, **options)
+
+        media = self.media_cache.store_variant(original.content_hash, kind, buffer.getvalue())
+        logging.debug(f"Generated {kind} for {original.content_hash} ({buffer.tell()} bytes)")
+        return media
@@ -0,0 +1,93 @@
+import base64
+import binascii
+import logging
+import struct
+
+
+# Flags in the type field of a Bot API file_id
+FILE_REFERENCE_FLAG = 1 << 25
+WEB_LOCATION_FLAG = 1 << 24
+
+PHOTO_FILE_TYPES = {2}  # Photo
+DOCUMENT_FILE_TYPES = {3, 4, 5, 8, 9, 10, 13}  # Voice, video, document, sticker, audio, animation, video note
+
+
+def _decode_base64(file_id):
+    return base64.urlsafe_b64decode(file_id + '=' * (-len(file_id) % 4))
+
+
+def _rle_decode(data):
+    """Bot API file_ids run-length encode zero bytes as 0x00 followed by the count"""
+    decoded = bytearray()
+    zero = False
+    for byte in data:
+        if zero:
+            decoded.extend(b'\0' * byte)
+            zero = False
+        elif byte == 0:
+            zero = True
+        else:
+            decoded.append(byte)
+    return bytes(decoded)
+
+
+def media_key(file_id):
+    """("photo" | "document", Telegram media id) a Bot API file_id refers to, None if it can't be decoded.
+
+    The id is the same one MTProto (Telethon) reports for the photo or
+    document, so a card can be found among channel messages without
+    downloading anything. Handles file_ids with and without a file
+    reference; thumbnails and web files have no such id.
+    """
+    try:
+        data = _rle_decode(_decode_base64(file_id))
+        if len(data) < 2 or data[-1] not in (2, 4):
+            return None
+        data = data[:-2] if data[-1] == 4 else data[:-1]  # Version 4 also has a sub-version byte
+
+        type_id, dc_id = struct.unpack_from('<ii', data, 0)
+        offset = 8
+        if type_id & WEB_LOCATION_FLAG:
+            return None
+        if type_id & FILE_REFERENCE_FLAG:
+            # TL-serialized bytes: 1 byte length (or 0xFE + 3 bytes), padded to 4 bytes
+            length, header = data[offset], 1
+            if length == 254:
+                length, header = int.from_bytes(data[offset + 1:offset + 4], 'little'), 4
+            offset += header + length
+            offset += -(header + length) % 4
+        file_type = type_id & ~(FILE_REFERENCE_FLAG | WEB_LOCATION_FLAG)
+        if not 1 <= dc_id <= 5:
+            return None
+
+        media_id, = struct.unpack_from('<q', data, offset)
+    except (binascii.Error, ValueError, struct.error, IndexError):
+        return None
+
+    if file_type in PHOTO_FILE_TYPES:
+        return 'photo', media_id
+    if file_type in DOCUMENT_FILE_TYPES:
+        return 'document', media_id
+    return None
+
+
+class MediaIdentityIndex:
+    """Channel messages by the (media type, media id) of their photo or document"""
+
+    def __init__(self, messages):
+        self.messages = {}
+        for message in messages:
+            if not getattr(message, 'media_id', None):
+                continue
+            key = (message.media_type, message.media_id)
+            current = self.messages.get(key)
+            # Like the exact name match: the newest message wins, ties go to the earlier one
+            if current is None or message.date > current.date:
+                self.messages[key] = message
+        logging.debug(f"Media identity index: {len(self.messages)} media in {len(messages)} messages")
+
+    def match(self, key):
+        """Message posting the media with this media_key(), None if none does"""
+        if key is None:
+            return None
+        return self.messages.get(tuple(key))
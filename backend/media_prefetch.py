@@ -0,0 +1,160 @@
+import fcntl
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from media_cache import FILE_ID_PATTERN
+from telegram_bot_api import TelegramFileRejected, TelegramRateLimited
+
+
+class MediaPrefetcher:
+    """Downloads card media that is not cached yet, in the background.
+
+    A run diffs the file_ids returned by `file_ids_source` against the media
+    cache index and downloads the missing ones with at most `max_workers`
+    concurrent transfers. Failures are retried with exponential backoff and
+    jitter; a 429 from Telegram pauses every transfer for the retry_after it
+    asked for. An exclusive lock on `lock_path` ensures only one gunicorn
+    worker prefetches at a time.
+    """
+
+    def __init__(self, media_cache, file_ids_source, lock_path, max_workers=4,
+                 max_attempts=3, backoff=2.0, on_downloaded=None):
+        self.media_cache = media_cache
+        self.file_ids_source = file_ids_source
+        self.lock_path = lock_path
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.on_downloaded = on_downloaded
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._rerun = False
+        self._paused_until = 0.0
+        self._progress = {'state': 'idle', 'runs': 0}
+
+    def trigger(self, reason=""):
+        """Start a prefetch run in a background thread; a run already in progress is followed by another one"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._rerun = True
+                return False
+            self._thread = threading.Thread(target=self._loop, args=(reason,), name="media-prefetch", daemon=True)
+            self._thread.start()
+            return True
+
+    def status(self):
+        with self._lock:
+            return dict(self._progress)
+
+    def _loop(self, reason):
+        while True:
+            try:
+                self.run(reason)
+            except Exception as e:
+                logging.error(f"Media prefetch failed: {e}", exc_info=True)
+                self._update(state='error', error=str(e))
+            with self._lock:
+                if not self._rerun:
+                    return
+                self._rerun = False
+            reason = "changes during previous run"
+
+    def run(self, reason=""):
+        """Prefetch everything missing now, in the calling thread"""
+        lock_file = open(self.lock_path, 'a')
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info("Media prefetch already running in another worker, skipping")
+                self._update(state='skipped', finished_at=time.time())
+                return
+
+            started = time.time()
+            file_ids = [
+                file_id for file_id in dict.fromkeys(self.file_ids_source())
+                if file_id and FILE_ID_PATTERN.match(file_id) and file_id not in self.media_cache.rejected
+            ]
+            missing = self.media_cache.missing(file_ids)
+            with self._lock:
+                self._progress = {
+                    'state': 'running',
+                    'reason': reason,
+                    'runs': self._progress.get('runs', 0) + 1,
+                    'started_at': started,
+                    'finished_at': None,
+                    'known': len(file_ids),
+                    'total': len(missing),
+                    'done': 0,
+                    'failed': 0,
+                    'rejected': 0,
+                    'rate_limited': 0,
+                    'over_budget': 0,
+                }
+            logging.info(f"Media prefetch ({reason or 'manual'}): {len(missing)} of {len(file_ids)} files missing")
+
+            if missing:
+                with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="media-prefetch") as pool:
+                    # list() surfaces unexpected exceptions from the workers
+                    list(pool.map(self._prefetch_one, missing))
+
+            self._update(state='finished', finished_at=time.time())
+            progress = self.status()
+            logging.info(f"Media prefetch finished in {time.time() - started:.1f}s: {progress['done']} downloaded, "
+                         f"{progress['failed']} failed, {progress['rejected']} rejected")
+        finally:
+            lock_file.close()  # Also releases the flock
+
+    def _prefetch_one(self, file_id):
+        _, used = self.media_cache.index.totals()
+        if used >= self.media_cache.max_bytes * self.media_cache.low_watermark:
+            # Prefetching more would only evict files that were actually requested
+            self._increment('over_budget')
+            return
+        attempt = 0
+        while attempt < self.max_attempts:
+            self._wait_if_paused()
+            try:
+                media = self.media_cache.download(file_id)
+            except TelegramFileRejected:
+                self._increment('rejected')
+                return
+            except TelegramRateLimited as e:
+                self._increment('rate_limited')
+                with self._lock:
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logging.warning(f"Media prefetch paused for {e.retry_after}s by Telegram rate limiting")
+                continue  # Waiting out a 429 doesn't use up an attempt
+            except Exception as e:
+                attempt += 1
+                if attempt == self.max_attempts:
+                    logging.warning(f"Giving up prefetching {file_id} after {attempt} attempts: {e}")
+                    break
+                time.sleep(self.backoff ** attempt * random.uniform(0.5, 1.5))
+                continue
+
+            if self.on_downloaded is not None:
+                try:
+                    self.on_downloaded(file_id, media)
+                except Exception as e:
+                    logging.warning(f"Post-download hook failed for {file_id}: {e}")
+            self._increment('done')
+            return
+        self._increment('failed')
+
+    def _wait_if_paused(self):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _increment(self, key):
+        with self._lock:
+            self._progress[key] += 1
+
+    def _update(self, **values):
+        with self._lock:
+            self._progress.update(values)
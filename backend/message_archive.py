@@ -0,0 +1,250 @@
+import argparse
+import json
+import logging
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import bindparam, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from card_matcher import NORMALIZATION_VERSION, MessageForms, message_forms
+from models import ChannelMessage
+
+
+# What the matcher needs of a channel message, whether it came from Telethon, the archive or a JSONL file;
+# `forms` holds the card_matcher.MessageForms stored with archived messages
+# and `image_hash` the perceptual_hash.dhash() of its photo
+ArchivedMessage = namedtuple('ArchivedMessage',
+                             ['id', 'date', 'text', 'media_type', 'media_id', 'media_size', 'image_hash', 'forms'],
+                             defaults=(None, None, None))
+
+UPSERT_BATCH_SIZE = 500
+
+
+def media_identifiers(message):
+    """(media type, Telegram id, size) of a Telethon message's photo or document, (None, None, None) without media"""
+    if message.photo is not None:
+        sizes = [max(size.sizes) if hasattr(size, 'sizes') else getattr(size, 'size', 0)
+                 for size in message.photo.sizes]  # Progressive sizes list every prefix length
+        return 'photo', message.photo.id, max(sizes, default=None)
+    if message.document is not None:
+        return 'document', message.document.id, message.document.size
+    return None, None, None
+
+
+def thumbnail_type(photo):
+    """Type of the smallest downloadable size of a Telethon photo (e.g. "s", about 100 px), None if it has none"""
+    sizes = [(max(size.sizes) if hasattr(size, 'sizes') else size.size, size.type)
+             for size in photo.sizes if hasattr(size, 'sizes') or isinstance(getattr(size, 'size', None), int)]
+    return min(sizes)[1] if sizes else None
+
+
+def forms_columns(text):
+    """channel_message columns holding the precomputed MessageForms of a text"""
+    if not text:
+        return {'lower_text': None, 'tokens': None, 'normalized_text': None,
+                'normalization_version': NORMALIZATION_VERSION}
+    forms = message_forms(text)
+    return {
+        'lower_text': forms.lower,
+        'tokens': sorted(forms.words),
+        'normalized_text': forms.fuzzy,
+        'normalization_version': NORMALIZATION_VERSION,
+    }
+
+
+def from_telethon(message, image_hash=None):
+    media_type, media_id, media_size = media_identifiers(message)
+    return ArchivedMessage(message.id, message.date, message.text, media_type, media_id, media_size, image_hash)
+
+
+def write_jsonl(messages, path):
+    """Record messages as one JSON object per line, e.g. as a fixture for offline matching"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for message in messages:
+            f.write(json.dumps({
+                'id': message.id,
+                'date': message.date.isoformat(),
+                'text': message.text,
+                'media_type': message.media_type,
+                'media_id': message.media_id,
+                'media_size': message.media_size,
+                'image_hash': message.image_hash,
+            }, ensure_ascii=False) + '\n')
+    return len(messages)
+
+
+def read_jsonl(path):
+    """ArchivedMessages from a file written by write_jsonl(), in file order"""
+    messages = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            messages.append(ArchivedMessage(
+                record['id'],
+                datetime.fromisoformat(record['date']),
+                record.get('text'),
+                record.get('media_type'),
+                record.get('media_id'),
+                record.get('media_size'),
+                record.get('image_hash'),
+            ))
+    return messages
+
+
+class MessageArchive:
+    """Messages of one Telegram channel kept in the channel_message table.
+
+    The sync appends what it fetches (edited messages are overwritten), so
+    matching and debugging can read the channel history locally instead of
+    fetching it again over MTProto. The normalized forms the matcher works
+    on are stored with each message and only recomputed by renormalize()
+    after card_matcher.NORMALIZATION_VERSION changes. Works with any SQLAlchemy session, e.g.
+    the sync script's own or Flask-SQLAlchemy's db.session.
+    """
+
+    def __init__(self, session, channel):
+        self.session = session
+        self.channel = channel
+        self.table = ChannelMessage.__table__
+
+    def latest_id(self):
+        """Newest archived message id, None while the archive is empty"""
+        return self.session.execute(
+            select(func.max(self.table.c.message_id)).where(self.table.c.channel == self.channel)
+        ).scalar()
+
+    def count(self):
+        return self.session.execute(
+            select(func.count()).select_from(self.table).where(self.table.c.channel == self.channel)
+        ).scalar()
+
+    def append(self, messages):
+        """Insert new messages and overwrite already archived ones; returns how many were written"""
+        now = datetime.utcnow()
+        rows = [dict({
+            'channel': self.channel,
+            'message_id': message.id,
+            'date': message.date,
+            'text': message.text,
+            'media_type': message.media_type,
+            'media_id': message.media_id,
+            'media_size': message.media_size,
+            'image_hash': message.image_hash,
+            'archived_at': now,
+        }, **forms_columns(message.text)) for message in messages]
+
+        for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+            statement = insert(self.table).values(rows[start:start + UPSERT_BATCH_SIZE])
+            statement = statement.on_conflict_do_update(
+                index_elements=['channel', 'message_id'],
+                set_={column: statement.excluded[column] for column in
+                      ('date', 'text', 'lower_text', 'tokens', 'normalized_text', 'normalization_version',
+                       'media_type', 'media_id', 'media_size', 'image_hash', 'archived_at')},
+            )
+            self.session.execute(statement)
+        self.session.commit()
+        return len(rows)
+
+    def image_hashes(self):
+        """{message id: (media id, image hash)} of the archived photos that have been hashed"""
+        table = self.table
+        rows = self.session.execute(
+            select(table.c.message_id, table.c.media_id, table.c.image_hash)
+            .where(table.c.channel == self.channel, table.c.image_hash.isnot(None))
+        )
+        return {message_id: (media_id, image_hash) for message_id, media_id, image_hash in rows}
+
+    def renormalize(self):
+        """Recompute the stored forms written under another NORMALIZATION_VERSION; returns how many"""
+        table = self.table
+        stale = self.session.execute(
+            select(table.c.id, table.c.text).where(
+                table.c.channel == self.channel,
+                or_(table.c.normalization_version.is_(None),
+                    table.c.normalization_version != NORMALIZATION_VERSION),
+            )
+        ).fetchall()
+        if not stale:
+            return 0
+
+        columns = ('lower_text', 'tokens', 'normalized_text', 'normalization_version')
+        statement = update(table).where(table.c.id == bindparam('row_id')).values(
+            {column: bindparam(f'new_{column}') for column in columns}
+        )
+        for start in range(0, len(stale), UPSERT_BATCH_SIZE):
+            self.session.execute(statement, [
+                dict({f'new_{column}': value for column, value in forms_columns(text).items()}, row_id=row_id)
+                for row_id, text in stale[start:start + UPSERT_BATCH_SIZE]
+            ])
+        self.session.commit()
+        logging.info(f"Renormalized {len(stale)} archived messages")
+        return len(stale)
+
+    def messages(self, min_id=None, limit=None):
+        """ArchivedMessages newest first, optionally only those after min_id"""
+        table = self.table
+        query = select(
+            table.c.message_id,
+            table.c.date,
+            table.c.text,
+            table.c.media_type,
+            table.c.media_id,
+            table.c.media_size,
+            table.c.image_hash,
+            table.c.lower_text,
+            table.c.tokens,
+            table.c.normalized_text,
+            table.c.normalization_version,
+        ).where(table.c.channel == self.channel)
+        if min_id is not None:
+            query = query.where(table.c.message_id > min_id)
+        query = query.order_by(table.c.message_id.desc())
+        if limit is not None:
+            query = query.limit(limit)
+
+        messages = []
+        for row in self.session.execute(query):
+            message_id, date, text, media_type, media_id, media_size, image_hash, lower, tokens, fuzzy, version = row
+            forms = None
+            if text and version == NORMALIZATION_VERSION:
+                forms = MessageForms(lower, frozenset(tokens or ()), fuzzy)
+            messages.append(ArchivedMessage(message_id, date, text, media_type, media_id, media_size, image_hash,
+                                            forms))
+        return messages
+
+    def export_jsonl(self, path):
+        return write_jsonl(self.messages(), path)
+
+    def import_jsonl(self, path):
+        return self.append(read_jsonl(path))
+
+
+def main():
+    from telegram_user_sync import TelegramUserSync
+
+    parser = argparse.ArgumentParser(description="Export or import the local Telegram channel archive")
+    parser.add_argument('action', choices=['export', 'import', 'count'])
+    parser.add_argument('path', nargs='?', help="JSONL file to write or read")
+    args = parser.parse_args()
+    if args.action != 'count' and not args.path:
+        parser.error(f"{args.action} needs a path")
+
+    sync = TelegramUserSync()
+    postgres_session = sync.open_postgres_session()
+    try:
+        archive = MessageArchive(postgres_session, sync.channel_username)
+        if args.action == 'export':
+            logging.info(f"Exported {archive.export_jsonl(args.path)} messages to {args.path}")
+        elif args.action == 'import':
+            logging.info(f"Imported {archive.import_jsonl(args.path)} messages from {args.path}")
+        else:
+            logging.info(f"{archive.count()} messages archived for {sync.channel_username}")
+    finally:
+        postgres_session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,121 @@ class CardUploadMetadata(db.Model):
             "season": self.season
         }
 
+# Progress of the Telegram channel sync (see telegram_user_sync.py)
+class TelegramSyncState(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    channel = db.Column(db.String(100), nullable=False, unique=True)
+    last_message_id = db.Column(BigInteger, nullable=True)  # Newest channel message already processed
+    last_card_id = db.Column(db.Integer, nullable=True)  # Newest MySQL files.id already processed
+    last_sync_at = db.Column(db.DateTime, nullable=True)
+    last_full_sync_at = db.Column(db.DateTime, nullable=True)
+
+    def present(self):
+        return {
+            "channel": self.channel,
+            "last_message_id": self.last_message_id,
+            "last_card_id": self.last_card_id,
+            "last_sync_at": self.last_sync_at.isoformat() if self.last_sync_at else None,
+            "last_full_sync_at": self.last_full_sync_at.isoformat() if self.last_full_sync_at else None
+        }
+
+# A Telegram sync requested through the API or the scheduler (see sync_jobs.py)
+class SyncJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    kind = db.Column(db.String(20), nullable=False)  # "incremental" or "full"
+    state = db.Column(db.String(20), nullable=False)  # queued, running, succeeded or failed
+    reason = db.Column(db.String(100), nullable=True)
+    progress = db.Column(db.JSON, nullable=True)  # Current stage, counts and seconds per stage, see TelegramUserSync.report()
+    error = db.Column(db.Text, nullable=True)
+    worker = db.Column(db.String(100), nullable=True)  # host:pid that ran it
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    duration = db.Column(db.Float, nullable=True)  # Seconds from start to finish
+
+    def present(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "reason": self.reason,
+            "progress": self.progress,
+            "error": self.error,
+            "worker": self.worker,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "duration": self.duration
+        }
+
+# Current holder of a cluster-wide role, e.g. the sync scheduler (see leader_election.py)
+class LeaderLease(db.Model):
+    name = db.Column(db.String(100), primary_key=True)
+    holder = db.Column(db.String(100), nullable=False)  # host:pid of the leader
+    backend_pid = db.Column(db.Integer, nullable=False)  # Postgres backend holding the advisory lock
+    term = db.Column(BigInteger, nullable=False, default=1)  # Fencing token: bumped at every election
+    acquired_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    renewed_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False)  # Others may depose the leader after this
+
+    def present(self):
+        return {
+            "name": self.name,
+            "holder": self.holder,
+            "backend_pid": self.backend_pid,
+            "term": self.term,
+            "acquired_at": self.acquired_at.isoformat() if self.acquired_at else None,
+            "renewed_at": self.renewed_at.isoformat() if self.renewed_at else None,
+            "expires_at": self.expires_at.isoformat() if self.expires_at else None
+        }
+
+# Local copy of the Telegram channel's messages (see message_archive.py)
+class ChannelMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    channel = db.Column(db.String(100), nullable=False)
+    message_id = db.Column(BigInteger, nullable=False)
+    date = db.Column(db.DateTime(timezone=True), nullable=False)
+    text = db.Column(db.Text, nullable=True)
+    # card_matcher.message_forms(text), as of normalization_version
+    lower_text = db.Column(db.Text, nullable=True)
+    tokens = db.Column(db.ARRAY(db.Text), nullable=True)  # Words of lower_text
+    normalized_text = db.Column(db.Text, nullable=True)  # Fuzzy-normalized text
+    normalization_version = db.Column(db.Integer, nullable=True)
+    media_type = db.Column(db.String(20), nullable=True)  # "photo" or "document"
+    media_id = db.Column(BigInteger, nullable=True)  # Telegram photo/document id
+    media_size = db.Column(BigInteger, nullable=True)  # Bytes (largest size of a photo)
+    image_hash = db.Column(BigInteger, nullable=True)  # perceptual_hash.dhash() of the photo, as a signed 64-bit value
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('channel', 'message_id'),
+        db.Index('ix_channel_message_media', 'media_type', 'media_id'),
+    )
+
+    def present(self):
+        return {
+            "message_id": self.message_id,
+            "date": self.date.isoformat() if self.date else None,
+            "text": self.text,
+            "media_type": self.media_type,
+            "media_id": self.media_id,
+            "media_size": self.media_size,
+            "image_hash": self.image_hash
+        }
+
+# card_matcher.card_patterns(), media_identity.media_key() and the image hash
+# of each card, recomputed when its name, file_id or the rules change
+class CardSearchPattern(db.Model):
+    card_id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Maps to MySQL files.id
+    name = db.Column(db.Text, nullable=False)  # The name the patterns were computed from
+    exact_patterns = db.Column(db.ARRAY(db.Text), nullable=False)
+    fuzzy_name = db.Column(db.Text, nullable=False)
+    tg_id = db.Column(db.Text, nullable=True)  # The file_id the media key was computed from
+    media_type = db.Column(db.String(20), nullable=True)
+    media_id = db.Column(BigInteger, nullable=True)
+    image_hash = db.Column(BigInteger, nullable=True)  # perceptual_hash.dhash() of the cached image, once it is cached
+    normalization_version = db.Column(db.Integer, nullable=False)
+
 # Token Model
 class AuthToken(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
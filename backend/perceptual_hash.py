@@ -0,0 +1,178 @@
+import io
+import logging
+import random
+import time
+from array import array
+
+from PIL import Image
+
+
+HASH_SIZE = 8  # dHash grid: HASH_SIZE rows of HASH_SIZE gradients, a 64-bit hash
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def dhash(image):
+    """64-bit difference hash of a Pillow image: one bit per horizontal brightness gradient.
+
+    Survives re-encoding, rescaling and mild color changes, so the same
+    artwork hashes the same (or within a few bits) whether it came from the
+    Bot API or a channel post.
+    """
+    image.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))  # Let the JPEG decoder downscale while decoding
+    pixels = list(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for column in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + column] < pixels[offset + column + 1])
+    return value
+
+
+def dhash_file(path):
+    with Image.open(path) as image:
+        return dhash(image)
+
+
+def dhash_files(paths):
+    """{key: dhash as a signed 64-bit value} of the images at {key: path}, leaving out unreadable ones"""
+    hashes = {}
+    for key, path in paths.items():
+        try:
+            hashes[key] = to_signed(dhash_file(path))
+        except Exception as e:
+            logging.debug(f"Could not hash {path}: {e}")
+    return hashes
+
+
+def dhash_bytes(data):
+    with Image.open(io.BytesIO(data)) as image:
+        return dhash(image)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def to_signed(value):
+    """A 64-bit hash as a Postgres BIGINT"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value):
+    return value & ((1 << 64) - 1)
+
+
+class HammingIndex:
+    """64-bit hashes searchable for everything within `max_distance` bits (multi-index hashing).
+
+    The hash is cut into max_distance + 1 bit ranges; by the pigeonhole
+    principle any hash within max_distance bits of the query equals it
+    exactly on at least one range. Each range has its own hash table, so a
+    search only compares against the few hashes sharing a range with the
+    query instead of all of them. Hashes are kept in a compact array by
+    position.
+    """
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        pieces = max_distance + 1
+        bounds = [HASH_BITS * piece // pieces for piece in range(pieces + 1)]
+        self.ranges = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]  # (shift, mask)
+        self.tables = [{} for _ in self.ranges]  # range value -> positions
+        self.hashes = array('Q')
+
+    def add(self, value):
+        """Index a hash; returns its position"""
+        position = len(self.hashes)
+        self.hashes.append(value)
+        for (shift, mask), table in zip(self.ranges, self.tables):
+            table.setdefault((value >> shift) & mask, []).append(position)
+        return position
+
+    def search(self, value):
+        """[(distance, position)] of the hashes within max_distance bits, closest first"""
+        seen = set()
+        found = []
+        for (shift, mask), table in zip(self.ranges, self.tables):
+            for position in table.get((value >> shift) & mask, ()):
+                if position in seen:
+                    continue
+                seen.add(position)
+                distance = hamming(value, self.hashes[position])
+                if distance <= self.max_distance:
+                    found.append((distance, position))
+        found.sort()
+        return found
+
+
+class ImageHashIndex:
+    """Channel messages by the perceptual hash (dhash) of their photo"""
+
+    def __init__(self, messages, max_distance):
+        self.messages = []  # Indexed message of each position in the HammingIndex
+        self.index = HammingIndex(max_distance)
+        for message in messages:
+            image_hash = getattr(message, 'image_hash', None)
+            if image_hash is None:
+                continue
+            self.index.add(to_unsigned(image_hash))
+            self.messages.append(message)
+        logging.debug(f"Image hash index: {len(self.messages)} photos in {len(messages)} messages")
+
+    def candidates(self, image_hash):
+        """[(distance, message)] of the photos within max_distance bits, closest and then newest first"""
+        if image_hash is None:
+            return []
+        found = [(distance, self.messages[position])
+                 for distance, position in self.index.search(to_unsigned(image_hash))]
+        found.sort(key=lambda candidate: (candidate[0], -candidate[1].date.timestamp()))
+        return found
+
+
+def _scan(hashes, value, max_distance):
+    """Reference implementation: compare against every hash"""
+    found = []
+    for position, other in enumerate(hashes):
+        distance = hamming(value, other)
+        if distance <= max_distance:
+            found.append((distance, position))
+    return found
+
+
+def _benchmark(card_count=3000, message_count=2000, max_distance=8):
+    """Multi-index hashing vs. full scan for every card against a synthetic channel"""
+    rng = random.Random(7)
+    message_hashes = [rng.getrandbits(HASH_BITS) for _ in range(message_count)]
+    card_hashes = []
+    for _ in range(card_count):
+        if rng.random() < 0.7:  # A re-encoded channel photo, a few bits off
+            value = rng.choice(message_hashes)
+            for _ in range(rng.randint(0, 6)):
+                value ^= 1 << rng.randrange(HASH_BITS)
+            card_hashes.append(value)
+        else:
+            card_hashes.append(rng.getrandbits(HASH_BITS))
+
+    started = time.perf_counter()
+    index = HammingIndex(max_distance)
+    for value in message_hashes:
+        index.add(value)
+    build_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    indexed = [index.search(value) for value in card_hashes]
+    indexed_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    scanned = [_scan(message_hashes, value, max_distance) for value in card_hashes]
+    scan_time = time.perf_counter() - started
+    assert indexed == [sorted(found) for found in scanned], "index disagrees with the full scan"
+
+    print(f"{card_count} cards x {message_count} photos, max distance {max_distance}")
+    print(f"index build          {build_time:8.3f} s")
+    print(f"indexed search       {indexed_time:8.3f} s ({sum(map(bool, indexed))} cards matched)")
+    print(f"full scan            {scan_time:8.3f} s")
+
+
+if __name__ == "__main__":
+    _benchmark()
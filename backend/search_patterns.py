@@ -0,0 +1,114 @@
+import logging
+from collections import namedtuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from card_matcher import NORMALIZATION_VERSION, CardPatterns, card_patterns
+from media_identity import media_key
+from models import CardSearchPattern
+
+
+UPSERT_BATCH_SIZE = 500
+
+# What the sync matches a card by: its CardPatterns, the media_key() of its file_id and the
+# perceptual_hash.dhash() of its image (either None when unknown)
+CardFingerprint = namedtuple('CardFingerprint', ['patterns', 'media_key', 'image_hash'], defaults=(None,))
+
+
+class PatternStore:
+    """CardFingerprints of the cards, persisted in card_search_pattern.
+
+    Fingerprints are computed once per card name and file_id: a card is only
+    recomputed when one of them changed since, or when
+    card_matcher.NORMALIZATION_VERSION was bumped. Cards whose image was not
+    cached yet get their image hash once it is.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.table = CardSearchPattern.__table__
+
+    def unhashed(self, cards):
+        """tg_ids of the cards whose fingerprints_for() will ask for an image hash, to compute them in one batch"""
+        stored = self._stored(cards)
+        tg_ids = []
+        for card in cards:
+            tg_id = card.get('tg_id') or None
+            entry = stored.get(card['id'])
+            if tg_id and (entry is None or entry[:3] != (card['name'] or "", tg_id, NORMALIZATION_VERSION)
+                          or entry[3].image_hash is None):
+                tg_ids.append(tg_id)
+        return list(dict.fromkeys(tg_ids))
+
+    def fingerprints_for(self, cards, image_hash=None):
+        """{card id: CardFingerprint} for cards with 'id', 'name' and 'tg_id', computing and storing missing or stale ones.
+
+        image_hash(tg_id) gives the (signed) image hash of a card's file, None while it is not available.
+        """
+        image_hash = image_hash or (lambda tg_id: None)
+        table = self.table
+        stored = self._stored(cards)
+
+        fingerprints = {}
+        changed = []
+        for card in cards:
+            name = card['name'] or ""
+            tg_id = card.get('tg_id') or None
+            entry = stored.get(card['id'])
+            if entry is not None and entry[:3] == (name, tg_id, NORMALIZATION_VERSION):
+                fingerprint = entry[3]
+                hashed = None
+                if fingerprint.image_hash is None and tg_id:
+                    hashed = image_hash(tg_id)  # The image may have been cached since
+                if hashed is None:
+                    fingerprints[card['id']] = fingerprint
+                    continue
+                fingerprint = fingerprint._replace(image_hash=hashed)
+            else:
+                fingerprint = CardFingerprint(card_patterns(name), media_key(tg_id) if tg_id else None,
+                                              image_hash(tg_id) if tg_id else None)
+            fingerprints[card['id']] = fingerprint
+            changed.append({
+                'card_id': card['id'],
+                'name': name,
+                'exact_patterns': fingerprint.patterns.exact,
+                'fuzzy_name': fingerprint.patterns.fuzzy,
+                'tg_id': tg_id,
+                'media_type': fingerprint.media_key[0] if fingerprint.media_key else None,
+                'media_id': fingerprint.media_key[1] if fingerprint.media_key else None,
+                'image_hash': fingerprint.image_hash,
+                'normalization_version': NORMALIZATION_VERSION,
+            })
+
+        for start in range(0, len(changed), UPSERT_BATCH_SIZE):
+            statement = insert(table).values(changed[start:start + UPSERT_BATCH_SIZE])
+            statement = statement.on_conflict_do_update(
+                index_elements=['card_id'],
+                set_={column: statement.excluded[column] for column in
+                      ('name', 'exact_patterns', 'fuzzy_name', 'tg_id', 'media_type', 'media_id',
+                       'image_hash', 'normalization_version')},
+            )
+            self.session.execute(statement)
+        if changed:
+            self.session.commit()
+            logging.info(f"Computed fingerprints for {len(changed)} of {len(cards)} cards")
+        return fingerprints
+
+    def _stored(self, cards):
+        """{card id: (name, tg_id, normalization version, CardFingerprint)} as stored"""
+        table = self.table
+        stored = {}
+        card_ids = [card['id'] for card in cards]
+        for start in range(0, len(card_ids), UPSERT_BATCH_SIZE):
+            rows = self.session.execute(
+                select(table.c.card_id, table.c.name, table.c.tg_id, table.c.normalization_version,
+                       table.c.exact_patterns, table.c.fuzzy_name, table.c.media_type, table.c.media_id,
+                       table.c.image_hash)
+                .where(table.c.card_id.in_(card_ids[start:start + UPSERT_BATCH_SIZE]))
+            )
+            for card_id, name, tg_id, version, exact, fuzzy, media_type, media_id, hashed in rows:
+                key = (media_type, media_id) if media_id is not None else None
+                stored[card_id] = (name, tg_id, version,
+                                   CardFingerprint(CardPatterns(list(exact), fuzzy), key, hashed))
+        return stored
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, select, update
+
+from models import SyncJob
+
+
+class SyncJobRunner:
+    """Runs Telegram syncs as background jobs recorded in the sync_job table.
+
+    submit() queues a job and returns right away; as state and progress are
+    kept in Postgres, any worker can report on any job (SyncJob.present()).
+    Only the worker for which `is_leader()` is true executes them (see
+    leader_election.py): its runner thread works through queued jobs oldest
+    first, all in one long-lived event loop with a single TelegramUserSync
+    (built by `sync_factory(on_progress)`) that keeps its Telegram
+    connection open between runs. The other workers' runners check again
+    every `poll_interval` seconds and take over once elected. A job still
+    queued absorbs further requests. Every job records how long it took
+    and how long each stage of it took (progress["timings"]). cancel() stops
+    the running job, e.g. when this worker is no longer the leader; a
+    worker only ever updates jobs it is still running, so it can't undo
+    the new leader failing the job it interrupted.
+    """
+
+    def __init__(self, session_factory, sync_factory, is_leader, poll_interval=2.0, on_finished=None):
+        self.session_factory = session_factory
+        self.sync_factory = sync_factory
+        self.is_leader = is_leader
+        self.poll_interval = poll_interval
+        self.on_finished = on_finished  # Called with the job's dict after it succeeded
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._leading = False
+        self._current_job_id = None
+        self._task = None  # (event loop, asyncio task) of the running job
+        self._cancel_reason = None
+        self._stage = None  # (name, started) of the running job's current stage
+        self._timings = {}  # Seconds spent in each finished stage of the running job
+        self._progress = {}  # Last reported stage and counts of the running job
+
+    def start(self):
+        """Start this worker's runner thread (once)"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name="telegram-sync-jobs", daemon=True)
+            self._thread.start()
+
+    def submit(self, full=False, reason=""):
+        """(job dict, created): a new queued job, or the one already queued (made a full sync if asked)"""
+        session = self.session_factory()
+        try:
+            job = session.execute(
+                select(SyncJob).where(SyncJob.state == 'queued').order_by(SyncJob.created_at).limit(1)
+                .with_for_update()
+            ).scalar_one_or_none()
+            created = job is None
+            if created:
+                job = SyncJob(
+                    id=uuid.uuid4().hex,
+                    kind='full' if full else 'incremental',
+                    state='queued',
+                    reason=reason[:100] or None,
+                    created_at=datetime.utcnow()
+                )
+                session.add(job)
+            elif full:
+                job.kind = 'full'
+            session.commit()
+            submitted = job.present()
+        finally:
+            session.close()
+
+        logging.info(f"Sync job {submitted['id']} ({submitted['kind']}) {'queued' if created else 'already queued'}"
+                     f"{f' for {reason}' if reason else ''}")
+        self.start()
+        self._wakeup.set()
+        return submitted, created
+
+    def submit_if_due(self, interval, retry_after=3600, reason="scheduled"):
+        """Queue a job unless one is queued or running, succeeded in the last `interval` seconds or
+        failed in the last `retry_after` seconds; returns the new job's dict or None"""
+        now = datetime.utcnow()
+        session = self.session_factory()
+        try:
+            recent = session.execute(
+                select(SyncJob.id).where(or_(
+                    SyncJob.state.in_(('queued', 'running')),
+                    and_(SyncJob.state == 'succeeded', SyncJob.finished_at > now - timedelta(seconds=interval)),
+                    and_(SyncJob.state == 'failed', SyncJob.finished_at > now - timedelta(seconds=retry_after)),
+                )).limit(1)
+            ).first()
+        finally:
+            session.close()
+        if recent is not None:
+            return None
+        return self.submit(reason=reason)[0]
+
+    def wake(self):
+        """Look for queued jobs now instead of at the next poll"""
+        self._wakeup.set()
+
+    def cancel(self, reason):
+        """Cancel the running job, if any (callable from any thread)"""
+        with self._lock:
+            if self._task is None:
+                return False
+            loop, task = self._task
+            self._cancel_reason = reason
+        logging.warning(f"Cancelling sync job {self._current_job_id}: {reason}")
+        loop.call_soon_threadsafe(task.cancel)
+        return True
+
+    def _loop(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        sync = None
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                if not self._acquire():
+                    continue
+                if sync is None:
+                    sync = self.sync_factory(self._report)
+                job = self._claim()
+                while job is not None:
+                    self._execute(loop, sync, job)
+                    job = self._claim() if self.is_leader() else None
+            except Exception as e:
+                logging.error(f"Sync job runner error: {e}", exc_info=True)
+
+    def _acquire(self):
+        """Whether this worker is to run jobs now"""
+        leading, self._leading = self._leading, self.is_leader()
+        if not self._leading or leading:
+            return self._leading
+        logging.info(f"Worker {self.worker} now runs the Telegram sync jobs")
+
+        # The previous leader is gone, and so are the jobs it was running
+        session = self.session_factory()
+        try:
+            interrupted = session.execute(
+                select(SyncJob).where(SyncJob.state == 'running', SyncJob.worker != self.worker)
+            ).scalars().all()
+            for job in interrupted:
+                job.state = 'failed'
+                job.error = f"Interrupted: worker {job.worker} is no longer the leader"
+                job.finished_at = datetime.utcnow()
+            session.commit()
+        finally:
+            session.close()
+        return True
+
+    def _claim(self):
+        """Mark the oldest queued job as running and return its dict, None if nothing is queued"""
+        session = self.session_factory()
+        try:
+            job = session.execute(
+                select(SyncJob).where(SyncJob.state == 'queued').order_by(SyncJob.created_at).limit(1)
+                .with_for_update(skip_locked=True)
+            ).scalar_one_or_none()
+            if job is None:
+                session.rollback()
+                return None
+            job.state = 'running'
+            job.worker = self.worker
+            job.started_at = datetime.utcnow()
+            job.progress = {'stage': 'starting'}
+            session.commit()
+            return job.present()
+        finally:
+            session.close()
+
+    def _execute(self, loop, sync, job):
+        logging.info(f"Running sync job {job['id']} ({job['kind']})")
+        started = time.monotonic()
+        self._current_job_id = job['id']
+        self._stage = ('starting', started)
+        self._timings = {}
+        self._progress = {'stage': 'starting'}
+        task = loop.create_task(sync.sync_messages_async(full=job['kind'] == 'full'))
+        with self._lock:
+            self._task = (loop, task)
+            self._cancel_reason = None
+        if not self.is_leader():
+            self.cancel(f"worker {self.worker} is no longer the leader")  # Deposed before the task existed
+        try:
+            success = loop.run_until_complete(task)
+            error = None if success else "Sync failed - check logs"
+        except asyncio.CancelledError:
+            success, error = False, f"Cancelled: {self._cancel_reason}"
+        except Exception as e:
+            logging.error(f"Sync job {job['id']} failed: {e}", exc_info=True)
+            success, error = False, str(e)
+        finally:
+            with self._lock:
+                self._task = None
+            self._current_job_id = None
+
+        state = 'succeeded' if success else 'failed'
+        duration = time.monotonic() - started
+        self._finish_stage()
+        if not self._update(job['id'], state=state, error=error, finished_at=datetime.utcnow(),
+                            duration=round(duration, 3), progress=dict(self._progress, timings=self._timings)):
+            logging.warning(f"Sync job {job['id']} was taken over by another worker, dropping its {state} result")
+            return
+        logging.info(f"Sync job {job['id']} {state} in {duration:.1f}s "
+                     f"({', '.join(f'{stage} {seconds:.1f}s' for stage, seconds in self._timings.items())})")
+        if success and self.on_finished is not None:
+            try:
+                self.on_finished(job)
+            except Exception as e:
+                logging.warning(f"Post-sync hook failed for job {job['id']}: {e}")
+
+    def _report(self, stage, counts):
+        """TelegramUserSync.on_progress: record the running job's progress"""
+        if self._current_job_id is None:
+            return
+        if stage != self._stage[0]:
+            self._finish_stage()
+            self._stage = (stage, time.monotonic())
+        self._progress = dict(counts, stage=stage)
+        self._update(self._current_job_id, progress=dict(self._progress, timings=self._timings))
+
+    def _finish_stage(self):
+        name, started = self._stage
+        self._timings[name] = round(self._timings.get(name, 0) + time.monotonic() - started, 3)
+
+    def _update(self, job_id, **values):
+        """Update a job this worker is running; False if it is not running here any more"""
+        session = self.session_factory()
+        try:
+            updated = session.execute(
+                update(SyncJob)
+                .where(SyncJob.id == job_id, SyncJob.state == 'running', SyncJob.worker == self.worker)
+                .values(**values)
+            ).rowcount
+            session.commit()
+            return bool(updated)
+        finally:
+            session.close()
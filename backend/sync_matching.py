@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from card_matcher import CardMatcher, FuzzyCorpus, card_patterns, fuzz, name_score
+from media_identity import MediaIdentityIndex
+from perceptual_hash import ImageHashIndex
+
+
+FUZZY_CHUNK_SIZE = 50  # Cards per fuzzy matching task
+
+# What match_cards() leaves to the fuzzy stage: the indexes (in cards) and fuzzy-normalized
+# names of the unmatched cards, the fuzzy-normalized message texts and the message position of each
+FuzzyWork = namedtuple('FuzzyWork', ['indexes', 'names', 'texts', 'positions'])
+
+
+class MatchingPool:
+    """Processes running the sync's CPU-bound stages, off the web worker's event loop (and gevent hub).
+
+    The processes are started on first use and kept between syncs; the
+    leader shuts them down when it steps down, and the next use starts
+    new ones. spawn rather than fork: the sync runs inside threaded/gevent
+    web workers.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    async def run(self, function, *args):
+        """function(*args) in one of the processes"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            future = asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        return await future
+
+    def shutdown(self):
+        """Stop the processes (callable from any thread); tasks still running finish, their results are dropped"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def match_cards(self, cards, messages, fingerprints, image_max_distance):
+        """(message position, strategy) for each card, (None, None) without a match.
+
+        match_cards() runs in one process, then the cards it left to the
+        fuzzy stage are scored in chunks spread over all of them.
+        """
+        matches, fuzzy = await self.run(match_cards, cards, messages, fingerprints, image_max_distance)
+        if fuzz is None:
+            logging.warning("fuzzywuzzy not installed, skipping fuzzy matching")
+            return matches
+        chunks = [fuzzy.names[start:start + FUZZY_CHUNK_SIZE] for start in range(0, len(fuzzy.names), FUZZY_CHUNK_SIZE)]
+        results = await asyncio.gather(*[self.run(fuzzy_match_chunk, fuzzy.texts, chunk) for chunk in chunks])
+        fuzzy_matches = [result for chunk in results for result in chunk]
+        for index, (position, score) in zip(fuzzy.indexes, fuzzy_matches):
+            if position is not None:
+                logging.info(f"Fuzzy match: '{cards[index]['name']}' with score {score}")
+                matches[index] = (fuzzy.positions[position], 'fuzzy')
+        return matches
+
+
+def match_cards(cards, messages, fingerprints, image_max_distance):
+    """([(message position, strategy)] for each card, FuzzyWork) after exact name, media identity and image matching.
+
+    fingerprints maps card ids to precomputed CardFingerprints (see
+    search_patterns.py). Everything here is CPU-bound, so the sync calls it
+    through MatchingPool.match_cards(); positions rather than messages come
+    back to keep the reply small. Cards without a match are (None, None).
+    """
+    matcher = CardMatcher(messages)
+    positions = {id(message): position for position, message in enumerate(messages)}
+    media_index = MediaIdentityIndex(messages)
+    image_index = ImageHashIndex(messages, image_max_distance)
+
+    matches = []
+    fuzzy_indexes = []  # Cards left for the fuzzy stage
+    fuzzy_names = []
+    for card in cards:
+        fingerprint = fingerprints.get(card['id'])
+        strategy = None
+
+        # Strategy 1: Exact name matching
+        match = matcher.exact_match(card['name'], fingerprint.patterns if fingerprint else None)
+        if match:
+            strategy = 'exact'
+
+        # Strategy 2: The message posting the card's photo/document, by the media id in its file_id
+        elif fingerprint and fingerprint.media_key:
+            match = media_index.match(fingerprint.media_key)
+            if match:
+                strategy = 'media'
+
+        # Strategy 3: The photo closest to the card's image (re-encoded copies hash alike);
+        # among equally close photos the one naming the card best wins
+        if match is None and fingerprint and fingerprint.image_hash is not None:
+            candidates = image_index.candidates(fingerprint.image_hash)
+            if candidates:
+                closest = [message for distance, message in candidates if distance == candidates[0][0]]
+                match = max(closest, key=lambda message: name_score(fingerprint.patterns.fuzzy, message))
+                strategy = 'image'
+
+        if match is None:
+            # Strategy 4: Fuzzy name matching for difficult cases, see MatchingPool.match_cards()
+            fuzzy_indexes.append(len(matches))
+            fuzzy_names.append((fingerprint.patterns if fingerprint else card_patterns(card['name'])).fuzzy)
+        matches.append((positions[id(match)], strategy) if match is not None else (None, None))
+
+    logging.debug(f"Matched {len(cards) - len(fuzzy_indexes)} of {len(cards)} cards before the fuzzy stage")
+    fuzzy = FuzzyWork(fuzzy_indexes, fuzzy_names, matcher.fuzzy_corpus.texts,
+                      [positions[id(entry.message)] for entry in matcher.entries])
+    return matches, fuzzy
+
+
+def fuzzy_match_chunk(texts, normalized_card_names):
+    """FuzzyCorpus.best_match() of each fuzzy-normalized card name against the fuzzy-normalized texts"""
+    corpus = FuzzyCorpus(texts)
+    return [corpus.best_match(name) for name in normalized_card_names]
@@ -0,0 +1,67 @@
+import logging
+
+from sqlalchemy import create_engine, literal_column, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+
+from config import Config
+from models import CardUploadMetadata
+
+
+# One engine (and connection pool) per process for the sync's Postgres work
+postgres_engine = create_engine(Config.SQLALCHEMY_DATABASE_URI, pool_pre_ping=True)
+PostgresSession = sessionmaker(bind=postgres_engine)
+
+METADATA_COLUMNS = ('telegram_message_id', 'upload_date', 'season')
+
+
+class MetadataWriter:
+    """Collects card_upload_metadata rows and writes them in bulk.
+
+    flush() applies everything with one multi-row
+    INSERT ... ON CONFLICT (card_id) DO UPDATE per batch, all in a single
+    transaction. Rows whose stored values already match are left alone (the
+    DO UPDATE is conditional), and the counts of inserted, updated and
+    unchanged rows are returned.
+    """
+
+    def __init__(self, session, batch_size=500):
+        self.session = session
+        self.batch_size = batch_size
+        self._rows = {}  # card_id -> row; a later add() for the same card wins
+
+    def add(self, card_id, telegram_message_id=None, upload_date=None, season=None):
+        self._rows[card_id] = {
+            'card_id': card_id,
+            'telegram_message_id': telegram_message_id,
+            'upload_date': upload_date,
+            'season': season,
+        }
+
+    def flush(self):
+        """Write the collected rows and commit: {'inserted': n, 'updated': n, 'unchanged': n}"""
+        table = CardUploadMetadata.__table__
+        rows = list(self._rows.values())
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        try:
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                statement = insert(table).values(batch)
+                statement = statement.on_conflict_do_update(
+                    index_elements=['card_id'],
+                    set_={column: statement.excluded[column] for column in METADATA_COLUMNS},
+                    where=or_(*[table.c[column].is_distinct_from(statement.excluded[column])
+                                for column in METADATA_COLUMNS]),
+                ).returning(literal_column('xmax = 0'))  # xmax is 0 for freshly inserted rows
+                written = [inserted for (inserted,) in self.session.execute(statement)]
+                counts['inserted'] += sum(1 for inserted in written if inserted)
+                counts['updated'] += sum(1 for inserted in written if not inserted)
+                counts['unchanged'] += len(batch) - len(written)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        self._rows = {}
+        logging.info(f"card_upload_metadata: {counts['inserted']} inserted, {counts['updated']} updated, "
+                     f"{counts['unchanged']} unchanged")
+        return counts
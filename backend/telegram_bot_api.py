@@ -0,0 +1,192 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import Config
+
+
+API_BASE = "https://api.telegram.org"
+
+
+class TelegramAPIError(Exception):
+    """The Bot API answered with ok=false or an unexpected HTTP status"""
+
+    def __init__(self, description, status_code=None):
+        super().__init__(description)
+        self.status_code = status_code
+
+
+class TelegramFileRejected(TelegramAPIError):
+    """Telegram refused to resolve a file_id (e.g. CgAC animations the bot can't fetch)"""
+
+
+class TelegramRateLimited(TelegramAPIError):
+    """Telegram answered 429; retry_after is the number of seconds it asked us to wait"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited by Telegram, retry after {retry_after}s", 429)
+        self.retry_after = retry_after
+
+
+def _retry_after(response):
+    try:
+        return float(response.json().get('parameters', {}).get('retry_after', 1))
+    except ValueError:
+        return float(response.headers.get('Retry-After', 1))
+
+
+class TTLCache:
+    """Small dict with per-entry expiry, dropping the oldest entries beyond max_entries"""
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+                while len(self._entries) >= self.max_entries:
+                    self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class BotAPIClient:
+    """Shared Telegram Bot API client.
+
+    All calls go through one requests.Session, so TLS connections to
+    api.telegram.org are kept alive and reused (under gevent the pool is
+    shared cooperatively by every greenlet of the worker). Every request has a
+    timeout; connection errors and 5xx answers are retried with exponential
+    backoff and jitter, and a 429 is waited out when Telegram's retry_after is
+    short, otherwise raised as TelegramRateLimited. getFile results are cached
+    for `file_path_ttl` seconds (Telegram keeps file links valid for an hour).
+    """
+
+    def __init__(self, token=None, timeout=(5.0, 30.0), max_retries=3, backoff=0.5,
+                 max_rate_limit_wait=5.0, file_path_ttl=3000.0, pool_size=20):
+        self._token = token
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_rate_limit_wait = max_rate_limit_wait
+        self.file_paths = TTLCache(file_path_ttl)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @property
+    def token(self):
+        token = self._token or os.getenv("CARDS_BOT_TOKEN")
+        if not token:
+            raise RuntimeError("CARDS_BOT_TOKEN environment variable is not set!")
+        return token
+
+    def call(self, method, **params):
+        """Call a Bot API method and return its `result`"""
+        response = self._request(f"{API_BASE}/bot{self.token}/{method}", params=params)
+        try:
+            payload = response.json()
+        except ValueError:
+            raise TelegramAPIError(f"{method} returned HTTP {response.status_code}: {response.text}",
+                                   response.status_code)
+        if response.status_code == 400 or not payload.get("ok"):
+            raise TelegramAPIError(payload.get('description', 'Unknown error'), response.status_code)
+        return payload.get("result")
+
+    def get_file_path(self, file_id):
+        """file_path of a file_id for download URLs, cached"""
+        file_path = self.file_paths.get(file_id)
+        if file_path is not None:
+            return file_path
+        try:
+            result = self.call("getFile", file_id=file_id)
+        except TelegramRateLimited:
+            raise
+        except TelegramAPIError as e:
+            if e.status_code == 400 or e.status_code == 200:
+                raise TelegramFileRejected(str(e), e.status_code)
+            raise
+        file_path = (result or {}).get("file_path")
+        if not file_path:
+            raise TelegramFileRejected("file_path not found")
+        self.file_paths.set(file_id, file_path)
+        return file_path
+
+    def open_file(self, file_id):
+        """Resolve and open a file download as a streamed response: (file_path, response)"""
+        for attempt in range(2):
+            file_path = self.get_file_path(file_id)
+            response = self._request(f"{API_BASE}/file/bot{self.token}/{file_path}", stream=True)
+            if response.status_code == 200:
+                return file_path, response
+            response.close()
+            # An expired file_path gives 404; resolve it again once
+            self.file_paths.discard(file_id)
+            if response.status_code != 404:
+                break
+        raise TelegramAPIError(f"Download failed with HTTP {response.status_code}", response.status_code)
+
+    def get(self, url, **kwargs):
+        """Plain GET through the pooled session (e.g. avatar URLs), with the default timeout"""
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def _request(self, url, params=None, stream=False):
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(url, params=params, stream=stream, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                self._sleep_backoff(attempt, e)
+                attempt += 1
+                continue
+
+            if response.status_code == 429:
+                retry_after = _retry_after(response)
+                response.close()
+                if retry_after > self.max_rate_limit_wait or attempt >= self.max_retries:
+                    raise TelegramRateLimited(retry_after)
+                time.sleep(retry_after)
+                attempt += 1
+                continue
+            if response.status_code >= 500 and attempt < self.max_retries:
+                response.close()
+                self._sleep_backoff(attempt, f"HTTP {response.status_code}")
+                attempt += 1
+                continue
+            return response
+
+    def _sleep_backoff(self, attempt, reason):
+        delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+        logging.debug(f"Retrying Telegram request in {delay:.2f}s after {reason}")
+        time.sleep(delay)
+
+
+bot_api = BotAPIClient(
+    timeout=(Config.TELEGRAM_CONNECT_TIMEOUT, Config.TELEGRAM_READ_TIMEOUT),
+    max_retries=Config.TELEGRAM_MAX_RETRIES,
+    file_path_ttl=Config.TELEGRAM_FILE_PATH_TTL,
+)
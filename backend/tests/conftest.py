@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import sys
+
+# The backend modules import each other by their flat names and read Config at import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN_HASH", "test")
+
+import pytest
+from flask import Flask
+from sqlalchemy import event
+
+from models import db
+
+
+class MySQLOnSQLite:
+    """Stands in for a pymysql connection with DictCursor, backed by an in-memory SQLite database.
+
+    Only translates the %s placeholders; the queries in this repo are plain enough for that.
+    """
+
+    def __init__(self, schema):
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.db.row_factory = lambda cursor, row: {column[0]: value for column, value in zip(cursor.description, row)}
+        self.db.executescript(schema)
+        self.statements = []
+        self.closed = 0
+
+    def insert(self, table, rows):
+        for row in rows:
+            columns = ', '.join(row)
+            placeholders = ', '.join('?' * len(row))
+            self.db.execute(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", tuple(row.values()))
+
+    def execute(self, sql, params=()):
+        self.db.execute(sql, params)
+
+    def connect(self):
+        """connection_factory for the code under test"""
+        return _Connection(self)
+
+
+class _Connection:
+    def __init__(self, server):
+        self.server = server
+
+    def cursor(self):
+        return _Cursor(self.server)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.server.closed += 1
+
+
+class _Cursor:
+    def __init__(self, server):
+        self.server = server
+        self._cursor = server.db.cursor()
+
+    def execute(self, sql, params=()):
+        self.server.statements.append(sql)
+        self._cursor.execute(sql.replace('%s', '?'), tuple(params or ()))
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@pytest.fixture
+def app_db(tmp_path):
+    """models.db inside the app context of a Flask app on a fresh SQLite database (tables are up to the test)"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'test.db'}"
+    db.init_app(app)
+    with app.app_context():
+        yield db
+        db.session.remove()
+
+
+@pytest.fixture
+def count_queries():
+    """count_queries(engine) -> list collecting every statement run on the engine from then on"""
+    listeners = []
+
+    def start(engine):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        listeners.append((engine, before_cursor_execute))
+        return statements
+
+    yield start
+    for engine, listener in listeners:
+        event.remove(engine, 'before_cursor_execute', listener)
@@ -0,0 +1,60 @@
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from card_matcher import (CardMatcher, _scan_exact_match, _scan_fuzzy_match, card_patterns, message_forms)
+
+
+Message = namedtuple('Message', ['id', 'text', 'date'])
+
+START = datetime(2024, 1, 1)
+
+
+def channel(*texts):
+    return [Message(position, text, START + timedelta(days=position)) for position, text in enumerate(texts)]
+
+
+def test_exact_match_takes_the_newest_message():
+    messages = channel("New card: Golden Dragon", "nothing here", "Golden Dragon is back!", None)
+    matcher = CardMatcher(messages)
+    assert matcher.exact_match("Golden Dragon").id == 2
+    assert matcher.exact_match("Silver Dragon") is None
+    assert matcher.exact_match("") is None
+
+
+def test_parenthesized_parts_are_optional():
+    assert "golden dragon" in card_patterns("Golden Dragon (Limited)").exact
+    matcher = CardMatcher(channel("golden dragon"))
+    assert matcher.exact_match("Golden Dragon (Limited)").id == 0
+
+
+def test_precomputed_forms_and_patterns():
+    class Archived(namedtuple('Archived', ['id', 'text', 'date', 'forms'])):
+        pass
+    messages = [Archived(0, "Card: Blue Whale", START, message_forms("Card: Blue Whale"))]
+    matcher = CardMatcher(messages)
+    assert matcher.exact_match("Blue Whale", card_patterns("Blue Whale")).id == 0
+
+
+def test_fuzzy_match():
+    matcher = CardMatcher(channel("Meet the mighty golden dragonn of the north", "unrelated text"))
+    message, score = matcher.fuzzy_match("Golden Dragon")
+    assert message.id == 0 and score > 70
+    assert matcher.fuzzy_match("Completely different") == (None, 0)
+
+
+def test_indexes_agree_with_full_scan():
+    rng = random.Random(5)
+    words = ["alpha", "beta", "gamma", "delta", "omega", "sigma", "kappa", "zeta", "theta", "iota"]
+    names = [" ".join(rng.sample(words, rng.randint(1, 3))) for _ in range(60)]
+    texts = []
+    for _ in range(80):
+        text = " ".join(rng.sample(words, 4))
+        if rng.random() < 0.5:
+            text = f"Card: {rng.choice(names).title()} - {text}"
+        texts.append(text)
+    messages = channel(*texts)
+    matcher = CardMatcher(messages)
+    for name in names:
+        assert matcher.exact_match(name) == _scan_exact_match(name, messages)
+        assert matcher.fuzzy_match(name)[0] == _scan_fuzzy_match(name, messages)
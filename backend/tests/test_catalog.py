@@ -0,0 +1,121 @@
+import pytest
+
+from catalog import CatalogStore, decode_cursor, encode_cursor
+from conftest import MySQLOnSQLite
+
+
+SCHEMA = "CREATE TABLE files (id INTEGER PRIMARY KEY, tg_id TEXT, name TEXT, rare TEXT, fame INTEGER, shop TEXT)"
+
+
+def card(card_id, name=None, rare='common', fame=None, shop='-'):
+    return {'id': card_id, 'tg_id': f'file{card_id}', 'name': name or f'card {card_id}',
+            'rare': rare, 'fame': fame, 'shop': shop}
+
+
+@pytest.fixture
+def mysql():
+    server = MySQLOnSQLite(SCHEMA)
+    server.insert('files', [card(1, fame=5), card(2, rare='rare', shop='100'), card(3, name='test'),
+                            card(4, rare='hidden'), card(5, fame=1)])
+    return server
+
+
+@pytest.fixture
+def store(mysql):
+    metadata_calls = []
+
+    def metadata_loader(card_ids=None):
+        metadata_calls.append(card_ids)
+        return {1: ('2024-01-01T00:00:00', 2)}
+    metadata_state = [0]
+    store = CatalogStore(mysql.connect, metadata_loader, hidden_names=['test'], hidden_rarities=['hidden'],
+                         probe_interval=0, metadata_probe=lambda: metadata_state[0])
+    store.metadata_calls = metadata_calls
+    store.metadata_state = metadata_state
+    return store
+
+
+def test_reload_hides_cards(store):
+    snapshot = store.get()
+    assert sorted(snapshot.by_id) == [1, 2, 5]
+    assert snapshot.get(1).upload_date == '2024-01-01T00:00:00' and snapshot.get(1).season == 2
+    assert snapshot.get(5).season == 1
+    assert snapshot.get(2).in_shop and not snapshot.get(1).in_shop
+
+
+def test_appended_cards_extend_the_snapshot(store, mysql):
+    first = store.get()
+    mysql.insert('files', [card(6), card(7, rare='hidden'), card(8, name='test')])
+    snapshot = store.get()
+    assert snapshot.version == first.version + 1
+    assert sorted(snapshot.by_id) == [1, 2, 5, 6]
+    assert store.metadata_calls[-1] == [6]  # Only the new visible card's metadata
+    assert sorted(first.by_id) == [1, 2, 5]  # Readers of the old snapshot are unaffected
+
+
+def test_other_changes_reload(store, mysql):
+    store.get()
+    mysql.execute("DELETE FROM files WHERE id = 1")
+    mysql.insert('files', [card(6)])
+    assert sorted(store.get().by_id) == [2, 5, 6]
+    assert store.metadata_calls[-1] is None  # A full reload
+
+
+def test_unchanged_catalog_is_only_probed(store, mysql):
+    first = store.get()
+    mysql.statements.clear()
+    assert store.get() is first
+    assert len(mysql.statements) == 1
+
+
+def test_metadata_changes_reload(store, mysql):
+    first = store.get()
+    assert store.get() is first
+    store.metadata_state[0] = 1  # e.g. the sync leader wrote new upload dates
+    snapshot = store.get()
+    assert snapshot.version == first.version + 1
+    assert store.metadata_calls[-1] is None  # A full reload
+    assert store.get() is snapshot
+
+
+def test_keyset_pages(store):
+    snapshot = store.get()
+    cards, key = snapshot.page('all', 'fame', 'desc', limit=2)
+    assert [c.id for c in cards] == [1, 5]
+    cursor = encode_cursor('fame', 'desc', key)
+    cards, key = snapshot.page('all', 'fame', 'desc', after=decode_cursor(cursor, 'fame', 'desc'), limit=2)
+    assert [c.id for c in cards] == [2]
+    assert key is None
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, 'name', 'desc')
+
+
+def test_empty_and_owned_pages(store):
+    snapshot = store.get()
+    assert snapshot.page('all', limit=0) == ([], None)
+    cards, key = snapshot.page('all', limit=1)
+    assert snapshot.page('all', after=key, limit=0) == ([], key)
+
+    cards, key = snapshot.page('all', limit=1, owned={1, 5})
+    assert [c.id for c in cards] == [5]
+    cards, key = snapshot.page('all', after=key, limit=1, owned={1, 5})
+    assert [c.id for c in cards] == [1]
+    assert key is None
+    assert snapshot.page('all', limit=1, owned={1})[1] is None
+    assert snapshot.page('all', limit=1, owned=set()) == ([], None)
+
+
+def test_categories(store):
+    snapshot = store.get()
+    assert [c.id for c in snapshot.cards_in_category('shop')] == [2]
+    assert [c.id for c in snapshot.cards_in_category('rarity_rare')] == [2]
+    assert snapshot.cards_in_category('rarity_hidden') is None
+
+
+def test_extend_and_reload_agree_on_null_names(store, mysql):
+    store.get()
+    mysql.insert('files', [dict(card(6), name=None), dict(card(7), rare=None), card(8)])
+    extended = store.get()
+    assert sorted(extended.by_id) == [1, 2, 5, 8]
+    store.invalidate()
+    assert sorted(store.get().by_id) == sorted(extended.by_id)
@@ -0,0 +1,82 @@
+import gc
+
+import pytest
+
+import db_pool
+from db_pool import MySQLConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.rollbacks = 0
+
+    def cursor(self, *args, **kwargs):
+        return 'cursor'
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    opened = []
+
+    def connect(**kwargs):
+        opened.append(FakeConnection())
+        return opened[-1]
+    monkeypatch.setattr(db_pool.pymysql, 'connect', connect)
+    pool = MySQLConnectionPool({}, max_size=2, checkout_timeout=0.05)
+    pool.opened = opened
+    return pool
+
+
+def test_close_returns_the_connection(pool):
+    connection = pool.connection()
+    connection.close()
+    connection.close()  # Closing twice doesn't return it twice
+    assert pool.connection()._raw is pool.opened[0]
+    assert pool.opened[0].rollbacks == 1
+    assert pool.stats()['created'] == 1
+
+
+def test_exhausted_pool_times_out(pool):
+    held = [pool.connection(), pool.connection()]
+    with pytest.raises(PoolTimeout):
+        pool.connection()
+    held[0].close()
+    assert pool.connection() is not None
+
+
+def test_unclosed_connection_is_reclaimed(pool):
+    for _ in range(5):
+        connection = pool.connection()
+        connection.cursor()
+        del connection
+        gc.collect()
+
+    stats = pool.stats()
+    assert stats['leaked'] == 5
+    assert stats['in_use'] == 0
+    assert all(raw.closed for raw in pool.opened)  # Mid-transaction state is never reused
+
+
+def test_used_after_close(pool):
+    connection = pool.connection()
+    connection.close()
+    with pytest.raises(db_pool.pymysql.err.InterfaceError):
+        connection.cursor()
+
+
+def test_operational_error_discards(pool):
+    with pytest.raises(db_pool.pymysql.err.OperationalError):
+        with pool.connection():
+            raise db_pool.pymysql.err.OperationalError(2013, "Lost connection")
+    assert pool.opened[0].closed
+    assert pool.stats()['size'] == 0
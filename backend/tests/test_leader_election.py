@@ -0,0 +1,62 @@
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from leader_election import LeaderElection, LeadershipLost
+
+
+class FakeResult:
+    def __init__(self, row):
+        self.row = row
+
+    def first(self):
+        return self.row
+
+
+class FakeSession:
+    """Answers fence()'s lease query with `row`"""
+
+    def __init__(self, row):
+        self.row = row
+        self.queries = []
+
+    def execute(self, statement, params):
+        self.queries.append(params)
+        return FakeResult(self.row)
+
+
+def leader(term=3):
+    election = LeaderElection(None, "telegram-sync")
+    election.is_leader = True
+    election.term = term
+    return election
+
+
+def test_fence_checks_the_term():
+    session = FakeSession((1,))
+    leader().fence(session)
+    assert session.queries == [{"name": "telegram-sync", "holder": leader().identity, "term": 3}]
+
+
+def test_fence_raises_once_the_lease_is_lost():
+    with pytest.raises(LeadershipLost):
+        leader().fence(FakeSession(None))
+
+    election = leader()
+    election.is_leader, election.term = False, None
+    session = FakeSession((1,))
+    with pytest.raises(LeadershipLost):
+        election.fence(session)
+    assert session.queries == []
+
+
+def test_fence_aborts_commits():
+    election = leader()
+    election.is_leader = False
+    session = sessionmaker(bind=create_engine("sqlite://"))()
+    event.listen(session, 'before_commit', election.fence)
+    try:
+        with pytest.raises(LeadershipLost):
+            session.commit()
+    finally:
+        session.close()
@@ -0,0 +1,181 @@
+import os
+import threading
+
+import pytest
+
+import media_cache
+from media_cache import MediaCache, MediaIndex, SingleFlight
+from telegram_bot_api import TelegramFileRejected
+
+
+class FakeResponse:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.headers = {'Content-Length': str(sum(map(len, chunks)))}
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        yield from self.chunks
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeBotAPI:
+    def __init__(self, files):
+        self.files = files  # file_id -> (file_path, bytes)
+        self.opened = []
+        self.responses = []
+
+    def open_file(self, file_id):
+        self.opened.append(file_id)
+        if file_id not in self.files:
+            raise TelegramFileRejected("Bad Request: wrong file_id", 400)
+        file_path, data = self.files[file_id]
+        self.responses.append(FakeResponse([data[:3], data[3:]]))
+        return file_path, self.responses[-1]
+
+
+@pytest.fixture
+def bot_api():
+    return FakeBotAPI({
+        'photo_file_1': ('photos/a.jpg', b'image bytes'),
+        'photo_file_2': ('photos/b.jpg', b'image bytes'),  # Same artwork, other file_id
+        'video_file_1': ('videos/c.mp4', b'video bytes, longer'),
+    })
+
+
+@pytest.fixture
+def make_cache(tmp_path, bot_api):
+    def make(**kwargs):
+        return MediaCache(str(tmp_path / 'images'), str(tmp_path / 'videos'), str(tmp_path / 'index.sqlite3'),
+                          bot_api=bot_api, **kwargs)
+    return make
+
+
+def test_fetch_downloads_once_and_deduplicates(make_cache, bot_api):
+    cache = make_cache()
+    first = cache.fetch('photo_file_1')
+    assert open(first.path, 'rb').read() == b'image bytes'
+    assert cache.fetch('photo_file_1') == first
+    second = cache.fetch('photo_file_2')
+    assert second.path == first.path and second.etag == first.etag
+    assert cache.fetch('video_file_1').kind == 'video'
+    assert bot_api.opened == ['photo_file_1', 'photo_file_2', 'video_file_1']
+    stats = cache.stats()
+    assert (stats['entries'], stats['file_ids'], stats['deduplicated_downloads']) == (2, 3, 1)
+
+
+def test_rejected_file_ids_are_remembered(make_cache, bot_api):
+    cache = make_cache()
+    assert cache.fetch('unknown_file') is None
+    assert cache.fetch('unknown_file') is None
+    assert cache.fetch('../../etc/passwd') is None
+    assert bot_api.opened == ['unknown_file']
+
+
+def test_budget_evicts_least_recently_used(make_cache):
+    cache = make_cache(max_bytes=25, low_watermark=1.0)
+    image = cache.fetch('photo_file_1')
+    video = cache.fetch('video_file_1')
+    assert not os.path.exists(image.path)
+    assert os.path.exists(video.path)
+    assert cache.lookup('photo_file_1') is None
+
+
+def test_streaming_relays_and_stores(make_cache, bot_api):
+    cache = make_cache()
+    result = cache.fetch_streaming('photo_file_1')
+    assert result[0] == 'stream' and result[3] == len(b'image bytes')
+    assert b''.join(result[1]) == b'image bytes'
+    assert bot_api.responses[0].closed
+    assert cache.fetch_streaming('photo_file_1')[0] == 'file'
+
+
+def test_reconcile_migrates_file_id_named_files(make_cache, tmp_path):
+    cache = make_cache()
+    legacy = tmp_path / 'images' / 'legacyfile_1.jpg'
+    legacy.write_bytes(b'old image')
+    cache.reconcile()
+    media = cache.lookup('legacyfile_1')
+    assert media is not None and open(media.path, 'rb').read() == b'old image'
+    assert not legacy.exists()
+
+    os.unlink(media.path)
+    cache.reconcile()
+    assert cache.index.resolve('legacyfile_1') is None
+
+
+def test_single_flight_shares_one_call():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'done'
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do('key', work)))
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=lambda: results.append(flights.do('key', work)))
+    follower.start()
+    release.set()
+    leader.join()
+    follower.join()
+    assert results == ['done', 'done'] and calls == [1]
+
+
+def test_unread_stream_releases_the_download(make_cache, bot_api, tmp_path):
+    cache = make_cache()
+    result = cache.fetch_streaming('photo_file_1')
+    result[1].close()  # A HEAD request: never iterated
+    assert bot_api.responses[0].closed
+    assert not [name for name in os.listdir(tmp_path / 'images') if name.startswith('.tmp-')]
+
+    # The flight is over: the next request downloads again instead of waiting forever
+    result = cache.fetch_streaming('photo_file_1')
+    assert result[0] == 'stream'
+    assert b''.join(result[1]) == b'image bytes'
+
+
+def test_stream_closed_midway_is_abandoned(make_cache, bot_api, tmp_path):
+    cache = make_cache()
+    _, chunks, _, _ = cache.fetch_streaming('photo_file_1')
+    assert next(iter(chunks)) == b'ima'
+    assert 'photo_file_1' in cache._flights._calls
+    chunks.close()
+    assert 'photo_file_1' not in cache._flights._calls
+    assert bot_api.responses[0].closed
+    assert cache.lookup('photo_file_1') is None
+    assert not [name for name in os.listdir(tmp_path / 'images') if name.startswith('.tmp-')]
+
+
+def test_reconcile_skips_files_that_vanish(make_cache, tmp_path, monkeypatch):
+    cache = make_cache()
+    (tmp_path / 'images' / 'legacyfile_1.jpg').write_bytes(b'old image')
+    (tmp_path / 'images' / 'legacyfile_2.jpg').write_bytes(b'other image')
+
+    file_sha256 = media_cache.file_sha256
+
+    def migrated_meanwhile(path):
+        if path.endswith('legacyfile_1.jpg'):
+            os.unlink(path)  # Another worker got there first
+        return file_sha256(path)
+    monkeypatch.setattr(media_cache, 'file_sha256', migrated_meanwhile)
+    cache.reconcile()
+    assert cache.index.resolve('legacyfile_1') is None
+    assert cache.lookup('legacyfile_2') is not None
+
+
+def test_index_creates_its_directory(tmp_path):
+    index = MediaIndex(str(tmp_path / 'missing' / 'media_index.sqlite3'))
+    assert index.resolve('unknown') is None
@@ -0,0 +1,43 @@
+import io
+
+from PIL import Image
+
+from media_cache import MediaCache
+from media_derivatives import DerivativeGenerator, parse_accept, variant_kind
+from test_media_cache import FakeBotAPI
+
+
+def jpeg_bytes(size=(600, 900)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def make_generator(tmp_path, **kwargs):
+    cache = MediaCache(str(tmp_path / 'images'), str(tmp_path / 'videos'), str(tmp_path / 'index.sqlite3'),
+                       bot_api=FakeBotAPI({'card_image_1': ('photos/a.jpg', jpeg_bytes())}))
+    return cache, DerivativeGenerator(cache, widths=(160, 480), **kwargs)
+
+
+def test_variants_are_resized_and_reused(tmp_path):
+    cache, derivatives = make_generator(tmp_path)
+    original = cache.fetch('card_image_1')
+    variant = derivatives.get(original, derivatives.snap_width(200), 'jpg')
+    with Image.open(variant.path) as image:
+        assert image.size == (480, 720)
+    assert derivatives.get(original, 480, 'jpg') == variant
+
+
+def test_pregenerate(tmp_path):
+    cache, derivatives = make_generator(tmp_path, pregenerate_pause=0)
+    original = cache.fetch('card_image_1')
+    derivatives.pregenerate(original, widths=(160,))
+    for suffix in derivatives.formats:
+        assert cache.lookup_variant(original.content_hash, variant_kind(160, suffix)) is not None
+
+
+def test_negotiate(tmp_path):
+    _, derivatives = make_generator(tmp_path)
+    assert parse_accept('image/webp,image/*;q=0.8') == {'image/webp': 1.0, 'image/*': 0.8}
+    assert derivatives.negotiate('text/html') == 'jpg'
+    assert derivatives.negotiate('image/webp;q=0.5') == 'webp'
@@ -0,0 +1,44 @@
+import base64
+import struct
+from collections import namedtuple
+from datetime import datetime
+
+from media_identity import FILE_REFERENCE_FLAG, MediaIdentityIndex, media_key
+
+
+def bot_file_id(file_type, media_id, dc_id=2, file_reference=b'ref!'):
+    """A version 4 Bot API file_id, as the Bot API encodes it"""
+    data = struct.pack('<ii', file_type | (FILE_REFERENCE_FLAG if file_reference is not None else 0), dc_id)
+    if file_reference is not None:
+        data += bytes([len(file_reference)]) + file_reference + b'\0' * (-(1 + len(file_reference)) % 4)
+    data += struct.pack('<qq', media_id, 1234) + bytes([40, 4])
+    encoded = bytearray()
+    zeros = 0
+    for byte in data + b'\x01':  # Sentinel flushing a trailing run of zeros
+        if byte == 0 and zeros < 255:
+            zeros += 1
+            continue
+        if zeros:
+            encoded += bytes([0, zeros])
+            zeros = 0
+        encoded.append(byte)
+    return base64.urlsafe_b64encode(bytes(encoded[:-1])).decode().rstrip('=')
+
+
+def test_media_key():
+    assert media_key(bot_file_id(2, 5366)) == ('photo', 5366)
+    assert media_key(bot_file_id(4, -99, file_reference=None)) == ('document', -99)
+    assert media_key(bot_file_id(2, 5366, dc_id=9)) is None
+    assert media_key(bot_file_id(1, 5366)) is None  # A thumbnail
+    assert media_key("not a file id") is None
+
+
+def test_index_prefers_the_newest_message():
+    Message = namedtuple('Message', ['message_id', 'media_type', 'media_id', 'date'])
+    messages = [Message(1, 'photo', 7, datetime(2024, 1, 1)), Message(2, 'photo', 7, datetime(2024, 1, 2)),
+                Message(3, None, None, datetime(2024, 1, 3))]
+    index = MediaIdentityIndex(messages)
+    assert index.match(('photo', 7)).message_id == 2
+    assert index.match(['photo', 7]).message_id == 2
+    assert index.match(('document', 7)) is None
+    assert index.match(None) is None
@@ -0,0 +1,53 @@
+import asyncio
+import os
+
+import pytest
+
+from card_matcher import card_patterns
+from message_archive import read_jsonl, write_jsonl
+from perceptual_hash import to_signed
+from search_patterns import CardFingerprint
+from sync_matching import MatchingPool
+from telegram_user_sync import TelegramUserSync
+
+
+ARCHIVE = os.path.join(os.path.dirname(__file__), 'fixtures', 'channel_archive.jsonl')
+
+
+@pytest.fixture
+def messages():
+    return read_jsonl(ARCHIVE)
+
+
+def test_read_recorded_archive(messages):
+    assert [message.id for message in messages] == list(range(1001, 1009))
+    assert messages[0].date.utcoffset() is not None
+    assert (messages[0].media_type, messages[0].media_id) == ('photo', 5530001)
+    assert messages[1].image_hash is None
+
+
+def test_jsonl_round_trip(messages, tmp_path):
+    path = str(tmp_path / 'archive.jsonl')
+    assert write_jsonl(messages, path) == len(messages)
+    assert read_jsonl(path) == messages
+
+
+def test_match_cards_against_the_archive(messages):
+    cards = [
+        {'id': 1, 'name': 'Golden Dragon', 'tg_id': None},
+        {'id': 2, 'name': 'Tony Stark', 'tg_id': None},
+        {'id': 3, 'name': 'Silver Fox', 'tg_id': 'a'},  # Posted without a name
+        {'id': 4, 'name': 'Ночной Волк', 'tg_id': 'b'},  # Re-encoded copy of a posted photo
+        {'id': 5, 'name': 'Железный Человек', 'tg_id': None},  # Misspelled in the post
+        {'id': 6, 'name': 'Unknown Card', 'tg_id': None},
+    ]
+    fingerprints = {card['id']: CardFingerprint(card_patterns(card['name']), None) for card in cards}
+    fingerprints[3] = fingerprints[3]._replace(media_key=('photo', 5530004))
+    fingerprints[4] = fingerprints[4]._replace(image_hash=to_signed(0x0f0f0f0f33cc33cc ^ 0b101))
+
+    pool = MatchingPool(2)
+    try:
+        matches = asyncio.run(TelegramUserSync(matching_pool=pool).match_cards(cards, messages, fingerprints))
+    finally:
+        pool.shutdown()
+    assert [match.id if match else None for match in matches] == [1007, 1003, 1004, 1005, 1006, None]
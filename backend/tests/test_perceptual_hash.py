@@ -0,0 +1,69 @@
+import io
+import random
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+from PIL import Image, ImageDraw
+
+from perceptual_hash import (HASH_BITS, HammingIndex, ImageHashIndex, _scan, dhash, dhash_bytes, dhash_files, hamming,
+                             to_signed, to_unsigned)
+
+
+def artwork(size=(320, 480)):
+    image = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(image)
+    for i in range(8):
+        draw.ellipse([i * 30, i * 40, i * 30 + 120, i * 40 + 90], fill=(i * 30, 255 - i * 30, 90))
+    return image
+
+
+def jpeg(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def test_dhash_survives_reencoding_and_scaling():
+    original = dhash(artwork())
+    assert hamming(original, dhash_bytes(jpeg(artwork(), 40))) <= 4
+    assert hamming(original, dhash(artwork().resize((160, 240)))) <= 4
+    assert hamming(original, dhash(Image.new('RGB', (320, 480), 'gray'))) > 8
+
+
+def test_signed_round_trip():
+    for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+        assert -(1 << 63) <= to_signed(value) < 1 << 63
+        assert to_unsigned(to_signed(value)) == value
+
+
+
+def test_dhash_files_skips_unreadable(tmp_path):
+    image = tmp_path / "card.png"
+    artwork().save(image)
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+    hashes = dhash_files({'a': str(image), 'b': str(broken), 'c': str(tmp_path / "missing.png")})
+    assert hashes == {'a': to_signed(dhash(artwork()))}
+
+
+def test_index_agrees_with_full_scan():
+    rng = random.Random(3)
+    hashes = [rng.getrandbits(HASH_BITS) for _ in range(500)]
+    index = HammingIndex(max_distance=8)
+    for value in hashes:
+        index.add(value)
+    for _ in range(200):
+        value = rng.choice(hashes)
+        for _ in range(rng.randint(0, 10)):
+            value ^= 1 << rng.randrange(HASH_BITS)
+        assert index.search(value) == sorted(_scan(hashes, value, 8))
+
+
+def test_image_hash_index_prefers_closest_then_newest():
+    def message(message_id, image_hash, day):
+        return SimpleNamespace(message_id=message_id, image_hash=to_signed(image_hash),
+                               date=datetime(2024, 1, day, tzinfo=timezone.utc))
+    messages = [message(1, 0b1111, 1), message(2, 0b1110, 2), message(3, 0b1111, 3), SimpleNamespace(image_hash=None)]
+    index = ImageHashIndex(messages, max_distance=2)
+    assert [(distance, m.message_id) for distance, m in index.candidates(to_signed(0b1111))] == [(0, 3), (0, 1), (1, 2)]
+    assert index.candidates(None) == []
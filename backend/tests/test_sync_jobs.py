@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import SyncJob
+from sync_jobs import SyncJobRunner
+
+
+class FakeSync:
+    def __init__(self, on_progress, fail=False, duration=0.01):
+        self.on_progress = on_progress
+        self.fail = fail
+        self.duration = duration
+        self.runs = []
+
+    async def sync_messages_async(self, full=False):
+        self.runs.append(full)
+        self.on_progress('fetching', {'messages': 10})
+        await asyncio.sleep(self.duration)
+        self.on_progress('matching', {'messages': 10, 'cards': 3})
+        if self.fail:
+            raise RuntimeError("Telegram is down")
+        return True
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.db'}")
+    SyncJob.__table__.create(engine)
+    return sessionmaker(engine)
+
+
+def make_runner(session_factory, leader=True, **kwargs):
+    syncs = []
+
+    def sync_factory(on_progress):
+        syncs.append(FakeSync(on_progress, **kwargs))
+        return syncs[-1]
+    runner = SyncJobRunner(session_factory, sync_factory, is_leader=lambda: leader, poll_interval=0.02)
+    runner.syncs = syncs
+    return runner
+
+
+def job_state(session_factory, job_id):
+    with session_factory() as session:
+        return session.get(SyncJob, job_id).present()
+
+
+def test_job_runs_and_records_timings(session_factory):
+    runner = make_runner(session_factory)
+    job, created = runner.submit(full=True, reason="test")
+    assert created and job['state'] == 'queued'
+    wait_for(lambda: job_state(session_factory, job['id'])['state'] == 'succeeded')
+
+    finished = job_state(session_factory, job['id'])
+    assert runner.syncs[0].runs == [True]
+    assert finished['progress']['cards'] == 3
+    assert set(finished['progress']['timings']) == {'starting', 'fetching', 'matching'}
+    assert finished['duration'] >= 0.01
+
+
+def test_queued_job_absorbs_requests(session_factory):
+    runner = make_runner(session_factory, leader=False)
+    first, _ = runner.submit()
+    second, created = runner.submit(full=True)
+    assert not created and second['id'] == first['id'] and second['kind'] == 'full'
+    time.sleep(0.1)
+    assert job_state(session_factory, first['id'])['state'] == 'queued'  # Only the leader runs jobs
+
+
+def test_failed_job(session_factory):
+    runner = make_runner(session_factory, fail=True)
+    job, _ = runner.submit()
+    wait_for(lambda: job_state(session_factory, job['id'])['state'] == 'failed')
+    assert job_state(session_factory, job['id'])['error'] == "Telegram is down"
+
+
+def test_submit_if_due(session_factory):
+    runner = make_runner(session_factory, leader=False)
+    assert runner.submit_if_due(3600) is not None
+    assert runner.submit_if_due(3600) is None  # Already queued
+
+
+def test_cancel_running_job(session_factory):
+    runner = make_runner(session_factory, duration=30)
+    job, _ = runner.submit()
+    wait_for(lambda: runner.syncs and runner.syncs[0].runs)
+    assert runner.cancel("worker test is no longer the leader")
+    wait_for(lambda: job_state(session_factory, job['id'])['state'] == 'failed')
+    assert job_state(session_factory, job['id'])['error'] == "Cancelled: worker test is no longer the leader"
+
+
+def test_job_taken_over_keeps_its_failed_state(session_factory):
+    runner = make_runner(session_factory, duration=0.3)
+    job, _ = runner.submit()
+    wait_for(lambda: job_state(session_factory, job['id'])['state'] == 'running')
+    with session_factory() as session:
+        # What the next leader does with jobs of a worker that lost the lease
+        interrupted = session.get(SyncJob, job['id'])
+        interrupted.state, interrupted.error = 'failed', "Interrupted"
+        session.commit()
+    time.sleep(0.5)
+    assert runner.syncs[0].runs == [False]
+    assert job_state(session_factory, job['id'])['state'] == 'failed'
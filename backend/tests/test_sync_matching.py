@@ -0,0 +1,40 @@
+import asyncio
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from card_matcher import CardMatcher
+from sync_matching import FUZZY_CHUNK_SIZE, MatchingPool
+
+
+Message = namedtuple('Message', ['id', 'text', 'date', 'media_type', 'media_id', 'image_hash'])
+
+
+def channel(texts):
+    start = datetime(2024, 1, 1)
+    return [Message(100 + position, text, start + timedelta(days=position), None, None, None)
+            for position, text in enumerate(texts)]
+
+
+def test_fuzzy_chunks_agree_with_the_matcher():
+    rng = random.Random(7)
+    words = ["alpha", "beta", "gamma", "delta", "omega", "sigma", "kappa", "zeta", "theta", "iota"]
+    names = [" ".join(rng.sample(words, rng.randint(2, 3))) + "x" for _ in range(FUZZY_CHUNK_SIZE * 2 + 10)]
+    messages = channel([None] + [f"Card: {rng.choice(names)}y {' '.join(rng.sample(words, 3))}" for _ in range(40)])
+    cards = [{'id': card_id, 'name': name, 'tg_id': None} for card_id, name in enumerate(names)]
+
+    pool = MatchingPool(2)
+    try:
+        matches = asyncio.run(pool.match_cards(cards, messages, {}, 8))
+        executor = pool._executor
+        assert asyncio.run(pool.match_cards(cards, messages, {}, 8)) == matches
+        assert pool._executor is executor  # Reused between syncs
+    finally:
+        pool.shutdown()
+    assert pool._executor is None
+
+    fuzzy = [index for index, (_, strategy) in enumerate(matches) if strategy != 'exact']
+    expected = CardMatcher(messages).fuzzy_match_many([names[index] for index in fuzzy])
+    assert [matches[index][0] for index in fuzzy] == \
+        [messages.index(message) if message else None for message, _ in expected]
+    assert len(fuzzy) > FUZZY_CHUNK_SIZE and any(matches[index][1] == 'fuzzy' for index in fuzzy)
@@ -0,0 +1,59 @@
+from datetime import datetime
+
+import pytest
+
+from models import CardUploadMetadata, TelegramSyncState
+from upload_metadata import load_upload_metadata, probe_upload_metadata
+
+
+@pytest.fixture
+def metadata(app_db):
+    CardUploadMetadata.__table__.create(app_db.engine)
+    app_db.session.add_all(
+        CardUploadMetadata(card_id=card_id, telegram_message_id=card_id * 10,
+                           upload_date=datetime(2024, 1, 1 + card_id % 28), season=None if card_id % 2 else 2)
+        for card_id in range(1, 201)
+    )
+    app_db.session.commit()
+    return app_db
+
+
+@pytest.mark.parametrize('card_count', [1, 100])
+def test_one_query_for_any_number_of_cards(metadata, count_queries, card_count):
+    statements = count_queries(metadata.engine)
+    loaded = load_upload_metadata(list(range(1, card_count + 1)))
+    assert len(loaded) == card_count
+    assert len(statements) == 1
+
+
+def test_values_and_defaults(metadata):
+    loaded = load_upload_metadata([1, 2, 999])
+    assert loaded == {
+        1: ('2024-01-02T00:00:00', 1),  # No season stored: season 1
+        2: ('2024-01-03T00:00:00', 2),
+    }
+
+
+def test_all_cards(metadata, count_queries):
+    statements = count_queries(metadata.engine)
+    assert len(load_upload_metadata()) == 200
+    assert len(statements) == 1
+
+
+def test_no_cards_no_query(metadata, count_queries):
+    statements = count_queries(metadata.engine)
+    assert load_upload_metadata([]) == {}
+    assert statements == []
+
+
+def test_probe_sees_syncs_and_imports(metadata):
+    TelegramSyncState.__table__.create(metadata.engine)
+    first = probe_upload_metadata()
+    assert first == (200, 200, None)
+    metadata.session.add(TelegramSyncState(channel='@channel', last_sync_at=datetime(2024, 2, 1)))
+    metadata.session.commit()
+    synced = probe_upload_metadata()
+    assert synced != first
+    metadata.session.add(CardUploadMetadata(card_id=999))
+    metadata.session.commit()
+    assert probe_upload_metadata() not in (first, synced)
@@ -0,0 +1,33 @@
+from catalog import CatalogCard, CategoryIndex
+from user_collections import UserCollectionCache, category_counts, ids_to_bitset, parse_user_cards
+
+
+def test_parse_user_cards():
+    collection = parse_user_cards("3, 1,3,,x,2")
+    assert list(collection.all_ids) == [3, 1, 3, 2]
+    assert list(collection.card_ids) == [1, 2, 3]
+    assert list(collection.counts) == [1, 1, 2]
+    assert (collection.total_tokens, collection.unique_tokens) == (5, 4)
+    assert len(parse_user_cards("?")) == 0
+
+
+def test_bitset():
+    assert ids_to_bitset([0, 3, 9]) == 0b1000001001
+    assert ids_to_bitset([]) == 0
+
+
+def test_category_counts():
+    cards = [CatalogCard(card_id, 'f', f'card {card_id}', 'rare' if card_id % 2 else 'common', 1,
+                         '-', False, None, 1) for card_id in range(1, 11)]
+    index = CategoryIndex.build(cards)
+    counts = category_counts(parse_user_cards("1,2,3,3,42").bits, index)
+    assert counts['all'] == 3
+    assert counts['shop'] == 0
+    assert sum(count for category_id, count in counts.items() if category_id.startswith('rarity_')) == 3
+
+
+def test_cache_reparses_only_on_change():
+    cache = UserCollectionCache(max_entries=2)
+    first = cache.get(1, "1,2")
+    assert cache.get(1, "1,2") is first
+    assert list(cache.get(1, "1,2,5").card_ids) == [1, 2, 5]
@@ -0,0 +1,31 @@
+from sqlalchemy import func, select
+
+from models import db, CardUploadMetadata, TelegramSyncState
+
+
+def load_upload_metadata(card_ids=None):
+    """Fetch upload metadata for many cards at once (all cards if card_ids is None):
+    {card_id: (upload_date, season)}"""
+    query = db.session.query(
+        CardUploadMetadata.card_id,
+        CardUploadMetadata.upload_date,
+        CardUploadMetadata.season
+    )
+    if card_ids is not None:
+        if not card_ids:
+            return {}
+        query = query.filter(CardUploadMetadata.card_id.in_(set(card_ids)))
+    return {
+        row.card_id: (row.upload_date.isoformat() if row.upload_date else None, row.season or 1)
+        for row in query.all()
+    }
+
+
+def probe_upload_metadata():
+    """Cheap (row count, max id, last sync) of the upload metadata, which changes whenever any worker's sync
+    or an import wrote it"""
+    return tuple(db.session.execute(select(
+        select(func.count()).select_from(CardUploadMetadata).scalar_subquery(),
+        select(func.max(CardUploadMetadata.id)).scalar_subquery(),
+        select(func.max(TelegramSyncState.last_sync_at)).scalar_subquery()
+    )).one())
@@ -0,0 +1,174 @@
+import random
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+
+def ids_to_bitset(card_ids):
+    """Pack card ids into an int whose bit N is set when card N is present"""
+    card_ids = [card_id for card_id in card_ids if card_id >= 0]
+    if not card_ids:
+        return 0
+    # Set bits in a byte buffer and convert once; OR-ing into a growing int is quadratic
+    buffer = bytearray(max(card_ids) // 8 + 1)
+    for card_id in card_ids:
+        buffer[card_id >> 3] |= 1 << (card_id & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+if hasattr(int, 'bit_count'):
+    def popcount(bits):
+        return bits.bit_count()
+else:  # Python < 3.10
+    def popcount(bits):
+        return bin(bits).count('1')
+
+
+def category_counts(user_bits, index):
+    """{category_id: number of the user's distinct cards in it} for every category of a CategoryIndex.
+
+    Each count is one AND plus a popcount over machine words, done in C,
+    instead of a COUNT(*) ... WHERE id IN (<whole collection>) per category.
+    """
+    return {
+        category_id: popcount(user_bits & index.bitset(category_id))
+        for category_id in index.ids_by_category
+    }
+
+
+class UserCollection:
+    """A parsed `users.cards` column.
+
+    `all_ids` keeps every valid id in stored order (duplicates included),
+    `card_ids`/`counts` are the distinct ids in ascending order with their
+    multiplicity. Token totals count every non-empty entry, valid or not,
+    which is what the stats and profile pages have always reported.
+    """
+
+    __slots__ = ('all_ids', 'card_ids', 'counts', 'total_tokens', 'unique_tokens', '_bits', '_id_set')
+
+    def __init__(self, all_ids, card_ids, counts, total_tokens, unique_tokens):
+        self.all_ids = all_ids
+        self.card_ids = card_ids
+        self.counts = counts
+        self.total_tokens = total_tokens
+        self.unique_tokens = unique_tokens
+        self._bits = None
+        self._id_set = None
+
+    @property
+    def bits(self):
+        """Distinct card ids as an int bitset, see ids_to_bitset()"""
+        if self._bits is None:
+            self._bits = ids_to_bitset(self.card_ids)
+        return self._bits
+
+    @property
+    def id_set(self):
+        if self._id_set is None:
+            self._id_set = frozenset(self.card_ids)
+        return self._id_set
+
+    def __len__(self):
+        return len(self.all_ids)
+
+
+EMPTY_COLLECTION = UserCollection(array('l'), array('l'), array('l'), 0, 0)
+
+
+def parse_user_cards(cards_text):
+    """Parse the comma-separated `users.cards` column ("?" means no cards)"""
+    if not cards_text or cards_text == "?":
+        return EMPTY_COLLECTION
+
+    tokens = [token.strip() for token in cards_text.split(',')]
+    tokens = [token for token in tokens if token]
+
+    all_ids = array('l')
+    multiplicity = {}
+    for token in tokens:
+        try:
+            card_id = int(token)
+        except ValueError:
+            continue
+        all_ids.append(card_id)
+        multiplicity[card_id] = multiplicity.get(card_id, 0) + 1
+
+    card_ids = array('l', sorted(multiplicity))
+    counts = array('l', (multiplicity[card_id] for card_id in card_ids))
+    return UserCollection(all_ids, card_ids, counts, len(tokens), len(set(tokens)))
+
+
+class UserCollectionCache:
+    """Per-user LRU cache of parsed collections.
+
+    An entry is reused while the raw column has the same length and hash, so
+    a collection is only re-parsed after the bot actually changed it.
+    """
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user_id -> (fingerprint, UserCollection)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, cards_text):
+        cards_text = cards_text or ""
+        fingerprint = (len(cards_text), hash(cards_text))
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] == fingerprint:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+
+        collection = parse_user_cards(cards_text)
+        with self._lock:
+            self.misses += 1
+            self._entries[user_id] = (fingerprint, collection)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return collection
+
+
+def _benchmark(catalog_size=20000, collection_size=12000, rarity_count=25, rounds=50):
+    """Compare bitset and set-intersection counting on a synthetic catalog"""
+    from catalog import CatalogCard, CategoryIndex
+
+    rng = random.Random(42)
+    cards = [
+        CatalogCard(
+            id=card_id, photo=None, name=f"card {card_id}", rarity=f"rarity {rng.randrange(rarity_count)}",
+            points=0, shop=None, in_shop=rng.random() < 0.2, upload_date=None, season=1
+        )
+        for card_id in range(1, catalog_size + 1)
+    ]
+    index = CategoryIndex.build(cards)
+    collection = [rng.randint(1, catalog_size) for _ in range(collection_size)]
+
+    def run(label, count_all):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            result = count_all()
+        elapsed = (time.perf_counter() - started) / rounds * 1000
+        print(f"{label:<34} {elapsed:8.3f} ms/request")
+        return result
+
+    category_sets = {category_id: set(ids) for category_id, ids in index.ids_by_category.items()}
+    for category_id in index.ids_by_category:
+        index.bitset(category_id)  # Category bitsets are built once per catalog version
+
+    with_sets = run("set intersection", lambda: {
+        category_id: len(set(collection) & ids) for category_id, ids in category_sets.items()
+    })
+    with_bits = run("bitset (incl. building user bits)", lambda: category_counts(ids_to_bitset(collection), index))
+    user_bits = ids_to_bitset(collection)
+    run("bitset (cached user bits)", lambda: category_counts(user_bits, index))
+    assert with_sets == with_bits
+
+
+if __name__ == "__main__":
+    _benchmark()